@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares per-write latency of the dill whole-file cache dump previously used
+by the search clients with the incremental SqliteCache.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os, sys
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'src'))
+
+import argparse
+import json
+import statistics
+import tempfile
+from time import perf_counter
+
+import dill
+from expiringdict import ExpiringDict
+
+from cache import SqliteCache
+
+def make_docs(qid, count):
+  return [{
+    'id': f'wc:{qid}_{i}.jpg',
+    'title': f'{qid} image {i}',
+    'description': 'Lorem ipsum dolor sit amet ' * 4,
+    'url': f'https://commons.wikimedia.org/wiki/File:{qid}_{i}.jpg',
+    'thumbnail': f'https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/{qid}_{i}.jpg/240px-{qid}_{i}.jpg',
+    'depicts': [{'id': f'Q{j}', 'label': f'label {j}', 'prominent': j == 0} for j in range(5)],
+    'weight': 2
+  } for i in range(count)]
+
+def bench_dill(path, entries, docs_per_entry):
+  cache = ExpiringDict(max_len=entries, max_age_seconds=1800)
+  timings = []
+  for i in range(entries):
+    start = perf_counter()
+    cache[f'Q{i}'] = make_docs(f'Q{i}', docs_per_entry)
+    dill.dump(cache, open(path, 'wb'))
+    timings.append(perf_counter() - start)
+  return timings
+
+def bench_sqlite(path, entries, docs_per_entry):
+  cache = SqliteCache(path, max_len=entries, max_age_seconds=1800)
+  timings = []
+  for i in range(entries):
+    start = perf_counter()
+    cache[f'Q{i}'] = make_docs(f'Q{i}', docs_per_entry)
+    timings.append(perf_counter() - start)
+  return timings
+
+def summarize(timings):
+  timings = sorted(timings)
+  return {
+    'writes': len(timings),
+    'mean_ms': round(statistics.mean(timings)*1000, 3),
+    'p50_ms': round(timings[len(timings)//2]*1000, 3),
+    'p95_ms': round(timings[int(len(timings)*.95)]*1000, 3),
+    'last_ms': round(timings[-1]*1000, 3)
+  }
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Search cache write latency benchmark')
+  parser.add_argument('--entries', help='Number of cache entries written', type=int, default=100)
+  parser.add_argument('--docs', help='Docs per cache entry', type=int, default=100)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    results = {
+      'dill': summarize(bench_dill(f'{tmpdir}/dill.cache', args.entries, args.docs)),
+      'sqlite': summarize(bench_sqlite(f'{tmpdir}/sqlite.cache', args.entries, args.docs))
+    }
+  print(json.dumps(results, indent=2))
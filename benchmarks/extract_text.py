@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares Commons extmetadata text extraction using the html5lib BeautifulSoup
+tree with the lxml extractor, cold and memoized.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os, sys
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'src'))
+
+import argparse
+import json
+from time import perf_counter
+
+from search.htmltext import extract_text, extract_text_html5lib
+
+SAMPLES = [
+  'Mona Lisa',
+  'Leonardo da Vinci',
+  '<div class="description mw-content-ltr en" dir="ltr" lang="en"><span class="language en" title="English"><b>English:</b></span> Portrait of Lisa Gherardini, wife of Francesco del Giocondo</div><div class="description mw-content-ltr fr" dir="ltr" lang="fr"><span class="language fr" title="Français"><b>Français&#160;:</b></span> Portrait de Mona Lisa</div>',
+  '<a href="https://en.wikipedia.org/wiki/Leonardo_da_Vinci" class="extiw" title="w:Leonardo da Vinci">Leonardo da Vinci</a>',
+  '<bdi><a href="https://www.wikidata.org/wiki/Q762" class="extiw" title="d:Q762"><span title="Italian Renaissance polymath (1452–1519)">Leonardo da Vinci</span></a><br /></bdi>',
+  'Louvre Museum &amp; C2RMF',
+  '<p>Scan by <i>C2RMF</i>: Galerie de tableaux en très haute définition<br>\nRetouched</p>',
+  '<table class="vcard"><tr><td lang="en">Unknown author</td></tr></table>',
+]
+
+def timeit(fn, values, repeat):
+  start = perf_counter()
+  for _ in range(repeat):
+    for val in values:
+      fn(val)
+  return round((perf_counter() - start) / (repeat * len(values)) * 1e6, 2)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Commons extmetadata text extraction benchmark')
+  parser.add_argument('--repeat', help='Iterations over the sample values', type=int, default=200)
+  args = parser.parse_args()
+
+  for val in SAMPLES:
+    assert extract_text(val) == extract_text_html5lib(val), val
+
+  results = {
+    'html5lib_us': timeit(extract_text_html5lib, SAMPLES, args.repeat),
+    'lxml_us': timeit(extract_text.__wrapped__, SAMPLES, args.repeat),
+    'lxml_memoized_us': timeit(extract_text, SAMPLES, args.repeat)
+  }
+  print(json.dumps(results, indent=2))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Benchmarks SearchClient.merge against the previous weight-loop merge over
+synthetic sources.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os, sys
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'src'))
+
+import argparse
+import json
+import random
+from time import perf_counter
+
+from search import SearchClient
+
+def legacy_merge(by_source, offset=0, limit=10):
+  cursors = dict([(source, 0) for source in by_source])
+  docs = [] 
+  try:   
+    for weight in range(5, 0, -1):
+      weight_done = False
+      while not weight_done:
+        matched = False
+        for source in sorted(by_source):
+          source_docs = by_source[source]['docs']
+          if len(source_docs) > cursors[source] and source_docs[cursors[source]]['weight'] == weight:
+            to_add = source_docs[cursors[source]]
+            to_add['seq'] = offset + len(docs)
+            docs.append(to_add)
+            cursors[source] += 1
+            matched = True
+            if len(docs) == offset + limit:
+              raise StopIteration
+        weight_done = not matched
+  except StopIteration:
+    pass
+  return docs[offset:offset+limit]
+
+def make_sources(count, docs_per_source):
+  by_source = {}
+  for idx in range(count):
+    docs = [{'id': f's{idx}:{i}', 'title': f'doc {i}', 'weight': random.choice((1, 2, 2, 2, 3, 4))} for i in range(docs_per_source)]
+    docs.sort(key=lambda doc: doc['weight'], reverse=True)
+    by_source[f'source{idx}'] = {'total': len(docs), 'docs': docs}
+  return by_source
+
+def make_ties(count, docs_per_source):
+  '''Sources of uneven length whose docs all have the same weight, so every position is
+  a tie across sources.'''
+  return dict([(f'source{idx}', {'total': docs_per_source * (idx + 1), 'docs': [
+    {'id': f's{idx}:{i}', 'title': f'doc {i}', 'weight': 2} for i in range(docs_per_source * (idx + 1))]}) for idx in range(count)])
+
+def page(docs):
+  return [(doc['id'], doc['seq']) for doc in docs]
+
+def check_equivalence(merge, by_source, offsets, limit):
+  '''Asserts merge returns the docs, in the order and with the seq, of the legacy merge.'''
+  for offset in offsets:
+    expected = page(legacy_merge(by_source, offset, limit))
+    assert page(merge(None, by_source, offset, limit)) == expected, f'offset={offset}'
+
+def timeit(fn, repeat):
+  start = perf_counter()
+  for _ in range(repeat):
+    fn()
+  return round((perf_counter() - start) / repeat * 1000, 3)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Search results merge benchmark')
+  parser.add_argument('--sources', help='Number of sources', type=int, default=2)
+  parser.add_argument('--docs', help='Docs per source', type=int, default=10000)
+  parser.add_argument('--limit', help='Page size', type=int, default=10)
+  parser.add_argument('--repeat', help='Iterations per measurement', type=int, default=20)
+  args = parser.parse_args()
+
+  random.seed(0)
+  by_source = make_sources(args.sources, args.docs)
+  merge = SearchClient.merge
+  past_end = args.sources * args.docs
+  # pages at the start, inside, straddling and past the end of the merged docs
+  check_equivalence(merge, by_source, (0, 1, 100, 1000, past_end - args.limit // 2, past_end, past_end + 100), args.limit)
+  check_equivalence(merge, make_ties(args.sources, 25), range(0, 25 * args.sources * (args.sources + 1) // 2 + args.limit, 3), args.limit)
+  results = {}
+  for offset in (0, 100, 1000, args.docs):
+    results[f'offset={offset}'] = {
+      'legacy_ms': timeit(lambda: legacy_merge(by_source, offset, args.limit), args.repeat),
+      'heap_ms': timeit(lambda: merge(None, by_source, offset, args.limit), args.repeat)
+    }
+  print(json.dumps(results, indent=2))
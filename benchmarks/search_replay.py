@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Search microbenchmarks over recorded upstream responses.
+
+record fetches the searches for a QID corpus from the live upstreams once and
+saves every response to a fixtures file; with --synthetic the responses are
+generated instead, which is how the committed fixtures were made.  Requests are
+matched on a key that sorts the lists the clients build from sets (SPARQL VALUES
+and IN lists, OR'ed ids, titles), so a replay matches whatever order a run builds
+them in.  run replays the fixtures with injected
+latency and reports, for a cold-cache pass over the corpus followed by warm
+passes: end-to-end latency, CPU time per stage (parsing, merging, label and
+metadata enrichment, encoding) and allocations.  Each measurement (latency, CPU
+profile, allocations) runs in a fresh worker process with empty caches in a
+temporary directory, so the profilers do not skew the latencies and every cold
+pass is really cold.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os, sys
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'src'))
+
+import argparse
+import asyncio
+import cProfile
+import gzip
+import hashlib
+import json
+import pstats
+import random
+import re
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+from time import perf_counter, process_time
+from urllib.parse import parse_qs, parse_qsl, unquote, urlencode
+
+import httpx
+
+CORPUS = ['Q42', 'Q12418', 'Q762', 'Q5582', 'Q90', 'Q1339', 'Q7186', 'Q146', 'Q9202', 'Q243']
+FIXTURES = os.path.join(SCRIPT_DIR, 'fixtures', 'search.json.gz')
+TARGETS = ('search', 'search_json', 'commons', 'jstor')
+
+# Stages reported from the CPU profile: (file, function) pairs whose inclusive time is summed
+STAGES = {
+  'parsing': [('httpx/_models.py', 'json')],
+  'merging': [('search/__init__.py', 'merge')],
+  'labels': [('search/labels.py', 'add_labels')],
+  'metadata': [('search/commons.py', 'image_metadata'), ('search/commons.py', 'apply_metadata')],
+  'depicts': [('search/jstor.py', 'depicts_items'), ('search/jstor.py', 'apply_depicts_items')],
+  'encoding': [('search/pages.py', 'encode_docs')]
+}
+
+# Lists the clients build from sets, whose order varies between runs: SPARQL VALUES and IN
+# lists, Solr OR lists and MediaWiki title lists.
+SET_LISTS = (
+  (re.compile(r'(VALUES\s*\([^()]*\)\s*\{)([^{}]*)(\})'), None),
+  (re.compile(r'(IN \()([^()]*)(\))'), ', '),
+  (re.compile(r'(\()([^()]* OR [^()]*)(\))'), ' OR ')
+)
+
+def canonical(text):
+  '''text with the set-built lists in it sorted.'''
+  for pattern, sep in SET_LISTS:
+    text = pattern.sub(lambda m: m.group(1) + (sep or ' ').join(sorted(m.group(2).split(sep))) + m.group(3), text)
+  return text
+
+def canonical_body(request):
+  content = request.content.decode('utf-8', errors='replace')
+  if 'json' in request.headers.get('content-type', ''):
+    def sort_lists(value):
+      if isinstance(value, dict):
+        return dict([(key, sort_lists(val)) for key, val in sorted(value.items())])
+      if isinstance(value, list):
+        return [sort_lists(val) for val in value]
+      return canonical(value) if isinstance(value, str) else value
+    return json.dumps(sort_lists(json.loads(content)), sort_keys=True)
+  if 'form-urlencoded' in request.headers.get('content-type', ''):
+    return urlencode([(key, canonical(value)) for key, value in parse_qsl(content)])
+  return content
+
+def fixture_key(request):
+  '''Method, URL path and a hash of the query and body with set-built lists sorted, so keys
+  match whatever order a run builds the lists in.'''
+  params = [(key, '|'.join(sorted(value.split('|'))) if key == 'titles' else canonical(value)) for key, value in parse_qsl(request.url.query.decode('utf-8'))]
+  digest = hashlib.sha1(f'{urlencode(params)}\n{canonical_body(request)}'.encode('utf-8')).hexdigest()[:16]
+  return f'{request.method} {request.url.scheme}://{request.url.host}{unquote(request.url.path)} {digest}'
+
+def label_qids(request):
+  '''QIDs of a label service query, None for other requests.  Which QIDs are batched
+  together depends on the timing of concurrent searches, so labels are recorded per
+  QID and label responses are built from them on replay.'''
+  if request.method != 'POST' or request.url.host != 'query.wikidata.org':
+    return None
+  query = parse_qs(request.content.decode('utf-8')).get('query', [''])[0]
+  return re.findall(r'<http://www.wikidata.org/entity/(Q\d+)>', query) if 'rdfs:label' in query else None
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+  '''Sends requests upstream and keeps their responses by fixture key.'''
+
+  def __init__(self, transport=None):
+    self.transport = transport or httpx.AsyncHTTPTransport()
+    self.responses = {}
+    self.labels = {}
+
+  async def handle_async_request(self, request):
+    await request.aread()
+    resp = await self.transport.handle_async_request(request)
+    content = await resp.aread()
+    if label_qids(request) is not None:
+      if resp.status_code == 200:
+        for rec in json.loads(content)['results']['bindings']:
+          self.labels[rec['item']['value'].split('/')[-1]] = rec['label']['value']
+      return httpx.Response(resp.status_code, headers=resp.headers, content=content)
+    self.responses[fixture_key(request)] = {
+      'status': resp.status_code,
+      'content_type': resp.headers.get('content-type'),
+      'text': content.decode('utf-8', errors='replace')
+    }
+    return httpx.Response(resp.status_code, headers=resp.headers, content=content)
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+  '''Serves recorded responses after latency_ms (plus up to jitter_ms) per request.
+  Requests missing from the fixtures get a 404 and are counted as unmatched.'''
+
+  def __init__(self, responses, labels=None, latency_ms=0, jitter_ms=0, seed=0):
+    self.responses = responses
+    self.labels = labels or {}
+    self.latency_ms = latency_ms
+    self.jitter_ms = jitter_ms
+    self._random = random.Random(seed)
+    self.counters = {'requests': 0, 'unmatched': 0}
+
+  async def handle_async_request(self, request):
+    await request.aread()
+    self.counters['requests'] += 1
+    await asyncio.sleep((self.latency_ms + self._random.uniform(0, self.jitter_ms)) / 1000)
+    qids = label_qids(request)
+    if qids is not None:
+      return httpx.Response(200, json={'results': {'bindings': [
+        {'item': {'value': f'http://www.wikidata.org/entity/{qid}'}, 'label': {'value': self.labels[qid]}}
+        for qid in qids if qid in self.labels]}})
+    rec = self.responses.get(fixture_key(request))
+    if rec is None:
+      self.counters['unmatched'] += 1
+      return httpx.Response(404, json={})
+    return httpx.Response(rec['status'], headers={'content-type': rec['content_type'] or 'application/json'}, content=rec['text'].encode('utf-8'))
+
+WORDS = ('portrait', 'landscape', 'study', 'view', 'sketch', 'detail', 'interior', 'figure', 'still life', 'panel')
+LICENSES = ('Creative Commons: Free Reuse (CC0)', 'Creative Commons: Attribution', 'Creative Commons: Attribution-NonCommercial')
+
+class SyntheticTransport(httpx.AsyncBaseTransport):
+  '''Stand-in for the live upstreams, for recording fixtures without network access.
+  Answers every request the search clients make with a response of the upstream's
+  shape, generated deterministically from the QID, file title or JSTOR id it is about.'''
+
+  def _sparql(self, rows):
+    return httpx.Response(200, json={'results': {'bindings': rows}})
+
+  def _titles(self, qid, count):
+    rnd = random.Random(f'titles {qid}')
+    return [f'{qid} {rnd.choice(WORDS)} {idx}.jpg' for idx in range(count)]
+
+  def _depicts(self, key, qid):
+    rnd = random.Random(key)
+    return [qid] + [f'Q{rnd.randint(1, 10**6)}' for _ in range(rnd.randint(0, 3))]
+
+  def _jstor_ids(self, qid, count):
+    rnd = random.Random(f'jstor {qid}')
+    return [str(rnd.randint(10**7, 10**8)) for _ in range(count)]
+
+  def wikidata_sparql(self, query):
+    qid = (re.findall(r'wd:(Q\d+)', query) or ['Q0'])[0]
+    rnd = random.Random(canonical(query))
+    if re.search(r'wdt:P18\b', query):
+      return self._sparql([
+        {'image': {'value': f'http://commons.wikimedia.org/wiki/Special:FilePath/{title.replace(" ", "_")}'}, 'depicts': {'value': f'http://www.wikidata.org/entity/{depicts}'}}
+        for title in self._titles(f'wd{qid}', rnd.randint(5, 40)) for depicts in self._depicts(title, qid)])
+    if 'IN (' in query:
+      ids = sorted(re.findall(r'"(\d+)"', query))
+      return self._sparql([
+        {'entity': {'value': f'http://www.wikidata.org/entity/Q{int(jstor_id) % 10**6}'}, 'jstorId': {'value': jstor_id}, 'depicts': {'value': f'http://www.wikidata.org/entity/{depicts}'}}
+        for jstor_id in ids if int(jstor_id) % 3 == 0 for depicts in self._depicts(jstor_id, qid)])
+    if 'P10187' in query:
+      return self._sparql([{'jstorId': {'value': jstor_id}} for jstor_id in self._jstor_ids(qid, rnd.randint(0, 15))])
+    return self._sparql([])
+
+  def wcqs_sparql(self, query):
+    qid = (re.findall(r'wd:(Q\d+)', query) or ['Q0'])[0]
+    rnd = random.Random(canonical(query))
+    rows = []
+    for title in self._titles(qid, rnd.randint(20, 300)):
+      dro = rnd.random() < 0.05
+      for depicts in self._depicts(title, qid):
+        row = {
+          'entity': {'value': f'https://commons.wikimedia.org/entity/M{random.Random(title).randint(1, 10**8)}'},
+          'image': {'value': f'http://commons.wikimedia.org/wiki/Special:FilePath/{title.replace(" ", "_")}'},
+          'depicts': {'value': f'http://www.wikidata.org/entity/{depicts}'},
+          'rank': {'value': 'http://wikiba.se/ontology#PreferredRank' if rnd.random() < 0.3 else 'http://wikiba.se/ontology#NormalRank'}
+        }
+        if dro:
+          row['dro'] = {'value': f'http://www.wikidata.org/entity/{qid}'}
+        rows.append(row)
+    return self._sparql(rows)
+
+  def commons_api(self, params):
+    if params.get('list') == 'search':
+      prop, qid = params['srsearch'].split(':', 1)[1].split('=')
+      count = random.Random(params['srsearch']).randint(0, 200 if prop == 'P180' else 3)
+      return httpx.Response(200, json={'query': {'search': [{'ns': 6, 'title': f'File:{title}'} for title in self._titles(f'{prop}{qid}', count)]}})
+    pages = {}
+    for idx, title in enumerate(sorted(params.get('titles', '').split('|'))):
+      rnd = random.Random(title)
+      pages[str(rnd.randint(10**6, 10**8))] = {'ns': 6, 'title': title, 'imageinfo': [{'size': rnd.randint(10**4, 10**7), 'mime': 'image/jpeg', 'extmetadata': {
+        'ObjectName': {'value': f'<div lang="en">{title[5:-4].title()}</div><div lang="fr">{title[5:-4]}</div>'},
+        'ImageDescription': {'value': f'<p>A <b>{rnd.choice(WORDS)}</b> of {title[5:-4]}, with <a href="https://example.org">notes</a>.</p>' * rnd.randint(1, 4)},
+        'Artist': {'value': f'<big><a href="https://commons.wikimedia.org/wiki/User:Someone{idx}">Someone {idx}</a></big>'},
+        'LicenseUrl': {'value': 'https://creativecommons.org/licenses/by-sa/4.0'}
+      }}]}
+    return httpx.Response(200, json={'batchcomplete': '', 'query': {'pages': pages}})
+
+  def wikidata_entity(self, qid):
+    rnd = random.Random(f'entity {qid}')
+    label = f'{rnd.choice(WORDS).title()} {qid}'
+    aliases = [{'language': 'en', 'value': f'{rnd.choice(WORDS)} {qid} {idx}'} for idx in range(rnd.randint(0, 6))]
+    return httpx.Response(200, json={'entities': {qid: {'id': qid, 'labels': {'en': {'language': 'en', 'value': label}}, 'aliases': {'en': aliases}}}})
+
+  def labs_about(self, query):
+    hits = []
+    if 'value.id.value:$' in query:
+      qid = re.findall(r'\$(Q\d+)', query)[0]
+      hits = [{'_source': {'id': f'community.{jstor_id}'}} for jstor_id in self._jstor_ids(f'labs {qid}', random.Random(canonical(query)).randint(0, 10))]
+    elif query.startswith('id:('):
+      for doc_id in sorted(re.findall(r'"community\.(\d+)"', query)):
+        if int(doc_id) % 4 == 0:
+          rnd = random.Random(doc_id)
+          statements = {'P180': [{'rank': 'preferred' if rnd.random() < 0.3 else 'normal', 'mainsnak': {'datavalue': {'value': {'id': {'value': depicts}}}}} for depicts in self._depicts(doc_id, f'Q{rnd.randint(1, 10**6)}')]}
+          hits.append({'_source': {'id': f'community.{doc_id}', 'statements': statements}})
+    return httpx.Response(200, json={'hits': {'total': {'value': len(hits)}, 'hits': hits}})
+
+  def jstor_search(self, args):
+    start = int(args.get('page_mark') or 0)
+    if args['query'] == '*:*':
+      ids = sorted(re.findall(r'community\.(\d+)', ' '.join(args.get('filter_queries', []))))
+      total = len(ids)
+    else:
+      total = random.Random(f'total {canonical(args["query"])}').randint(0, 800)
+      ids = [str(10**7 + idx) for idx in range(start, min(total, start + args['limit']))]
+    results = []
+    for doc_id in ids[:args['limit']]:
+      rnd = random.Random(doc_id)
+      results.append({
+        'doi': f'10.2307/community.{doc_id}', 'id': doc_id, 'item_title': f'{rnd.choice(WORDS).title()} {doc_id}',
+        'cc_reuse_license': [rnd.choice(LICENSES)], 'ps_desc': [f'A {rnd.choice(WORDS)} from the collection.'] * rnd.randint(0, 2),
+        'ps_source': [f'Museum {rnd.randint(1, 50)}'], 'ps_subject': [f'{rnd.choice(WORDS).title()}.', f'{rnd.choice(WORDS).title()}.']
+      })
+    next_mark = None if args['query'] == '*:*' or start + args['limit'] >= total else str(start + args['limit'])
+    return httpx.Response(200, json={'total': total, 'paging': {'next': next_mark}, 'results': results})
+
+  async def handle_async_request(self, request):
+    await request.aread()
+    host, path = request.url.host, request.url.path
+    params = dict(parse_qsl(request.url.query.decode('utf-8')))
+    qids = label_qids(request)
+    if qids is not None:
+      return self._sparql([
+        {'item': {'value': f'http://www.wikidata.org/entity/{qid}'}, 'label': {'value': f'{random.Random(qid).choice(WORDS)} {qid}'}} for qid in qids])
+    if host == 'query.wikidata.org':
+      return self.wikidata_sparql(params.get('query', ''))
+    if host == 'wcqs-beta.wmflabs.org':
+      return self.wcqs_sparql(params.get('query', ''))
+    if host == 'commons.wikimedia.org':
+      return self.commons_api(params)
+    if host == 'www.wikidata.org':
+      return self.wikidata_entity(path.split('/')[-1].split('.')[0])
+    if host == 'www.jstor.org' and path.endswith('/labs/about/'):
+      return self.labs_about(json.loads(request.content)['query']['query_string']['query'])
+    if host == 'www.jstor.org':
+      return self.jstor_search(json.loads(request.content))
+    return httpx.Response(404, json={})
+
+def search_fn(target):
+  '''Coroutine function searching a QID with the target client.  Imported here, after
+  the worker has moved to its temporary directory, as the caches open on import.'''
+  from search import SearchClient
+  if target == 'search':
+    client = SearchClient()
+    return lambda qid: client.search(qid)
+  if target == 'search_json':
+    client = SearchClient()
+    # all ResultsDoc and Depicts fields, as /search/{qid}/ passes them
+    return lambda qid: client.search_json(qid, ['seq', 'id', 'title', 'description', 'url', 'depicts', 'tags', 'digital_representation_of', 'thumbnail', 'owner', 'rights', 'weight'], ['id', 'label', 'prominent'])
+  from search.commons import CommonsClient
+  from search.jstor import JSTORClient
+  client = CommonsClient() if target == 'commons' else JSTORClient()
+  return lambda qid: client.search(qid)
+
+def stage_times(profile, searches):
+  stats = pstats.Stats(profile).stats
+  times = dict([(stage, 0) for stage in STAGES])
+  for (filename, _, funcname), (_, _, _, cumtime, _) in stats.items():
+    for stage, funcs in STAGES.items():
+      if any(filename.endswith(path) and funcname == name for path, name in funcs):
+        times[stage] += cumtime
+  return dict([(stage, round(cpu / searches * 1000, 3)) for stage, cpu in times.items()])
+
+async def run_pass(search, qids, mode):
+  '''Searches qids one after another, returns the measurements of the pass.'''
+  timings, peaks, retained = [], [], []
+  profile = cProfile.Profile(process_time) if mode == 'cpu' else None
+  cpu_start = process_time()
+  for qid in qids:
+    if mode == 'alloc':
+      tracemalloc.reset_peak()
+      before = tracemalloc.get_traced_memory()[0]
+    if profile:
+      profile.enable()
+    start = perf_counter()
+    await search(qid)
+    timings.append(perf_counter() - start)
+    if profile:
+      profile.disable()
+    if mode == 'alloc':
+      current, peak = tracemalloc.get_traced_memory()
+      peaks.append(peak - before)
+      retained.append(current - before)
+  if mode == 'latency':
+    return {**summarize(timings), 'cpu_ms': round((process_time() - cpu_start) / len(qids) * 1000, 3)}
+  if mode == 'cpu':
+    return {'stages_cpu_ms': stage_times(profile, len(qids))}
+  return {'peak_kb': round(statistics.mean(peaks) / 1024, 1), 'retained_kb': round(statistics.mean(retained) / 1024, 1)}
+
+def worker(args):
+  '''Runs a cold pass and args.repeat warm passes in one measurement mode, prints JSON.'''
+  with open(args.fixtures, 'rb') as fp:
+    fixtures = json.loads(gzip.decompress(fp.read()))
+  from upstream import engine, policy
+  transport = ReplayTransport(fixtures['responses'], fixtures.get('labels'), args.latency_ms, args.jitter_ms)
+  engine.transport = transport
+  policy.hedging = False # duplicate requests would make the replayed request counts vary
+  qids = args.qids or fixtures['qids']
+  with tempfile.TemporaryDirectory() as tmpdir:
+    os.chdir(tmpdir)
+    search = search_fn(args.target)
+    if args.mode == 'alloc':
+      tracemalloc.start()
+
+    async def passes():
+      results = {'cold': await run_pass(search, qids, args.mode)}
+      warm = [await run_pass(search, qids, args.mode) for _ in range(args.repeat)]
+      results['warm'] = warm[-1] if args.mode != 'latency' else summarize_passes(warm)
+      results['upstream'] = dict(transport.counters)
+      return results
+    results = asyncio.run(passes())
+    os.chdir(SCRIPT_DIR)
+  print(json.dumps(results))
+
+def summarize(timings):
+  timings = sorted(timings)
+  return {
+    'searches': len(timings),
+    'mean_ms': round(statistics.mean(timings)*1000, 3),
+    'p50_ms': round(timings[len(timings)//2]*1000, 3),
+    'p95_ms': round(timings[int(len(timings)*.95)]*1000, 3),
+    'max_ms': round(timings[-1]*1000, 3)
+  }
+
+def summarize_passes(passes):
+  return {
+    'searches': sum(rec['searches'] for rec in passes),
+    'mean_ms': round(statistics.mean([rec['mean_ms'] for rec in passes]), 3),
+    'p50_ms': round(statistics.median([rec['p50_ms'] for rec in passes]), 3),
+    'p95_ms': round(max([rec['p95_ms'] for rec in passes]), 3),
+    'max_ms': round(max([rec['max_ms'] for rec in passes]), 3),
+    'cpu_ms': round(statistics.mean([rec['cpu_ms'] for rec in passes]), 3)
+  }
+
+def record(args):
+  '''Searches the corpus against the live upstreams, or the synthetic ones, saving every response.'''
+  from upstream import engine
+  transport = RecordingTransport(SyntheticTransport() if args.synthetic else None)
+  engine.transport = transport
+  qids = args.qids or CORPUS
+  with tempfile.TemporaryDirectory() as tmpdir:
+    os.chdir(tmpdir)
+    searches = [search_fn(target) for target in ('search', 'search_json')]
+    async def run():
+      for qid in qids:
+        for search in searches:
+          await search(qid)
+    asyncio.run(run())
+    os.chdir(SCRIPT_DIR)
+  os.makedirs(os.path.dirname(args.fixtures), exist_ok=True)
+  with open(args.fixtures, 'wb') as fp:
+    fp.write(gzip.compress(json.dumps({'qids': qids, 'synthetic': args.synthetic, 'responses': transport.responses, 'labels': transport.labels}, sort_keys=True).encode('utf-8'), mtime=0))
+  print(json.dumps({'fixtures': args.fixtures, 'qids': len(qids), 'responses': len(transport.responses)}))
+
+def run(args):
+  '''Runs a worker per measurement mode and combines their results.'''
+  results = {}
+  for mode in ('latency', 'cpu', 'alloc'):
+    cmd = [sys.executable, __file__, 'run', '--worker', '--mode', mode,
+      '--target', args.target, '--fixtures', args.fixtures, '--repeat', str(args.repeat),
+      '--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms)] + (['--qids'] + args.qids if args.qids else [])
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+      sys.exit(proc.stderr)
+    for phase, measures in json.loads(proc.stdout.strip().split('\n')[-1]).items():
+      results.setdefault(phase, {}).update(measures)
+  print(json.dumps({'target': args.target, 'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms, **results}, indent=2))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Search benchmarks over recorded upstream responses')
+  parser.add_argument('command', choices=('run', 'record'), nargs='?', default='run')
+  parser.add_argument('--target', help='Client searched', choices=TARGETS, default='search')
+  parser.add_argument('--qids', help='QIDs searched, defaults to the recorded corpus', nargs='+')
+  parser.add_argument('--fixtures', help='Recorded responses', default=FIXTURES)
+  parser.add_argument('--latency-ms', help='Latency injected per upstream request', type=float, default=50)
+  parser.add_argument('--jitter-ms', help='Random extra latency per upstream request, up to', type=float, default=0)
+  parser.add_argument('--repeat', help='Warm passes over the corpus', type=int, default=5)
+  parser.add_argument('--synthetic', help='Record from generated upstream responses instead of the live upstreams', action='store_true')
+  parser.add_argument('--worker', help=argparse.SUPPRESS, action='store_true')
+  parser.add_argument('--mode', help=argparse.SUPPRESS, choices=('latency', 'cpu', 'alloc'), default='latency')
+  args = parser.parse_args()
+
+  if args.command == 'record':
+    record(args)
+  elif args.worker:
+    worker(args)
+  else:
+    run(args)
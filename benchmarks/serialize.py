@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares per-request serialization cost of a /search/{qid}/ page through FastAPI's
+generic JSON encoding with the pre-encoded fast path (SEARCH_FAST_JSON) and a page
+cache hit.  The response model validation the generic path also pays is not included.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os, sys
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'src'))
+
+import argparse
+import json
+from time import perf_counter
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from search.pages import PageCache, encode_docs, project_docs
+
+# ResultsDoc and Depicts fields of the API, in model order
+DOC_FIELDS = ['seq', 'id', 'title', 'description', 'url', 'depicts', 'tags', 'digital_representation_of', 'thumbnail', 'owner', 'rights', 'weight']
+DEPICTS_FIELDS = ['id', 'label', 'prominent']
+
+def make_docs(count):
+  return [{
+    'seq': i,
+    'id': f'wc:Example_{i}.jpg',
+    'title': f'Example image {i} – «ünïcödé»',
+    'description': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit ' * 3,
+    'url': f'https://commons.wikimedia.org/wiki/File:Example_{i}.jpg',
+    'thumbnail': f'https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/Example_{i}.jpg/240px-Example_{i}.jpg',
+    'depicts': [{'id': f'Q{j}', 'label': f'label {j}', 'prominent': j == 0} for j in range(6)],
+    'digital_representation_of': {'id': 'Q12418', 'label': 'Mona Lisa', 'prominent': True},
+    'owner': 'Leonardo da Vinci',
+    'rights': 'https://creativecommons.org/publicdomain/mark/1.0/',
+    'weight': 3,
+    'pageid': str(1000 + i)
+  } for i in range(count)]
+
+def timeit(fn, repeat):
+  start = perf_counter()
+  for _ in range(repeat):
+    fn()
+  return round((perf_counter() - start) / repeat * 1e6, 1)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Search response serialization benchmark')
+  parser.add_argument('--docs', help='Docs per page', type=int, default=10)
+  parser.add_argument('--repeat', help='Iterations per measurement', type=int, default=500)
+  args = parser.parse_args()
+
+  resp = {'total': 1000, 'qtime': 0.5, 'docs': make_docs(args.docs)}
+
+  def generic_path():
+    return JSONResponse(jsonable_encoder({'total': resp['total'], 'qtime': resp['qtime'], 'docs': project_docs(resp['docs'], DOC_FIELDS, DEPICTS_FIELDS)})).body
+
+  def fast_path():
+    return b'{"total":%d,"qtime":%s,"docs":%s}' % (resp['total'], json.dumps(resp['qtime']).encode('utf-8'), encode_docs(resp['docs'], DOC_FIELDS, DEPICTS_FIELDS))
+
+  pages = PageCache()
+  pages.set('page', resp['total'], encode_docs(resp['docs'], DOC_FIELDS, DEPICTS_FIELDS))
+  def cached_path():
+    total, docs_json = pages.get('page')
+    return b'{"total":%d,"qtime":%s,"docs":%s}' % (total, json.dumps(resp['qtime']).encode('utf-8'), docs_json)
+
+  assert generic_path() == fast_path() == cached_path()
+  print(json.dumps({
+    'docs': args.docs,
+    'generic_encode_us': timeit(generic_path, args.repeat),
+    'fast_encode_us': timeit(fast_path, args.repeat),
+    'cached_page_us': timeit(cached_path, args.repeat)
+  }, indent=2))
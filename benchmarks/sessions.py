@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compares per-call latency of bare requests.get, which opens a connection per
+call, with the pooled keep-alive sessions of the upstream session registry.
+
+By default calls go to a local HTTP/1.1 server that sleeps --connect-ms on each
+new connection to stand in for the TCP and TLS handshakes of a remote upstream.
+Pass --url to measure against a real upstream instead.'''
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.WARNING)
+
+import os, sys
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(SCRIPT_DIR), 'src'))
+
+import argparse
+import json
+import statistics
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+
+import requests
+
+from upstream.sessions import SessionRegistry
+
+def serve(connect_ms):
+  '''Starts a local keep-alive server, returns (server, url, connection counter).'''
+  connections = {'count': 0}
+
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # headers and body are separate writes
+
+    def setup(self):
+      super().setup()
+      connections['count'] += 1
+      sleep(connect_ms / 1000)
+
+    def do_GET(self):
+      body = b'{"ok": true}'
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      pass
+
+  server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, f'http://127.0.0.1:{server.server_port}/', connections
+
+def bench(get, url, calls):
+  timings = []
+  for _ in range(calls):
+    start = perf_counter()
+    resp = get(url)
+    resp.content
+    timings.append(perf_counter() - start)
+  return timings
+
+def summarize(timings):
+  first = timings[0]
+  timings = sorted(timings)
+  return {
+    'calls': len(timings),
+    'mean_ms': round(statistics.mean(timings)*1000, 3),
+    'p50_ms': round(timings[len(timings)//2]*1000, 3),
+    'p95_ms': round(timings[int(len(timings)*.95)]*1000, 3),
+    'first_ms': round(first*1000, 3)
+  }
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Pooled session latency benchmark')
+  parser.add_argument('--calls', help='Calls per variant', type=int, default=50)
+  parser.add_argument('--connect-ms', help='Delay per new connection of the local server', type=float, default=20)
+  parser.add_argument('--url', help='Upstream URL to call instead of the local server')
+  args = parser.parse_args()
+
+  server, connections = None, None
+  url = args.url
+  if not url:
+    server, url, connections = serve(args.connect_ms)
+
+  host = requests.utils.urlparse(url).hostname
+  session = SessionRegistry(pool_sizes={host: 10}).session(host)
+  results = {}
+  for name, get in (('unpooled', requests.get), ('pooled', session.get)):
+    opened = connections['count'] if connections else None
+    results[name] = summarize(bench(get, url, args.calls))
+    if connections:
+      results[name]['connections'] = connections['count'] - opened
+  if server:
+    server.shutdown()
+  print(json.dumps(results, indent=2))
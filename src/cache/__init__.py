@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+from cache.backend import CacheBackend
+from cache.memory import MemoryCache
+from cache.sqlite import SqliteCache
+
+# Backend for all caches, one of 'memory' (per worker), 'sqlite' (per node) or 'redis' (shared).
+# When unset each subsystem uses its own default.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND')
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+_caches = {} # namespace -> the cache last opened for it
+
+def open_cache(namespace, default='sqlite', **kwargs):
+  '''Returns the cache for a subsystem.  kwargs (max_len, max_age_seconds, memory_bytes,
+  disk_bytes) are applied where the backend supports them.'''
+  backend = CACHE_BACKEND or default
+  if backend == 'redis':
+    from cache.redis import RedisCache
+    cache = RedisCache(namespace, url=CACHE_REDIS_URL, **kwargs)
+  elif backend == 'memory':
+    cache = MemoryCache(namespace, **kwargs)
+  else:
+    cache = SqliteCache(f'{namespace}.cache', namespace=namespace, **kwargs)
+  _caches[namespace] = cache
+  return cache
+
+def opened_caches():
+  '''The caches opened in this process by namespace.'''
+  return dict(_caches)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+from time import time as now
+
+class CacheBackend(object):
+  '''Interface of the cache backends.
+
+  A cache holds the entries of one subsystem (its namespace).  Keys are strings,
+  values any picklable object.  Entries expire max_age_seconds after they were
+  stored, or after the ttl given to set.  Backends implement get_entry, set and
+  delete; the dict-style access used by the callers is built on those.
+
+  Code running on the event loop uses the async methods (aget_entry, aset, ...).
+  Local backends answer them inline, backends making network round trips override
+  them so a slow cache server does not block the loop.'''
+
+  def __init__(self, namespace=None, max_age_seconds=1800, **kwargs):
+    self.namespace = namespace
+    self.max_age_seconds = max_age_seconds
+
+  def get_entry(self, key):
+    '''Returns (value, stored) for a live key, or None.'''
+    raise NotImplementedError
+
+  def set(self, key, value, ttl=None, stored=None):
+    '''Stores value under key.  Passing the stored time of an existing entry rewrites
+    its value without extending its age.'''
+    raise NotImplementedError
+
+  def delete(self, key):
+    raise NotImplementedError
+
+  def get_entries(self, keys):
+    '''Returns {key: (value, stored)} for the live keys.'''
+    entries = {}
+    for key in keys:
+      entry = self.get_entry(key)
+      if entry is not None:
+        entries[key] = entry
+    return entries
+
+  def set_many(self, items, ttl=None):
+    '''Stores the values of items, a dict by key.'''
+    for key, value in items.items():
+      self.set(key, value, ttl)
+
+  async def aget_entry(self, key):
+    return self.get_entry(key)
+
+  async def aget_entries(self, keys):
+    return self.get_entries(keys)
+
+  async def aget(self, key, default=None):
+    entry = await self.aget_entry(key)
+    return entry[0] if entry else default
+
+  async def aset(self, key, value, ttl=None, stored=None):
+    self.set(key, value, ttl, stored)
+
+  async def aset_many(self, items, ttl=None):
+    self.set_many(items, ttl)
+
+  async def adelete(self, key):
+    self.delete(key)
+
+  def entries(self, limit=None):
+    '''Yields live entries as (key, value, stored, expires), most recently used first, for
+    snapshots.  Backends shared across processes need no snapshot and yield nothing.'''
+    return iter(())
+
+  def load(self, entries):
+    '''Sets entries from a snapshot, skipping expired ones and keys with an entry stored
+    since.  Returns the number set.'''
+    loaded = 0
+    for key, value, stored, expires in entries:
+      if expires <= now():
+        continue
+      entry = self.get_entry(key)
+      if entry is not None and entry[1] >= stored:
+        continue
+      self.set(key, value, ttl=expires - stored, stored=stored)
+      loaded += 1
+    return loaded
+
+  def stats(self):
+    return {}
+
+  def get(self, key, default=None):
+    entry = self.get_entry(key)
+    return entry[0] if entry else default
+
+  def __getitem__(self, key):
+    entry = self.get_entry(key)
+    if entry is None:
+      raise KeyError(key)
+    return entry[0]
+
+  def __setitem__(self, key, value):
+    self.set(key, value)
+
+  def __delitem__(self, key):
+    self.delete(key)
+
+  def __contains__(self, key):
+    return self.get_entry(key) is not None
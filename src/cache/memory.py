@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import pickle
+import threading
+from collections import OrderedDict
+from time import time as now
+
+from cache.backend import CacheBackend
+
+class MemoryCache(CacheBackend):
+  '''In-process expiring LRU cache.  Values are held as is, not serialized.
+
+  Bounded by entry count (max_len) and by size (memory_bytes), where the size of
+  an entry is its pickled length, passed in by the caller or computed on set when
+  memory_bytes is given.'''
+
+  def __init__(self, namespace=None, max_len=100, max_age_seconds=1800, memory_bytes=None, **kwargs):
+    super().__init__(namespace, max_age_seconds)
+    self.max_len = max_len
+    self.memory_bytes = memory_bytes
+    self._entries = OrderedDict()
+    self._size = 0
+    self._lock = threading.RLock()
+    self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+  def get_entry(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[2] < now():
+        self._forget(key)
+        self.counters['misses'] += 1
+        return None
+      self._entries.move_to_end(key)
+      self.counters['hits'] += 1
+      return entry[0], entry[1]
+
+  def set(self, key, value, ttl=None, stored=None, size=None):
+    stored = stored if stored is not None else now()
+    expires = stored + (ttl if ttl is not None else self.max_age_seconds)
+    if size is None:
+      size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)) if self.memory_bytes else 0
+    with self._lock:
+      self._forget(key)
+      self._entries[key] = (value, stored, expires, size)
+      self._size += size
+      while len(self._entries) > 1 and (
+        (self.max_len and len(self._entries) > self.max_len) or
+        (self.memory_bytes and self._size > self.memory_bytes)):
+        _, evicted = self._entries.popitem(last=False)
+        self._size -= evicted[3]
+        self.counters['evictions'] += 1
+
+  def delete(self, key):
+    with self._lock:
+      self._forget(key)
+
+  def entries(self, limit=None):
+    with self._lock:
+      items = list(reversed(self._entries.items()))
+    count = 0
+    for key, (value, stored, expires, _) in items:
+      if limit is not None and count >= limit:
+        break
+      if expires >= now():
+        count += 1
+        yield key, value, stored, expires
+
+  def _forget(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._size -= entry[3]
+
+  def stats(self):
+    with self._lock:
+      return {'memory': {**self.counters, 'entries': len(self._entries), 'bytes': self._size, 'budget': self.memory_bytes}}
+
+  def __len__(self):
+    return len(self._entries)
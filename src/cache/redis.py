@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import asyncio
+import functools
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from time import time as now
+
+import redis
+
+from cache.backend import CacheBackend
+
+SOCKET_TIMEOUT = 0.5 # seconds, a slow cache is treated as a miss
+# threads running the (blocking) Redis calls of the async methods, shared by all namespaces
+REDIS_THREADS = int(os.environ.get('CACHE_REDIS_THREADS', 16))
+
+_executor = None
+
+def _get_executor():
+  global _executor
+  if _executor is None:
+    _executor = ThreadPoolExecutor(max_workers=REDIS_THREADS, thread_name_prefix='redis-cache')
+  return _executor
+
+class RedisCache(CacheBackend):
+  '''Cache shared by workers and nodes through a Redis server (or anything speaking
+  its protocol).  Keys are prefixed with the namespace, values are pickled together
+  with their stored time and expire through the server's TTL.  Errors talking to
+  the server are logged and treated as misses so a cache outage degrades to
+  upstream calls.  The async methods run the calls on a thread pool, keeping the
+  event loop free while waiting on the server.'''
+
+  def __init__(self, namespace, url='redis://localhost:6379/0', max_age_seconds=1800, client=None, **kwargs):
+    super().__init__(namespace, max_age_seconds)
+    self.url = url
+    self._client = client or redis.Redis.from_url(url, socket_timeout=SOCKET_TIMEOUT, socket_connect_timeout=SOCKET_TIMEOUT)
+    self.counters = {'hits': 0, 'misses': 0, 'errors': 0}
+
+  def _key(self, key):
+    return f'{self.namespace}:{key}'
+
+  def get_entry(self, key):
+    try:
+      data = self._client.get(self._key(key))
+    except redis.RedisError as exc:
+      logger.warning(f'RedisCache: get {self._key(key)} failed: {exc}')
+      self.counters['errors'] += 1
+      data = None
+    if data is None:
+      self.counters['misses'] += 1
+      return None
+    self.counters['hits'] += 1
+    stored, value = pickle.loads(data)
+    return value, stored
+
+  def get_entries(self, keys):
+    keys = list(keys)
+    if not keys:
+      return {}
+    try:
+      values = self._client.mget([self._key(key) for key in keys])
+    except redis.RedisError as exc:
+      logger.warning(f'RedisCache: mget {self.namespace} keys={len(keys)} failed: {exc}')
+      self.counters['errors'] += 1
+      values = [None] * len(keys)
+    entries = {}
+    for key, data in zip(keys, values):
+      if data is None:
+        self.counters['misses'] += 1
+        continue
+      self.counters['hits'] += 1
+      stored, value = pickle.loads(data)
+      entries[key] = (value, stored)
+    return entries
+
+  def _records(self, items, ttl=None, stored=None):
+    '''(key, pickled entry, ms to live) for items, a dict by key, None for expired ones.
+    Pickling happens in the caller's thread, so values are copied before another thread
+    writes them.'''
+    stored = stored if stored is not None else now()
+    remaining = stored + (ttl if ttl is not None else self.max_age_seconds) - now()
+    return [
+      (self._key(key), pickle.dumps((stored, value), protocol=pickle.HIGHEST_PROTOCOL) if remaining > 0 else None, int(remaining * 1000))
+      for key, value in items.items()
+    ]
+
+  def _write(self, records):
+    try:
+      pipe = self._client.pipeline(transaction=False)
+      for key, data, px in records:
+        if data is None:
+          pipe.delete(key)
+        else:
+          pipe.set(key, data, px=px)
+      pipe.execute()
+    except redis.RedisError as exc:
+      logger.warning(f'RedisCache: set {", ".join([key for key, _, _ in records][:3])} keys={len(records)} failed: {exc}')
+      self.counters['errors'] += 1
+
+  def set(self, key, value, ttl=None, stored=None):
+    self._write(self._records({key: value}, ttl, stored))
+
+  def set_many(self, items, ttl=None):
+    if items:
+      self._write(self._records(items, ttl))
+
+  def delete(self, key):
+    try:
+      self._client.delete(self._key(key))
+    except redis.RedisError as exc:
+      logger.warning(f'RedisCache: delete {self._key(key)} failed: {exc}')
+      self.counters['errors'] += 1
+
+  async def _run(self, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), functools.partial(fn, *args))
+
+  async def aget_entry(self, key):
+    return await self._run(self.get_entry, key)
+
+  async def aget_entries(self, keys):
+    return await self._run(self.get_entries, list(keys))
+
+  async def aset(self, key, value, ttl=None, stored=None):
+    await self._run(self._write, self._records({key: value}, ttl, stored))
+
+  async def aset_many(self, items, ttl=None):
+    if items:
+      await self._run(self._write, self._records(items, ttl))
+
+  async def adelete(self, key):
+    await self._run(self.delete, key)
+
+  def stats(self):
+    return {'redis': self.counters}
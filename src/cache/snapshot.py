@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import asyncio
+import gzip
+import os
+import pickle
+import traceback
+from time import time as now
+
+SNAPSHOT_VERSION = 1
+# caches worth carrying over to a new process: search results, labels and GitHub repo prefixes
+SNAPSHOT_NAMESPACES = ('commons', 'commons-metadata', 'jstor', 'jstor-stages', 'labels', 'mdrender-gh-prefixes')
+SNAPSHOT_ENTRIES = 2000   # most recently used entries per namespace
+SNAPSHOT_INTERVAL = 600   # seconds between snapshots
+SNAPSHOT_LOAD_TIMEOUT = 5 # seconds startup waits for the snapshot, loading continues in the background after
+
+class LocalStore(object):
+
+  def __init__(self, path):
+    self.path = path
+
+  def read(self):
+    if not os.path.exists(self.path):
+      return None
+    with open(self.path, 'rb') as fp:
+      return fp.read()
+
+  def write(self, data):
+    tmp = f'{self.path}.tmp'
+    with open(tmp, 'wb') as fp:
+      fp.write(data)
+    os.replace(tmp, self.path)
+
+class BucketStore(object):
+  '''Snapshot object in Google Cloud Storage (gs://bucket/key) or S3 (s3://bucket/key),
+  through the mdrender bucket clients.'''
+
+  def __init__(self, location):
+    scheme, path = location.split('://', 1)
+    bucket, self.key = path.split('/', 1)
+    if scheme == 'gs':
+      from mdrender import gcs
+      self.bucket = gcs.Bucket(bucket)
+      self._read = lambda: self.bucket.get_bytes(self.key)
+    else:
+      from mdrender import s3
+      self.bucket = s3.Bucket(bucket)
+      self._read = lambda: self.bucket.get(self.key)
+
+  def read(self):
+    return self._read()
+
+  def write(self, data):
+    self.bucket[self.key] = data
+
+def open_store(location):
+  return BucketStore(location) if location.startswith(('gs://', 's3://')) else LocalStore(location)
+
+def _copy(value):
+  '''Copy of the dicts and lists of a cached value.  Cached docs are updated in place
+  (metadata, labels), so a copy only of the top-level container would still share them.'''
+  if isinstance(value, dict):
+    return dict([(key, _copy(item)) for key, item in value.items()])
+  if isinstance(value, list):
+    return [_copy(item) for item in value]
+  return value
+
+def collect(caches, max_entries=SNAPSHOT_ENTRIES):
+  '''Copies of the most recently used entries of caches, a dict by namespace.  Called on
+  the thread that updates the caches (the event loop), so the copies can be encoded
+  elsewhere while the entries change.'''
+  return dict([(namespace, [(key, _copy(value), stored, expires) for key, value, stored, expires in cache.entries(max_entries)])
+    for namespace, cache in caches.items()])
+
+def encode(namespaces):
+  '''Compressed snapshot of collected entries.'''
+  return gzip.compress(pickle.dumps({
+    'version': SNAPSHOT_VERSION,
+    'created': now(),
+    'namespaces': namespaces
+  }, protocol=pickle.HIGHEST_PROTOCOL))
+
+def dump(caches, max_entries=SNAPSHOT_ENTRIES):
+  '''Compressed snapshot of the most recently used entries of caches, a dict by namespace.'''
+  return encode(collect(caches, max_entries))
+
+def decode(data):
+  '''Entries of a snapshot by namespace, None if the snapshot is of another version.'''
+  snapshot = pickle.loads(gzip.decompress(data))
+  if snapshot.get('version') != SNAPSHOT_VERSION:
+    logger.warning(f'snapshot: ignoring version {snapshot.get("version")}, expected {SNAPSHOT_VERSION}')
+    return None
+  return snapshot['namespaces']
+
+def load(data, caches):
+  '''Loads a snapshot into caches, a dict by namespace.  Returns the entries loaded per
+  namespace, None if the snapshot is of another version.'''
+  namespaces = decode(data)
+  if namespaces is None:
+    return None
+  return dict([(namespace, caches[namespace].load(entries)) for namespace, entries in namespaces.items() if namespace in caches])
+
+class Snapshotter(object):
+  '''Warm starts new processes from a snapshot of the hottest cache entries.
+
+  On start the snapshot at location (a local path, gs://bucket/key or s3://bucket/key)
+  is loaded into the opened caches of the snapshot namespaces, off the event loop, and
+  then rewritten every interval seconds (never if interval is 0).  Entries are copied
+  on the event loop, then encoded and written off it.  Snapshots are pickles, so the
+  location must only be writable by the service.'''
+
+  def __init__(self, location, namespaces=SNAPSHOT_NAMESPACES, max_entries=SNAPSHOT_ENTRIES, interval=SNAPSHOT_INTERVAL, **kwargs):
+    self.location = location
+    self.namespaces = namespaces
+    self.max_entries = max_entries
+    self.interval = interval
+    self._store = None
+    self._tasks = set()
+    self.counters = {'loads': 0, 'loaded': 0, 'writes': 0, 'bytes': 0, 'errors': 0}
+
+  def caches(self):
+    from cache import opened_caches
+    return dict([(namespace, cache) for namespace, cache in opened_caches().items() if namespace in self.namespaces])
+
+  def store(self):
+    if self._store is None:
+      self._store = open_store(self.location)
+    return self._store
+
+  def read(self):
+    '''Loads the snapshot, if there is one, into the caches.'''
+    start = now()
+    data = self.store().read()
+    if not data:
+      logger.info(f'snapshot: none at {self.location}')
+      return
+    loaded = load(data, self.caches())
+    if loaded is not None:
+      self.counters['loads'] += 1
+      self.counters['loaded'] += sum(loaded.values())
+    logger.info(f'snapshot: loaded {loaded} from {self.location} bytes={len(data)} elapsed={round(now()-start, 2)}')
+
+  def write(self, namespaces=None):
+    '''Writes a snapshot of collected entries, by default of the caches' current entries.'''
+    start = now()
+    if namespaces is None:
+      namespaces = collect(self.caches(), self.max_entries)
+    data = encode(namespaces)
+    self.store().write(data)
+    self.counters['writes'] += 1
+    self.counters['bytes'] = len(data)
+    logger.info(f'snapshot: wrote {list(namespaces)} to {self.location} bytes={len(data)} elapsed={round(now()-start, 2)}')
+
+  async def _write(self):
+    await self._in_thread(self.write, collect(self.caches(), self.max_entries))
+
+  async def _in_thread(self, fn, *args):
+    try:
+      await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    except Exception as exc:
+      self.counters['errors'] += 1
+      logger.warning(f'snapshot: {fn.__name__} {self.location} failed: {exc}')
+      logger.info(traceback.format_exc())
+
+  def _background(self, aw):
+    task = asyncio.ensure_future(aw)
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+    return task
+
+  async def start(self, timeout=SNAPSHOT_LOAD_TIMEOUT):
+    '''Loads the snapshot, waiting up to timeout seconds, and starts the periodic writes.'''
+    loading = self._background(self._in_thread(self.read))
+    try:
+      await asyncio.wait_for(asyncio.shield(loading), timeout)
+    except asyncio.TimeoutError:
+      logger.warning(f'snapshot: still loading after {timeout}s, serving meanwhile')
+    if self.interval:
+      self._background(self._periodic())
+
+  async def _periodic(self):
+    while True:
+      await asyncio.sleep(self.interval)
+      await self._write()
+
+  async def stop(self):
+    '''Stops the periodic writes, writing a last snapshot if they were enabled.'''
+    for task in list(self._tasks):
+      task.cancel()
+    if self.interval:
+      await self._write()
+
+  def stats(self):
+    return {**self.counters, 'location': self.location}
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import asyncio
+import functools
+import os
+import pickle
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time as now
+
+from cache.backend import CacheBackend
+from cache.memory import MemoryCache
+
+PURGE_INTERVAL = 500 # writes between purges of expired rows
+PURGE_FRACTION = 0.1 # or purge once this fraction of disk_bytes has been written
+
+_executor = None
+
+def _get_executor():
+  '''The thread writing the disk tiers of the async methods, shared by all namespaces.
+  SQLite serializes writers anyway, and one thread keeps the writes in order.'''
+  global _executor
+  if _executor is None:
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-cache')
+  return _executor
+
+class SqliteCache(CacheBackend):
+  '''Persistent expiring cache backed by a SQLite database in WAL mode.
+
+  Writes upsert only the changed key.  Nothing is loaded on startup; entries are
+  read from disk on first access and kept in an in-memory LRU (a MemoryCache).
+
+  Both tiers can be bounded by entry count (max_len) and by size (memory_bytes,
+  disk_bytes), where the size of an entry is estimated by its pickled length.
+  The file is per node, shared by the workers running there.
+
+  The async methods answer from the memory tier inline and leave the disk reads and
+  writes, and any purge a write triggers, to a background thread, as the file may be
+  locked by another worker for up to the connection timeout.'''
+
+  def __init__(self, path, max_len=100, max_age_seconds=1800, memory_bytes=None, disk_bytes=None, namespace=None, **kwargs):
+    super().__init__(namespace, max_age_seconds)
+    self.path = path
+    self.max_len = max_len
+    self.disk_bytes = disk_bytes
+    self._memory = MemoryCache(namespace, max_len=max_len, max_age_seconds=max_age_seconds, memory_bytes=memory_bytes)
+    self._lock = threading.RLock()
+    self._writes = 0
+    self._written = 0 # bytes written since the last purge
+    self._conn = self._connect()
+    self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+  def _connect(self):
+    try:
+      conn = self._open()
+    except sqlite3.DatabaseError:
+      # not a SQLite database (e.g. a dill dump from an earlier version), start over
+      logger.warning(f'SqliteCache: replacing unreadable cache file {self.path}')
+      os.remove(self.path)
+      conn = self._open()
+    return conn
+
+  def _open(self):
+    conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, stored REAL, expires REAL)')
+    conn.execute('DELETE FROM cache WHERE expires < ?', (now(),))
+    return conn
+
+  def _read(self, keys):
+    '''{key: (value, stored)} of the live keys on disk, added to the memory tier.'''
+    entries = {}
+    with self._lock:
+      for key in keys:
+        row = self._conn.execute('SELECT value, stored, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[2] < now():
+          self.counters['misses'] += 1
+          continue
+        self.counters['hits'] += 1
+        value = pickle.loads(row[0])
+        self._memory.set(key, value, ttl=row[2]-row[1], stored=row[1], size=len(row[0]))
+        entries[key] = (value, row[1])
+    return entries
+
+  def get_entry(self, key):
+    '''Returns (value, stored) for a live key, or None.'''
+    return self.get_entries([key]).get(key)
+
+  def get_entries(self, keys):
+    keys = list(keys)
+    entries = self._memory.get_entries(keys)
+    missing = [key for key in keys if key not in entries]
+    return {**entries, **self._read(missing)} if missing else entries
+
+  def _records(self, items, ttl=None, stored=None):
+    '''(key, value, pickled value, stored, expires) for items, a dict by key.  Pickling
+    happens in the caller's thread, so values are copied before another thread writes them.'''
+    stored = stored if stored is not None else now()
+    expires = stored + (ttl if ttl is not None else self.max_age_seconds)
+    return [(key, value, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), stored, expires) for key, value in items.items()]
+
+  def _remember(self, records):
+    for key, value, data, stored, expires in records:
+      self._memory.set(key, value, ttl=expires-stored, stored=stored, size=len(data))
+
+  def _write(self, records):
+    with self._lock:
+      self._conn.executemany('INSERT OR REPLACE INTO cache (key, value, stored, expires) VALUES (?, ?, ?, ?)',
+        [(key, data, stored, expires) for key, _, data, stored, expires in records])
+      self._writes += len(records)
+      self._written += sum([len(data) for _, _, data, _, _ in records])
+      if self._writes >= PURGE_INTERVAL or (self.disk_bytes and self._written > self.disk_bytes * PURGE_FRACTION):
+        self.purge()
+
+  def _store(self, records):
+    with self._lock:
+      self._remember(records)
+      self._write(records)
+
+  def set(self, key, value, ttl=None, stored=None):
+    self._store(self._records({key: value}, ttl, stored))
+
+  def set_many(self, items, ttl=None):
+    if items:
+      self._store(self._records(items, ttl))
+
+  def delete(self, key):
+    with self._lock:
+      self._memory.delete(key)
+      self._delete(key)
+
+  def _delete(self, key):
+    with self._lock:
+      self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+  async def _run(self, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), functools.partial(fn, *args))
+
+  async def aget_entry(self, key):
+    return (await self.aget_entries([key])).get(key)
+
+  async def aget_entries(self, keys):
+    keys = list(keys)
+    entries = self._memory.get_entries(keys)
+    missing = [key for key in keys if key not in entries]
+    return {**entries, **(await self._run(self._read, missing))} if missing else entries
+
+  async def aset(self, key, value, ttl=None, stored=None):
+    records = self._records({key: value}, ttl, stored)
+    self._remember(records)
+    await self._run(self._write, records)
+
+  async def aset_many(self, items, ttl=None):
+    if items:
+      records = self._records(items, ttl)
+      self._remember(records)
+      await self._run(self._write, records)
+
+  async def adelete(self, key):
+    self._memory.delete(key)
+    await self._run(self._delete, key)
+
+  def entries(self, limit=None):
+    '''Entries of the memory tier, most recently used first, then the most recently stored
+    of the rest.'''
+    seen = set()
+    for key, value, stored, expires in self._memory.entries(limit):
+      seen.add(key)
+      yield key, value, stored, expires
+    if limit is not None and len(seen) >= limit:
+      return
+    with self._lock:
+      rows = self._conn.execute('SELECT key, value, stored, expires FROM cache WHERE expires >= ? ORDER BY stored DESC LIMIT ?',
+        (now(), -1 if limit is None else limit)).fetchall()
+    for key, data, stored, expires in rows:
+      if key in seen:
+        continue
+      if limit is not None and len(seen) >= limit:
+        break
+      seen.add(key)
+      yield key, pickle.loads(data), stored, expires
+
+  def purge(self):
+    '''Removes expired rows, then the oldest rows beyond max_len and disk_bytes.'''
+    with self._lock:
+      self._writes = 0
+      self._written = 0
+      self._conn.execute('DELETE FROM cache WHERE expires < ?', (now(),))
+      evicted = 0
+      if self.max_len:
+        evicted += self._conn.execute('DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY stored DESC LIMIT ?)', (self.max_len,)).rowcount
+      if self.disk_bytes:
+        evicted += self._conn.execute('''
+          DELETE FROM cache WHERE key IN (
+            SELECT key FROM (SELECT key, SUM(length(value)) OVER (ORDER BY stored DESC) AS total FROM cache)
+            WHERE total > ?)''', (self.disk_bytes,)).rowcount
+      self.counters['evictions'] += evicted
+
+  def stats(self):
+    '''Per-tier hit/miss/eviction counters with current sizes and budgets.'''
+    with self._lock:
+      entries, size = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(length(value)), 0) FROM cache').fetchone()
+      return {
+        **self._memory.stats(),
+        'disk': {**self.counters, 'entries': entries, 'bytes': size, 'budget': self.disk_bytes}
+      }
+
+  def __len__(self):
+    with self._lock:
+      return self._conn.execute('SELECT COUNT(*) FROM cache WHERE expires >= ?', (now(),)).fetchone()[0]
@@ -19,7 +19,7 @@ from urllib.parse import urlparse
 
 import yaml
 
-import requests
+from upstream import sync
 logging.getLogger('requests').setLevel(logging.INFO)
 
 with open(f'{SCRIPT_DIR}/creds.yaml', 'r') as fp:
@@ -49,7 +49,7 @@ def sendinblue(**kwargs):
         'htmlContent': kwargs['message']
     }
     logger.debug(json.dumps(data, indent=2))
-    resp = requests.post(
+    resp = sync.post(
         'https://api.sendinblue.com/v3/smtp/email',
         headers = {
             'Content-type': 'application/json; charset=utf-8', 
@@ -13,7 +13,7 @@ import json
 import uuid
 from time import time as now
 
-import requests
+from upstream import sync
 logging.getLogger('requests').setLevel(logging.INFO)
 
 from PIL import Image
@@ -50,10 +50,9 @@ class ImageInfo(object):
 
   def __call__(self, url, **kwargs):
     if url.endswith('/info.json'):
-        resp = requests.get(url,
+        resp = sync.get(url,
             cookies={'UUID': str(uuid.uuid4())},
             headers={
-                'User-Agent': 'Labs client',
                 'Content-Type': 'application/x-www-form-urlencoded',
                 'Accept': 'application/json'
             }
@@ -63,7 +62,7 @@ class ImageInfo(object):
         info = {}
         start = now()
         path = url.replace('/','%2F')
-        resp = requests.get(url, headers={'User-agent': 'IIIF service'})
+        resp = sync.get(url, headers={'User-agent': 'IIIF service'})
         if resp.status_code == 200:
             with open (path, 'wb') as fp:
                 fp.write(resp.content)
@@ -8,26 +8,31 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 import os, sys, json, yaml, re
+from time import time as now
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(SCRIPT_DIR)
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist, constr
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
 from fastapi.middleware.cors import CORSMiddleware
 
 from starlette.responses import RedirectResponse
 
-import requests
+from upstream import sync
 logging.getLogger('requests').setLevel(logging.WARNING)
 
-from search import SearchClient
+from search import BATCH_MAX_QIDS, LABELLED_FIELDS, LANGUAGE_PATTERN, QID_PATTERN, SearchClient
 search_client = SearchClient()
+from search.entities import entities
+from search.labels import labels
+
+from cache.snapshot import Snapshotter
 
 from mdrender import get_file, get_html, dir_list
 from image_info import ImageInfo
@@ -46,6 +51,17 @@ app.mount('/static', StaticFiles(directory='static'), name='static')
 
 CONFIG = yaml.load(open(f'{SCRIPT_DIR}/creds.yaml', 'r').read(), Loader=yaml.FullLoader)
 
+SEARCH_FAST_JSON = os.environ.get('SEARCH_FAST_JSON', 'true').lower() in ('1', 'true', 'yes')
+# queue the QIDs referenced by rendered essays for background search prefetch, opt-in as it
+# sends upstream queries for QIDs nobody may search
+SEARCH_PREFETCH = os.environ.get('SEARCH_PREFETCH', 'false').lower() in ('1', 'true', 'yes')
+# default latency budget for /search/{qid}/ in ms, none when unset
+SEARCH_BUDGET_MS = float(os.environ['SEARCH_BUDGET_MS']) if os.environ.get('SEARCH_BUDGET_MS') else None
+# cache snapshot warm start: a local path, gs://bucket/key or s3://bucket/key, written every
+# CACHE_SNAPSHOT_INTERVAL seconds (0 to only read it)
+CACHE_SNAPSHOT = os.environ.get('CACHE_SNAPSHOT')
+snapshotter = Snapshotter(CACHE_SNAPSHOT, interval=int(os.environ.get('CACHE_SNAPSHOT_INTERVAL', 600))) if CACHE_SNAPSHOT else None
+
 default_prefix = 'juncture-digital/content'
 # default_prefix = 'a3b5125'
 
@@ -76,35 +92,181 @@ class ResultsDoc(BaseModel):
   rights: Optional[str] = None
   weight: Optional[int] = 1
 
+# named ResultsDoc subsets for the search fields parameter
+RESULTS_DOC_FIELDS = {
+  'grid': ['id', 'thumbnail', 'title', 'rights']
+}
+
+def results_doc_fields(fields):
+  '''ResultsDoc fields selected by a comma-separated list of field names and named subsets,
+  in model order.  All fields when fields is empty.'''
+  if not fields:
+    return list(ResultsDoc.__fields__)
+  selected = set()
+  for name in [name.strip() for name in fields.split(',') if name.strip()]:
+    if name in RESULTS_DOC_FIELDS:
+      selected.update(RESULTS_DOC_FIELDS[name])
+    elif name in ResultsDoc.__fields__:
+      selected.add(name)
+    else:
+      raise HTTPException(status_code=400, detail=f'Unknown field: {name}')
+  return [fld for fld in ResultsDoc.__fields__ if fld in selected]
+
+def checked_language(language):
+  '''language if it is a well-formed language tag, labels are queried with it.'''
+  if not re.match(LANGUAGE_PATTERN, language or ''):
+    raise HTTPException(status_code=400, detail=f'Invalid language: {language}')
+  return language
+
 class SearchResults(BaseModel):
   total: int
   qtime: Optional[float] = None
+  stale: Optional[bool] = None # served from a cache entry past its soft TTL while it is refreshed
+  pending: Optional[List[str]] = None # sources that missed the latency budget, their results are cached when they complete
   docs: List[ResultsDoc] = []
+
+class SearchBatchRequest(BaseModel):
+  qids: conlist(constr(regex=QID_PATTERN), min_items=1, max_items=BATCH_MAX_QIDS)
+  source: Optional[str] = 'commons,jstor'
+  offset: Optional[int] = 0
+  limit: Optional[int] = 10
+  language: Optional[constr(regex=LANGUAGE_PATTERN)] = 'en'
+  refresh: Optional[bool] = False
+
+class SearchBatchResults(BaseModel):
+  qtime: Optional[float] = None
+  results: Dict[str, SearchResults] = {}
+
+class EntityMatch(BaseModel):
+  id: str
+  label: str
+  match: str # the label or alias that matched the query
+
+class EntityLookupResults(BaseModel):
+  qtime: Optional[float] = None
+  results: List[EntityMatch] = []
+
+class EntityLabels(BaseModel):
+  qtime: Optional[float] = None
+  labels: Dict[str, str] = {}
   
+@app.on_event('startup')
+async def load_cache_snapshot():
+  if snapshotter:
+    await snapshotter.start()
+
+@app.on_event('shutdown')
+async def write_cache_snapshot():
+  if snapshotter:
+    await snapshotter.stop()
+
 @app.get('/docs/')
 @app.get('/')
 def main():
   return RedirectResponse(url='/docs')
 
 @app.get('/search/{qid}/', response_model=SearchResults, response_model_exclude_unset=True)
-def search(
+async def search(
     qid: str,
     source: Optional[str] = 'commons,jstor',
     offset: Optional[int] = 0,
     limit: Optional[int] = 10,
     language: Optional[str] = 'en',
     refresh: Optional[bool] = False,
+    fields: Optional[str] = None,
+    budget_ms: Optional[float] = SEARCH_BUDGET_MS,
   ):
-  
-  logger.debug(f'search: qid={qid} source={source} limit={limit} language={language}')
-  return search_client.search(
+  '''fields limits the docs to a comma-separated list of ResultsDoc fields and named
+  subsets (grid: id, thumbnail, title, rights).  Depicts labels are only resolved when
+  depicts or digital_representation_of are included.  With budget_ms, sources that have
+  not returned within the budget are left out and listed in pending.'''
+  logger.debug(f'search: qid={qid} source={source} limit={limit} language={language} fields={fields}')
+  doc_fields = results_doc_fields(fields)
+  language = checked_language(language)
+  if SEARCH_FAST_JSON:
+    # pre-encoded response, bypasses response model validation (the model still documents the schema)
+    return Response(
+      content=await search_client.search_json(
+        qid=qid,
+        doc_fields=doc_fields,
+        depicts_fields=list(Depicts.__fields__),
+        source=source,
+        offset=offset,
+        limit=limit,
+        language=language,
+        refresh=refresh,
+        budget_ms=budget_ms
+      ),
+      media_type='application/json')
+  results = await search_client.search(
     qid=qid,
     source=source,
     offset=offset,
     limit=limit,
     language=language,
-    refresh=refresh
+    refresh=refresh,
+    label=any(fld in doc_fields for fld in LABELLED_FIELDS),
+    budget_ms=budget_ms
   )
+  if fields:
+    return Response(
+      content=SearchResults(**results).json(include={'total': True, 'qtime': True, 'stale': True, 'pending': True, 'docs': {'__all__': set(doc_fields)}}, exclude_unset=True),
+      media_type='application/json')
+  return results
+
+@app.post('/search/batch/', response_model=SearchBatchResults, response_model_exclude_unset=True)
+@app.post('/search/batch', response_model=SearchBatchResults, response_model_exclude_unset=True)
+async def search_batch(batch: SearchBatchRequest):
+  logger.debug(f'search_batch: qids={len(batch.qids)} source={batch.source} limit={batch.limit} language={batch.language}')
+  return await search_client.search_batch(**batch.dict())
+
+@app.get('/search/{qid}/stream/')
+async def search_stream(
+    qid: str,
+    source: Optional[str] = 'commons,jstor',
+    offset: Optional[int] = 0,
+    limit: Optional[int] = 10,
+    language: Optional[str] = 'en',
+    refresh: Optional[bool] = False,
+    fields: Optional[str] = None,
+  ):
+  '''Newline-delimited JSON stream of search results, one message per source as it completes
+  followed by a final "done" message with the merged page.  fields limits the docs as for
+  /search/{qid}/.'''
+  logger.debug(f'search_stream: qid={qid} source={source} limit={limit} language={language} fields={fields}')
+  doc_fields = results_doc_fields(fields)
+  language = checked_language(language)
+  async def messages():
+    async for message in search_client.stream(qid=qid, doc_fields=doc_fields, depicts_fields=list(Depicts.__fields__), source=source, offset=offset, limit=limit, language=language, refresh=refresh):
+      yield json.dumps(message) + '\n'
+  return StreamingResponse(messages(), media_type='application/x-ndjson')
+
+@app.get('/entities/lookup/', response_model=EntityLookupResults)
+@app.get('/entities/lookup', response_model=EntityLookupResults)
+async def entities_lookup(q: str, language: Optional[str] = 'en', limit: Optional[int] = 10):
+  '''Entities with a label or alias starting with q, for typeahead.  Answered from the entity
+  label index and the labels resolved so far, without calling Wikidata.'''
+  start = now()
+  results = entities.lookup(q, language, limit)
+  return {'qtime': round(now()-start, 4), 'results': results}
+
+@app.get('/entities/labels/', response_model=EntityLabels)
+@app.get('/entities/labels', response_model=EntityLabels)
+async def entities_labels(qids: str, language: Optional[str] = 'en', local: Optional[bool] = False):
+  '''Labels of comma-separated QIDs.  Labels missing from the cache and the entity label index
+  are queried from Wikidata unless local is true.'''
+  start = now()
+  qids = [qid.strip() for qid in qids.split(',') if qid.strip()]
+  invalid = [qid for qid in qids if not re.match(QID_PATTERN, qid)]
+  if invalid:
+    raise HTTPException(status_code=400, detail=f'Invalid QIDs: {", ".join(invalid[:5])}')
+  language = checked_language(language)
+  found = entities.labels(qids, language) if local else await labels.get_labels(qids, language)
+  return {'qtime': round(now()-start, 4), 'labels': dict([(qid, label) for qid, label in found.items() if label])}
+
+@app.get('/stats/')
+async def stats():
+  return {**search_client.stats(), 'snapshot': snapshotter.stats() if snapshotter else None}
 
 @app.get('/image-info/')
 def image_info(url: str):
@@ -141,7 +303,8 @@ async def html(
     inline=inline,
     env=ENV,
     host=request.client.host,
-    ghp=ghp
+    ghp=ghp,
+    on_entities=search_client.prefetch if SEARCH_PREFETCH else None
   )
   if html is None:
     raise HTTPException(status_code=404, detail='Not found')
@@ -168,7 +331,8 @@ async def markdown_to_html(
     base_url=base_url, 
     inline=inline,
     env=ENV,
-    host=request.client.host
+    host=request.client.host,
+    on_entities=search_client.prefetch if SEARCH_PREFETCH else None
   )
   if html is None:
     raise HTTPException(status_code=404, detail='Not found')
@@ -278,7 +442,7 @@ async def gh_token(request: Request, code: Optional[str] = None, hostname: Optio
     if hostname in ('127.0.0.1','localhost') or hostname.startswith('192.168.'):
       token = CONFIG['gh_auth_token']
     elif hostname in CONFIG['gh_secrets']:
-      resp = requests.post(
+      resp = sync.post(
         'https://github.com/login/oauth/access_token',
         headers={'Accept': 'application/json'},
         data={
@@ -27,20 +27,23 @@ import markdown
 from mdrender.gh import has_gh_repo_prefix, get_gh_file, gh_dirlist, get_default_branch
 from mdrender import gcs
 from mdrender import s3
+from cache import open_cache
 
 STORE = 'gc' if 'K_CONFIGURATION' in os.environ else 'aws'
 
-import requests
+from upstream import sync
 logging.getLogger('requests').setLevel(logging.WARNING)
 
-css_cache = {}
+css_cache = open_cache('mdrender-css', default='memory', max_len=500, max_age_seconds=86400)
 def fetch_css(url, refresh=False):
   logger.debug(f'fetch_css: url={url} refresh={refresh}')
-  if refresh or url not in css_cache:
-    resp = requests.get(url)
+  css = None if refresh else css_cache.get(url)
+  if css is None:
+    resp = sync.get(url)
     if resp.status_code == 200:
-      css_cache[url] = resp.text
-  return css_cache.get(url)
+      css = resp.text
+      css_cache[url] = css
+  return css
 
 def convert_urls(soup, md_source, prefix, ref, base_url, ghp=False):
   logger.debug(f'convert_urls: prefix={prefix} ref={ref} base_url={base_url} ghp={ghp}')
@@ -159,7 +162,7 @@ def source_path(path, prefix):
 
 def load_remote(url):
   markdown = ''
-  resp = requests.get(url)
+  resp = sync.get(url)
   if resp.status_code == 200:
     markdown = resp.text
   logger.debug(f'load_remote: url={url} status={resp.status_code} markdown_size={len(markdown)}')
@@ -190,6 +193,7 @@ def find_qids(text):
   return re.findall(r'\b(Q[0-9]+)\b', text) if text else []
 
 def set_entities(soup):
+  '''Tags elements with the QIDs they reference, returns all QIDs referenced in the document.'''
   for p in soup.find_all('p'):
     qids = find_qids(p.string)
     if qids:
@@ -225,6 +229,7 @@ def set_entities(soup):
   if 'entities' in soup.body.attrs:
     del soup.body.attrs['entities']
   '''
+  return list(dict.fromkeys([qid for el in soup.find_all(attrs={'entities': True}) for qid in el.attrs['entities'].split()]))
 
 def _config_tabs(soup):
   for el in soup.find_all('section', class_='tabs'):
@@ -318,7 +323,7 @@ def get_default_footer():
     'html5lib').find('ve-footer')
   return _default_footer
   
-def to_html(md_source, prefix, ref, base_url, env='PROD', host=None, inline=False, ghp=False, **kwargs):
+def to_html(md_source, prefix, ref, base_url, env='PROD', host=None, inline=False, ghp=False, on_entities=None, **kwargs):
   logger.info(f'to_html: prefix={prefix} path={md_source.path} base_url={base_url} env={env} host={host} inline={inline}')
   
   def replace_empty_headings(match):
@@ -390,7 +395,12 @@ def to_html(md_source, prefix, ref, base_url, env='PROD', host=None, inline=Fals
 
   if footer: main.append(footer)
 
-  set_entities(soup)
+  qids = set_entities(soup)
+  if on_entities and qids:
+    try:
+      on_entities(qids)
+    except Exception as exc:
+      logger.warning(f'to_html: on_entities failed: {exc}')
 
   css = ''
   api_static_root_js = f'http://{host}:8000/static' if env == 'DEV' else 'https://api.juncture-digital.org/static'
@@ -22,6 +22,7 @@ DEFAULT_CREDS_PATH = os.path.join(BASEDIR, 'gcreds.json')
 
 from google.oauth2 import service_account
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
 
 class Bucket(object):
 
@@ -60,6 +61,13 @@ class Bucket(object):
         except KeyError:
             return default
 
+    def get_bytes(self, key, default=None):
+        '''Object content as bytes, where get decodes it as text.'''
+        try:
+            return self.bucket.blob(key).download_as_bytes()
+        except NotFound:
+            return default
+
     def __delitem__(self, key):
         blob = self.bucket.blob(key)
         if blob:
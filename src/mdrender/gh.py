@@ -12,9 +12,11 @@ import yaml
 from time import time as now
 from collections import namedtuple
 
-import requests
+from upstream import sync
 logging.getLogger('requests').setLevel(logging.INFO)
 
+from cache import open_cache
+
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 CONFIG = yaml.load(open(f'{SCRIPT_DIR}/creds.yaml', 'r').read(), Loader=yaml.FullLoader)
 
@@ -24,10 +26,8 @@ GH_JSTOR_LABS_TOKEN = CONFIG['GH_JSTOR_LABS_TOKEN']
 def _get_gh_file_by_url(url):
     logger.debug(f'get_gh_file_by_url {url} {GH_ACCESS_TOKEN}')
     content = sha = None
-    resp = requests.get(url, headers={
-        'Authorization': f'Token {GH_ACCESS_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
+    resp = sync.get(url, headers={
+        'Authorization': f'Token {GH_ACCESS_TOKEN}'
     })
     logger.debug(f'_get_gh_file_by_url {url} {resp.status_code}')
     if resp.status_code == 200:
@@ -55,7 +55,7 @@ def put_gh_file(acct, repo, target, contents, sha, token, ref=None):
     }
     if sha:
         payload['sha'] = sha
-    resp = requests.put(
+    resp = sync.put(
         gh_content_url,
         headers={'Authorization': f'Token {token}'},
         json=payload
@@ -70,15 +70,14 @@ def gh_repo_info(acct, repo):
     start = now()
     logger.debug(f'gh_repo_info: acct={acct} repo={repo} GH_ACCESS_TOKEN={GH_ACCESS_TOKEN}')
     url = f'https://api.github.com/repos/{acct}/{repo}'
-    resp = requests.get(url, headers={
-        'Authorization': f'Token {GH_ACCESS_TOKEN}',
-        'Accept': 'application/vnd.github.v3+json',
-        'User-agent': 'JSTOR Labs visual essays client'
+    resp = sync.get(url, headers={
+        'Authorization': f'Token {GH_ACCESS_TOKEN}'
     })
     logger.debug(f'gh_repo_info: {url} {resp.status_code} {round(now()-start,3)}')
     return resp.json() if resp.status_code == 200 else None
 
-_checked_prefixes = {}
+# default branch per acct/repo prefix, None for prefixes that are not a repo
+_checked_prefixes = open_cache('mdrender-gh-prefixes', default='memory', max_len=10000, max_age_seconds=86400)
 def has_gh_repo_prefix(path):
     start = now()
     elems = path.split('/')
@@ -86,7 +85,7 @@ def has_gh_repo_prefix(path):
     if prefix is not None and prefix not in _checked_prefixes:
         repo_info = gh_repo_info(elems[0], elems[1])
         _checked_prefixes[prefix] = repo_info['default_branch'] if repo_info else None
-    _is_repo_prefix = _checked_prefixes.get(prefix) is not None
+    _is_repo_prefix = prefix is not None and _checked_prefixes.get(prefix) is not None
     logger.debug(f'has_gh_repo_prefix: prefix={prefix} _is_repo_prefix={_is_repo_prefix} elapsed={round(now()-start,3)}')
     return _is_repo_prefix
 
@@ -95,7 +94,7 @@ def get_gh_file(path, ref=None):
     if has_gh_repo_prefix(path):
         elems = path.split('/')
         prefix = '/'.join(elems[:2]) if len(elems) >= 2 else None
-        ref = ref or _checked_prefixes[prefix]
+        ref = ref or _checked_prefixes.get(prefix)
         acct, repo = elems[:2]
         path = f'/{"/".join(path.split("/")[2:])}'    
     markdown = url = sha = None
@@ -128,20 +127,16 @@ def gh_dirlist(acct, repo, path, ref=None):
     url = f'https://api.github.com/repos/{acct}/{repo}/git/trees/{ref}'
     path_elems = [pe for pe in path.split('/') if pe]
     for path_elem in path_elems:
-        resp = requests.get(url, headers={
-            'Authorization': f'Token {GH_ACCESS_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json',
-            'User-agent': 'JSTOR Labs visual essays client'
+        resp = sync.get(url, headers={
+            'Authorization': f'Token {GH_ACCESS_TOKEN}'
         })
         resp = resp.json() if resp.status_code == 200 else {}
         found = next(iter([item for item in resp.get('tree', []) if item['path'] == path_elem]), None)
         url = found['url'] if found else None
         if not url: break
     if url:
-        resp = requests.get(url, headers={
-            'Authorization': f'Token {GH_ACCESS_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json',
-            'User-agent': 'JSTOR Labs visual essays client'
+        resp = sync.get(url, headers={
+            'Authorization': f'Token {GH_ACCESS_TOKEN}'
         })
         resp = resp.json() if resp.status_code == 200 else {}
         logger.debug(json.dumps(resp, indent=2))
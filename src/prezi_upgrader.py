@@ -4,7 +4,7 @@
 ###
 
 import json
-import requests
+from upstream import sync
 import uuid
 from collections import OrderedDict
 
@@ -99,7 +99,7 @@ class Upgrader(object):
 			print(msg)
 
 	def retrieve_resource(self, uri):
-		resp = requests.get(uri, verify=False)
+		resp = sync.get(uri, verify=False)
 		try:
 			val = resp.json()
 		except:
@@ -304,7 +304,7 @@ class Upgrader(object):
 	def set_remote_type(self, what):
 		# do a HEAD on the resource and look at Content-Type
 		try:
-			h = requests.head(what['id'])
+			h = sync.head(what['id'])
 		except:
 			# dummy URI
 			h = None
@@ -7,79 +7,290 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 import argparse
+import asyncio
+import heapq
+import itertools
 import json
-import traceback
+import os
+import re
 from time import time as now
 
-import concurrent.futures
-
 try:
   from .commons import CommonsClient
   from .jstor import JSTORClient
+  from .labels import LABELLED_FIELDS, LANGUAGE_PATTERN, QID_PATTERN, labels, unlabelled
+  from .pages import PageCache, encode_docs, project_docs
+  from .prefetch import Prefetcher
 except:
   from commons import CommonsClient
   from jstor import JSTORClient
+  from labels import LABELLED_FIELDS, LANGUAGE_PATTERN, QID_PATTERN, labels, unlabelled
+  from pages import PageCache, encode_docs, project_docs
+  from prefetch import Prefetcher
+
+from upstream import engine
+
+BATCH_MAX_QIDS = int(os.environ.get('SEARCH_BATCH_MAX_QIDS', 50)) # QIDs per batch search
+
+# Per-source latency budgets in ms, e.g. SEARCH_SOURCE_BUDGETS_MS=commons=1500,jstor=3000.  A request
+# budget_ms further caps them.  Sources missing their budget are returned as pending.
+SOURCE_BUDGETS_MS = dict([(name.strip(), float(budget)) for name, budget in [
+  rec.split('=') for rec in os.environ.get('SEARCH_SOURCE_BUDGETS_MS', '').split(',') if '=' in rec]])
 
 class SearchClient(object):
 
-  def __init__(self, **kwargs):
+  def __init__(self, source_budgets=None, **kwargs):
     self._commons = CommonsClient()
     self._jstor = JSTORClient()
+    self._pages = PageCache()
+    self._prefetcher = Prefetcher(self._warm)
+    self.source_budgets = SOURCE_BUDGETS_MS if source_budgets is None else source_budgets
+    self._late = set() # searches still running after their budget
+    self.budget_counters = {'searches': 0, 'partial': 0, 'unlabelled': 0, 'late_completed': 0, 'late_failed': 0}
   
   def merge(self, by_source, offset=0, limit=10, page_mark=None):
-    
-    cursors = dict([(source, 0) for source in by_source])
-    docs = [] 
-    try:   
-      for weight in range(5, 0, -1):
-        weight_done = False
-        while not weight_done:
-          matched = False
-          for source in sorted(by_source):
-            source_docs = by_source[source]['docs']
-            if len(source_docs) > cursors[source] and source_docs[cursors[source]]['weight'] == weight:
-              to_add = source_docs[cursors[source]]
-              to_add['seq'] = offset + len(docs)
-              docs.append(to_add)
-              cursors[source] += 1
-              matched = True
-              if len(docs) == offset + limit:
-                raise StopIteration
-          weight_done = not matched
-    except StopIteration:
-      pass
-
-    return docs[offset:offset+limit]
-
-  def search(self, qid, source='all', offset=0, limit=10, **kwargs):
-  
+    '''k-way heap merge of the per-source doc lists, each ordered by descending weight.
+    Docs of equal weight are interleaved across sources in source name order.  Only
+    offset+limit docs are consumed and the page is returned as shallow copies with
+    their own seq, leaving the cached docs untouched.  seq keeps the numbering of the
+    weight-loop merge this replaced, offset plus the position in the merged list.'''
+    def keyed(idx, docs):
+      rank, weight = 0, None
+      for doc in docs:
+        if doc['weight'] != weight:
+          rank, weight = 0, doc['weight']
+        yield (-weight, rank, idx), doc
+        rank += 1
+
+    merged = heapq.merge(*[keyed(idx, by_source[source]['docs']) for idx, source in enumerate(sorted(by_source))], key=lambda rec: rec[0])
+    return [{**doc, 'seq': offset + pos} for pos, (_, doc) in enumerate(itertools.islice(merged, offset + limit)) if pos >= offset]
+
+  def stats(self):
+    return {
+      'labels': labels.stats(),
+      'commons': self._commons.stats(),
+      'jstor': self._jstor.stats(),
+      'pages': self._pages.stats(),
+      'prefetch': self._prefetcher.stats(),
+      'budget': {**self.budget_counters, 'late_running': len(self._late)},
+      'upstream': engine.stats()
+    }
+
+  def prefetch(self, qids, language='en'):
+    '''Queues QIDs to have their first page of results and labels cached in the background.'''
+    return self._prefetcher.enqueue(qids, language)
+
+  async def _warm(self, qid, language='en'):
+    await engine.gather(
+      labels=labels.get_labels([qid], language),
+      **self._searches(qid, 'all', 0, 10, language=language)
+    )
+
+  def _searches(self, qid, source, offset, limit, **kwargs):
+    searches = {}
+    if 'commons' in source or 'all' in source:
+      searches['commons'] = self._commons.search(qid, offset, limit, **kwargs)
+    if 'jstor' in source or 'all' in source:      
+      searches['jstor'] = self._jstor.search(qid, offset, limit, **kwargs)
+    return searches
+
+  def _budgets(self, names, budget_ms=None):
+    budgets = {}
+    for name in names:
+      limits = [budget for budget in (budget_ms, self.source_budgets.get(name)) if budget is not None]
+      if limits:
+        budgets[name] = min(limits)
+    return budgets
+
+  async def _gather_within(self, searches, budgets):
+    '''Runs the named searches concurrently, waiting for each no longer than its budget (ms).
+    Returns the results by name, omitting failed searches, and the names of the searches
+    still running.  These are left to complete in the background, so their results are
+    cached for later requests.'''
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+    tasks = dict([(name, asyncio.ensure_future(aw)) for name, aw in searches.items()])
+    for name in sorted(tasks, key=lambda name: budgets.get(name, float('inf'))):
+      timeout = max(0, deadline + budgets[name] / 1000 - loop.time()) if name in budgets else None
+      await asyncio.wait({tasks[name]}, timeout=timeout)
+    results, pending = {}, []
+    for name, task in tasks.items():
+      if not task.done():
+        pending.append(name)
+        self._late.add(task)
+        task.add_done_callback(self._late_done)
+      elif task.exception() is not None:
+        logger.warning('%r generated an exception: %s' % (name, task.exception()))
+      else:
+        results[name] = task.result()
+    return results, pending
+
+  def _late_done(self, task):
+    self._late.discard(task)
+    if task.cancelled() or task.exception() is not None:
+      self.budget_counters['late_failed'] += 1
+      logger.warning(f'late search failed: {"cancelled" if task.cancelled() else task.exception()}')
+    else:
+      self.budget_counters['late_completed'] += 1
+
+  async def _search(self, qid, source='all', offset=0, limit=10, label=True, budget_ms=None, **kwargs):
+    '''Returns the merged results page, whether all requested sources returned results, and
+    when the first of the source results goes stale.  With label false depicts labels are
+    neither resolved for uncached results nor added to the page.  Sources exceeding their
+    budget (see SOURCE_BUDGETS_MS, capped by budget_ms) are listed as pending in the page.
+    When every source has a budget, labels are added within what is left of the largest,
+    and the page is returned unlabelled (and not complete) if they are not resolved by
+    then.'''
     start = now()
-    by_source = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-      futures = {}
-      if 'commons' in source or 'all' in source:
-        futures[executor.submit(self._commons.search, qid, offset, limit, **kwargs)] = 'commons'
-      if 'jstor' in source or 'all' in source:      
-        futures[executor.submit(self._jstor.search, qid, offset, limit, **kwargs)] = 'jstor'
-
-      for future in concurrent.futures.as_completed(futures):
-        source = futures[future]
-        try:
-          by_source[source] = future.result()
-        except Exception as exc:
-          logger.warning('%r generated an exception: %s' % (source, exc))
-          logger.info(traceback.format_exc())
+    if offset == 0:
+      self._prefetcher.claim(qid, kwargs.get('language', 'en'))
+    if kwargs.get('refresh') and offset == 0:
+      self._pages.invalidate(qid)
+    searches = self._searches(qid, source, offset, limit, label=label, **kwargs)
+    budgets = self._budgets(searches, budget_ms)
+    pending = []
+    if budgets:
+      self.budget_counters['searches'] += 1
+      by_source, pending = await self._gather_within(searches, budgets)
+      if pending:
+        self.budget_counters['partial'] += 1
+    else:
+      by_source = await engine.gather(**searches)
     
     resp = {
       **{
         'total': sum(rec['total'] for rec in by_source.values()),
-        'qtime': round(now()-start, 2)
+        'qtime': round(now()-start, 2),
+        'stale': any(rec.get('stale') for rec in by_source.values())
       },
       **{'docs': self.merge(by_source, offset, limit)}
     }
-    logger.info(f'search: qid={qid} source={source} offset={offset} limit={limit} kwargs={kwargs} total={resp["total"]} docs={len(resp["docs"])} qtime={round(now()-start, 2)}')
+    if pending:
+      resp['pending'] = pending
+    labelled = True
+    to_label = [doc for doc in resp['docs'] if unlabelled(doc)] if label else []
+    if to_label:
+      # results cached by a search without labels are labelled a page at a time
+      labelling = asyncio.ensure_future(labels.add_labels(to_label, kwargs.get('language', 'en')))
+      timeout = max(0, max(budgets.values()) / 1000 - (now() - start)) if len(budgets) == len(searches) else None
+      await asyncio.wait({labelling}, timeout=timeout)
+      if not labelling.done():
+        # left to complete in the background, so the labels are cached for later requests
+        labelled = False
+        self.budget_counters['unlabelled'] += 1
+        self._late.add(labelling)
+        labelling.add_done_callback(self._late_done)
+      elif labelling.exception() is not None:
+        raise labelling.exception()
+    logger.info(f'search: qid={qid} source={source} offset={offset} limit={limit} kwargs={kwargs} total={resp["total"]} stale={resp["stale"]} pending={pending} docs={len(resp["docs"])} qtime={round(now()-start, 2)}')
+    return resp, len(by_source) == len(searches) and labelled, min([rec['expires'] for rec in by_source.values() if 'expires' in rec], default=None)
+
+  async def search(self, qid, source='all', offset=0, limit=10, **kwargs):
+    return (await self._search(qid, source, offset, limit, **kwargs))[0]
+
+  def _enriched(self, docs, label):
+    '''True if the Commons metadata and, with label, the depicts labels of docs were resolved.'''
+    if any(doc['id'].startswith('wc:') and 'pageid' not in doc for doc in docs):
+      return False
+    return not (label and any(unlabelled(doc) for doc in docs))
+
+  async def search_json(self, qid, doc_fields, depicts_fields, source='all', offset=0, limit=10, language='en', **kwargs):
+    '''Search results encoded as JSON bytes.  Encoded pages are cached per (qid, source,
+    offset, limit, language, doc_fields, depicts_fields) when all sources returned fresh
+    results and their metadata and labels were resolved, so repeat requests skip merging
+    and serialization.  doc_fields and depicts_fields give the fields to emit, in order;
+    labels are only resolved when doc_fields include labelled fields.'''
+    start = now()
+    key = (qid, source, offset, limit, language, tuple(doc_fields), tuple(depicts_fields))
+    page = None if kwargs.get('refresh') and offset == 0 else self._pages.get(key)
+    stale, pending = False, b''
+    if page is None:
+      label = any(fld in doc_fields for fld in LABELLED_FIELDS)
+      resp, complete, expires = await self._search(qid, source, offset, limit, label=label, language=language, **kwargs)
+      page = (resp['total'], encode_docs(resp['docs'], doc_fields, depicts_fields))
+      stale = resp['stale']
+      if 'pending' in resp:
+        pending = b',"pending":%s' % json.dumps(resp['pending']).encode('utf-8')
+      if complete and not stale and self._enriched(resp['docs'], label):
+        self._pages.set(key, *page, expires=expires)
+    total, docs_json = page
+    return b'{"total":%d,"qtime":%s,"stale":%s%s,"docs":%s}' % (total, json.dumps(round(now()-start, 2)).encode('utf-8'), b'true' if stale else b'false', pending, docs_json)
+
+  async def search_batch(self, qids, source='all', offset=0, limit=10, **kwargs):
+    '''Searches several QIDs at once, returning the merged results page per QID.  Raises
+    ValueError for more than BATCH_MAX_QIDS QIDs or a malformed QID.'''
+    start = now()
+    qids = list(dict.fromkeys(qids))
+    if len(qids) > BATCH_MAX_QIDS:
+      raise ValueError(f'at most {BATCH_MAX_QIDS} QIDs per batch, got {len(qids)}')
+    invalid = [qid for qid in qids if not re.match(QID_PATTERN, qid)]
+    if invalid:
+      raise ValueError(f'invalid QIDs: {", ".join(invalid[:5])}')
+    searches = {}
+    if 'commons' in source or 'all' in source:
+      searches['commons'] = self._commons.search_batch(qids, offset, limit, **kwargs)
+    if 'jstor' in source or 'all' in source:      
+      searches['jstor'] = self._jstor.search_batch(qids, offset, limit, **kwargs)
+    by_source = await engine.gather(**searches)
+
+    results = {}
+    for qid in qids:
+      qid_by_source = dict([(name, recs[qid]) for name, recs in by_source.items() if qid in recs])
+      results[qid] = {
+        'total': sum(rec['total'] for rec in qid_by_source.values()),
+        'stale': any(rec.get('stale') for rec in qid_by_source.values()),
+        'docs': self.merge(qid_by_source, offset, limit)
+      }
+    await labels.add_labels([doc for rec in results.values() for doc in rec['docs'] if unlabelled(doc)], kwargs.get('language', 'en'))
+    resp = {'qtime': round(now()-start, 2), 'results': results}
+    logger.info(f'search_batch: qids={len(qids)} source={source} offset={offset} limit={limit} kwargs={kwargs} qtime={resp["qtime"]}')
     return resp
 
+  async def stream(self, qid, doc_fields, depicts_fields, source='all', offset=0, limit=10, **kwargs):
+    '''Yields a message for each source as soon as its results are ready, followed
+    by a final message with the merged page and totals across sources.  Docs are
+    limited to doc_fields and depicts_fields, as in search_json.  Source messages
+    carry the first limit docs of the source for the first page only, a later page
+    of the merged results is not made of the same page of each source.'''
+    start = now()
+    if offset == 0:
+      self._prefetcher.claim(qid, kwargs.get('language', 'en'))
+    label = any(fld in doc_fields for fld in LABELLED_FIELDS)
+    tasks = dict([(asyncio.ensure_future(aw), name) for name, aw in self._searches(qid, source, offset, limit, label=label, **kwargs).items()])
+    by_source = {}
+    pending = set(tasks)
+    while pending:
+      done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        name = tasks[task]
+        try:
+          by_source[name] = task.result()
+        except Exception as exc:
+          logger.warning('%r generated an exception: %s' % (name, exc))
+          continue
+        docs = self.merge({name: by_source[name]}, 0, limit) if offset == 0 else []
+        if label and docs:
+          await labels.add_labels([doc for doc in docs if unlabelled(doc)], kwargs.get('language', 'en'))
+        yield {
+          'event': 'source',
+          'source': name,
+          'total': by_source[name]['total'],
+          'qtime': round(now()-start, 2),
+          'stale': by_source[name].get('stale', False),
+          'docs': project_docs(docs, doc_fields, depicts_fields)
+        }
+    docs = self.merge(by_source, offset, limit)
+    if label:
+      await labels.add_labels([doc for doc in docs if unlabelled(doc)], kwargs.get('language', 'en'))
+    yield {
+      'event': 'done',
+      'total': sum(rec['total'] for rec in by_source.values()),
+      'qtime': round(now()-start, 2),
+      'stale': any(rec.get('stale') for rec in by_source.values()),
+      'docs': project_docs(docs, doc_fields, depicts_fields)
+    }
+    logger.info(f'stream: qid={qid} source={source} offset={offset} limit={limit} kwargs={kwargs} sources={list(by_source)} qtime={round(now()-start, 2)}')
+
 if __name__ == '__main__':
   logger.setLevel(logging.INFO)
   parser = argparse.ArgumentParser(description='IIIF Image Search')
@@ -88,5 +299,5 @@ if __name__ == '__main__':
   parser.add_argument('--limit', help='Search results limit', type=int, default=10)
 
   client = SearchClient()
-  results = client.search(**vars(parser.parse_args()))
+  results = asyncio.run(client.search(**vars(parser.parse_args())))
   print(json.dumps(results))
\ No newline at end of file
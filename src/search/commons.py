@@ -6,76 +6,151 @@ logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(messa
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-import os
+import os, sys
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 BASEDIR = SCRIPT_DIR
+sys.path.append(os.path.dirname(SCRIPT_DIR))
 
 import argparse
+import asyncio
 import json
-import traceback
 import hashlib
 from time import time as now
 from urllib.parse import quote, unquote
 
 from typing import List
 
-import concurrent.futures
+from upstream import engine
+from cache import open_cache
 
-from bs4 import BeautifulSoup
+try:
+  from .depicts import DepictsIndex
+  from .health import StrategyHealth
+  from .htmltext import extract_text
+  from .labels import labels
+  from .singleflight import SingleFlight
+except:
+  from depicts import DepictsIndex
+  from health import StrategyHealth
+  from htmltext import extract_text
+  from labels import labels
+  from singleflight import SingleFlight
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
-
-import dill
-from expiringdict import ExpiringDict
+METADATA_CHUNK_SIZE = 50 # max titles per MediaWiki API query
+METADATA_TTL = 86400     # file metadata is cached per title for a day
+BATCH_CONCURRENCY = 8    # QIDs collected concurrently in batch searches
+CACHE_SOFT_TTL = 1800    # depicts results older than this are served stale and refreshed in the background
+CACHE_HARD_TTL = 86400   # depicts results older than this are dropped
+CACHE_MEMORY_BYTES = int(os.environ.get('SEARCH_CACHE_MEMORY_MB', 64)) * 2**20  # per source, in-memory tier
+CACHE_DISK_BYTES = int(os.environ.get('SEARCH_CACHE_DISK_MB', 1024)) * 2**20    # per source, on-disk tier
+DEPICTS_INDEX = os.environ.get('DEPICTS_INDEX') # offline depicts index (see depicts.py), SPARQL only when unset
+COMMONS_RACE = os.environ.get('COMMONS_RACE', 'true').lower() in ('1', 'true', 'yes') # race WCQS and MediaWiki search while WCQS health is uncertain
 
 class CommonsClient(object):
 
   def __init__(self, **kwargs):
-    try:
-      self._cache = dill.load(open('commons.cache', 'rb'))
-    except:
-      self._cache = ExpiringDict(max_len=100, max_age_seconds=1800) # cache images for 30 minutes
+    self._cache = open_cache('commons', max_len=None, max_age_seconds=CACHE_HARD_TTL, memory_bytes=CACHE_MEMORY_BYTES, disk_bytes=CACHE_DISK_BYTES)
+    self._flights = SingleFlight()
+    self._stale_counters = {'fresh': 0, 'stale': 0}
+    self._metadata = open_cache('commons-metadata', max_len=20000, max_age_seconds=METADATA_TTL)
+    self._metadata_inflight = {}
+    self._metadata_counters = {'hits': 0, 'misses': 0, 'coalesced': 0}
+    self._depicts_index = DepictsIndex(DEPICTS_INDEX) if DEPICTS_INDEX else None
+    self._index_counters = {'hits': 0, 'misses': 0}
+    self._health = {'sparql': StrategyHealth('wcqs'), 'wikimedia': StrategyHealth('mediawiki-search')}
+    self._strategy_counters = {'sequential': 0, 'skipped': 0, 'fallback': 0, 'raced': 0}
   
-  def _update_cache(self, key, data):
-    self._cache[key] = data
-    dill.dump(self._cache, open('commons.cache', 'wb'))
+  async def _update_cache(self, key, data):
+    await self._cache.aset(key, data)
+
+  async def _enrich_cache(self, key, data, stored):
+    '''Writes back docs updated in place with metadata, keeping their original age.  Skipped
+    if a refresh has replaced the entry in the meantime.'''
+    entry = await self._cache.aget_entry(key)
+    if entry is not None and entry[1] <= stored:
+      await self._cache.aset(key, data, stored=stored)
 
-  def wikidata_depict_images(self, qid):
+  async def cached_docs(self, qid, language='en'):
+    '''Returns (docs, stored) from the cache, or (None, None).  Entries past the soft TTL
+    are still returned, and a background refresh is started for them.'''
+    entry = await self._cache.aget_entry(qid)
+    if entry is None:
+      return None, None
+    docs, stored = entry
+    if now() - stored > CACHE_SOFT_TTL:
+      self._stale_counters['stale'] += 1
+      self._flights.spawn((qid, language), self.depict_images, qid, language)
+    else:
+      self._stale_counters['fresh'] += 1
+    return docs, stored
+
+  def image_doc(self, title):
+    '''Doc for a Commons file, without depicts.'''
+    return {
+      'id': f'wc:{quote(title.replace(" ","_"))}',
+      'title': title,
+      'depicts': [],
+      'url': f'https://commons.wikimedia.org/wiki/File:{title.replace(" ", "_")}',
+      'thumbnail': self.image_url(title, 240),
+      'weight': 2
+    }
+
+  def index_depict_images(self, qid):
+    '''Docs for the images depicting qid in the offline depicts index, built as the
+    SPARQL queries build them, Commons docs replacing Wikidata docs for the same file.'''
+    images, from_wikidata = {}, set()
+    for image in self._depicts_index.images(qid):
+      doc = self.image_doc(image['title'])
+      if image['from_wikidata']:
+        # items sharing an image contribute their depicts to one doc
+        if doc['id'] in images and doc['id'] not in from_wikidata:
+          continue
+        doc = images.get(doc['id'], doc)
+        doc['depicts'] += [{'id': depicts_id} for depicts_id, _ in image['depicts'] if {'id': depicts_id} not in doc['depicts']]
+        from_wikidata.add(doc['id'])
+      else:
+        from_wikidata.discard(doc['id'])
+        for depicts_id, preferred in image['depicts']:
+          depicts = {'id': depicts_id}
+          if preferred or image['dro']:
+            depicts['prominent'] = True
+          if preferred and depicts_id == qid:
+            doc['weight'] = 3
+          doc['depicts'].append(depicts)
+        if image['dro']:
+          doc['digital_representation_of'] = {'id': image['dro']}
+          if image['dro'] == qid:
+            doc['weight'] = 4
+        doc['depicts'].sort(key=lambda depicts: depicts.get('prominent', False), reverse=True)
+      images[doc['id']] = doc
+    return list(images.values())
+
+  async def wikidata_depict_images(self, qid):
     start = now()
     docs = []
     query = '''
       SELECT DISTINCT ?image ?depicts WHERE { 
       ?entity wdt:P180 wd:%s ; wdt:P180 ?depicts ; wdt:P18 ?image . }''' % qid
-    resp = requests.get(
+    resp = await engine.get(
       f'https://query.wikidata.org/sparql?query={quote(query)}',
       headers = {
         'Content-Type': 'application/x-www-form-urlencoded', 
-        'Accept': 'application/sparql-results+json',
-        'User-Agent': 'Labs Client'
+        'Accept': 'application/sparql-results+json'
       }
     )
     if resp.status_code == 200:
       images = {}
       for rec in resp.json()['results']['bindings']:
-        title = unquote(rec['image']['value'].split('/')[-1])
-        url = f'https://commons.wikimedia.org/wiki/File:{title.replace(" ", "_")}'
-        id = f'wc:{quote(title.replace(" ","_"))}'
+        doc = self.image_doc(unquote(rec['image']['value'].split('/')[-1]))
+        id = doc['id']
         if id not in images:
-          images[id] = {
-            'id': id,
-            'title': title,
-            'depicts': [],
-            'url': url,
-            'thumbnail': self.image_url(title, 240),
-            'weight': 2
-          }
+          images[id] = doc
         images[id]['depicts'].append({'id': rec['depicts']['value'].split('/')[-1]})
       docs = images.values()
     logger.debug(f'wikidata_depict_images: status={resp.status_code} docs={len(docs)} qtime={round(now()-start, 2)}')
     return docs
 
-  def commons_depict_images_sparql(self, qid: str):
+  async def commons_depict_images_sparql(self, qid: str):
     start = now()
     docs = None
     query = '''
@@ -84,12 +159,11 @@ class CommonsClient(object):
         ?entity p:P180 [ ps:P180 ?depicts ; wikibase:rank ?rank ] .
         OPTIONAL { ?entity wdt:P6243 ?dro . }
       }''' % qid
-    resp = requests.get(
+    resp = await engine.get(
       f'https://wcqs-beta.wmflabs.org/sparql?query={quote(query)}',
       headers = {
         'Content-Type': 'application/x-www-form-urlencoded', 
-        'Accept': 'application/sparql-results+json',
-        'User-Agent': 'Labs Client'
+        'Accept': 'application/sparql-results+json'
       }
     )
     logger.info(f'wcqs-beta.wmflabs.org.response_code={resp.status_code}')
@@ -97,18 +171,10 @@ class CommonsClient(object):
       docs = []
       images = {}
       for rec in resp.json()['results']['bindings']:
-        title = unquote(rec['image']['value'].split('/')[-1])
-        url = f'https://commons.wikimedia.org/wiki/File:{title.replace(" ", "_")}'
-        id = f'wc:{quote(title.replace(" ","_"))}'
+        doc = self.image_doc(unquote(rec['image']['value'].split('/')[-1]))
+        id = doc['id']
         if id not in images:
-          images[id] = {
-            'id': id,
-            'title': title,
-            'depicts': [],
-            'url': url,
-            'thumbnail': self.image_url(title, 240),
-            'weight': 2
-          }
+          images[id] = doc
         depicts_id = rec['depicts']['value'].split('/')[-1]
         depicts = {'id': depicts_id}
         if rec['rank']['value'].split('#')[-1] == 'PreferredRank':
@@ -128,15 +194,15 @@ class CommonsClient(object):
     logger.info(f'commons_depict_images_sparql: status={resp.status_code} docs={len(docs) if docs else None} qtime={round(now()-start, 2)}')
     return docs
 
-  def commons_depict_images_wikimedia(self, qid: str):
+  async def commons_depict_images_wikimedia(self, qid: str):
     start = now()
-    def get_depicts():
+    async def get_depicts():
       url = f'https://commons.wikimedia.org/w/api.php?action=query&list=search&srsearch=haswbstatement:P180={qid}&srnamespace=6&srlimit=500&format=json'
-      return requests.get(url).json().get('query',{}).get('search',[])
+      return (await engine.get(url)).json().get('query',{}).get('search',[])
 
-    def get_dro():
+    async def get_dro():
       url = f'https://commons.wikimedia.org/w/api.php?action=query&list=search&srsearch=haswbstatement:P6243={qid}&srnamespace=6&srlimit=500&format=json'
-      return requests.get(url).json().get('query',{}).get('search',[])
+      return (await engine.get(url)).json().get('query',{}).get('search',[])
 
     def parse_results(recs):
       images = {}
@@ -155,19 +221,9 @@ class CommonsClient(object):
           }
       return images
 
-    by_source = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-      futures = {}
-      futures[executor.submit(get_depicts)] = 'depicts'
-      futures[executor.submit(get_dro)] = 'dro'
-
-      for future in concurrent.futures.as_completed(futures):
-        source = futures[future]
-        try:
-          by_source[source] = parse_results(future.result())
-        except Exception as exc:
-          logger.warning('%r generated an exception: %s' % (source, exc))
-          logger.info(traceback.format_exc())
+    by_source = dict([(source, parse_results(recs)) for source, recs in (await engine.gather(depicts=get_depicts(), dro=get_dro())).items()])
+    if 'depicts' not in by_source:
+      return None
 
     if 'depicts' in by_source and 'dro' in by_source:
       for id, doc in by_source['dro'].items():
@@ -183,80 +239,157 @@ class CommonsClient(object):
     logger.info(f'commons_depict_images_wikimedia: docs={len(docs)} qtime={round(now()-start, 2)}')
     return docs
 
-  def commons_depict_images(self, qid: str):
-    docs = self.commons_depict_images_sparql(qid)
-    if docs == None:
-      docs = self.commons_depict_images_wikimedia(qid)
-    return docs
+  async def commons_depict_images(self, qid: str):
+    '''Depicted images from WCQS SPARQL, falling back to MediaWiki search.  While WCQS is
+    unhealthy it is skipped (except for periodic probes, raced against the fallback), and
+    while its health is uncertain both are raced and the first good answer is taken.'''
+    sparql, wikimedia = self._health['sparql'], self._health['wikimedia']
+    state = sparql.state
+    if state == 'unhealthy' and not sparql.probe_due():
+      self._strategy_counters['skipped'] += 1
+      docs = await wikimedia.run(self.commons_depict_images_wikimedia, qid)
+    elif state == 'healthy' or not COMMONS_RACE:
+      self._strategy_counters['sequential'] += 1
+      docs = await sparql.run(self.commons_depict_images_sparql, qid)
+      if docs is None:
+        self._strategy_counters['fallback'] += 1
+        docs = await wikimedia.run(self.commons_depict_images_wikimedia, qid)
+    else:
+      self._strategy_counters['raced'] += 1
+      docs = await self._race(qid)
+    return docs if docs is not None else []
+
+  async def _race(self, qid):
+    '''Runs both strategies, returns the first good answer.  The other is cancelled, so
+    only strategies that failed or answered count toward their health.'''
+    tasks = {
+      asyncio.ensure_future(self._health['sparql'].run(self.commons_depict_images_sparql, qid)): 'sparql',
+      asyncio.ensure_future(self._health['wikimedia'].run(self.commons_depict_images_wikimedia, qid)): 'wikimedia'
+    }
+    pending = set(tasks)
+    try:
+      while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+          if task.result() is not None:
+            logger.debug(f'commons_depict_images: qid={qid} race won by {tasks[task]}')
+            return task.result()
+      return None
+    finally:
+      for task in pending:
+        task.cancel()
 
-  def get_image_metadata(self, titles: List[str]):
+  async def get_image_metadata(self, titles: List[str]):
+    '''Fetches imageinfo metadata for file titles, keyed by the requested 'File:' title.
+    Titles Commons has no imageinfo for map to an empty dict, titles in failed requests are omitted.'''
     start = now()
     metadata = {}
     titles = [f'File:{title}' for title in titles]
-    url = f'https://commons.wikimedia.org/w/api.php?origin=*&format=json&action=query&prop=imageinfo&iiprop=extmetadata|size|mime&titles={"|".join(titles)}'
-    resp = requests.get(url)
-    if resp.status_code == 200:
-      resp = resp.json()
-      pages = resp.get('query',{}).get('pages',{})
-      for pageid, page in pages.items():
-        if 'imageinfo' in page:
-          md = {**page['imageinfo'][0], **page['imageinfo'][0]['extmetadata']}
-          del md['extmetadata']
-          md['pageid'] = pageid
-          metadata[page['title']] = md
-    logger.info(f'get_image_metadata: items={len(metadata)} qtime={round(now()-start, 2)}')
+
+    async def get_chunk(titles):
+      url = f'https://commons.wikimedia.org/w/api.php?origin=*&format=json&action=query&prop=imageinfo&iiprop=extmetadata|size|mime&titles={"|".join(titles)}'
+      resp = await engine.get(url)
+      chunk_metadata = {}
+      if resp.status_code == 200:
+        resp = resp.json()
+        normalized = dict([(rec['from'], rec['to']) for rec in resp.get('query',{}).get('normalized',[])])
+        pages = dict([(page['title'], (pageid, page)) for pageid, page in resp.get('query',{}).get('pages',{}).items()])
+        for title in titles:
+          pageid, page = pages.get(normalized.get(title, title), (None, {}))
+          if 'imageinfo' in page:
+            md = {**page['imageinfo'][0], **page['imageinfo'][0]['extmetadata']}
+            del md['extmetadata']
+            md['pageid'] = pageid
+            chunk_metadata[title] = md
+          else:
+            chunk_metadata[title] = {}
+      return chunk_metadata
+
+    # the MediaWiki API accepts at most 50 titles per request
+    chunks = [titles[i:i+METADATA_CHUNK_SIZE] for i in range(0, len(titles), METADATA_CHUNK_SIZE)]
+    for chunk_metadata in (await engine.gather(**dict([(f'metadata-{idx}', get_chunk(chunk)) for idx, chunk in enumerate(chunks)]))).values():
+      metadata.update(chunk_metadata)
+    logger.info(f'get_image_metadata: items={len(metadata)} chunks={len(chunks)} qtime={round(now()-start, 2)}')
     return metadata
 
-  def extract_text(self, val, lang='en'):
-    soup = BeautifulSoup(val, 'html5lib')
-    _elem = soup.select_one(f'[lang="{lang}"]')
-    return (_elem.text if _elem else soup.text).strip()
+  def metadata_fields(self, title, md):
+    '''Doc fields derived from the Commons metadata of a file.'''
+    fields = {'pageid': md['pageid']}
+    if 'LicenseUrl' in md:
+        fields['rights'] = md['LicenseUrl']['value']
+    elif md.get('License',{}).get('value') in ('pd', 'pdm'):
+      fields['rights'] = 'https://creativecommons.org/publicdomain/mark/1.0/'
+    if 'ObjectName' in md:
+      fields['title'] = self.extract_text(md['ObjectName']['value'])
+    else:
+      fields['title'] = title.replace(' ','_')
+    if 'ImageDescription' in md:
+      # fields['description'] = md['ImageDescription']['value']
+      fields['description'] = self.extract_text(md['ImageDescription']['value'])
+    for fld in ['Attribution', 'Artist']:
+      if fld in md:
+        # fields['owner'] = md[fld]['value'].replace('<big>','').replace('</big>','')
+        fields['owner'] = self.extract_text(md[fld]['value'].replace('<big>','').replace('</big>',''))
+        break
+    return fields
 
-  def get_labels(self, qids, language='en'):
+  async def image_metadata(self, titles: List[str]):
+    '''Doc fields for file titles, keyed by title, served from the title-keyed metadata
+    store.  Missing titles are fetched from Commons once, concurrent requests for a title
+    already being fetched wait on that fetch.'''
     start = now()
-    labels = {}
-    values = ' '.join([f'(<http://www.wikidata.org/entity/{qid}>)' for qid in qids])
-    query = f'SELECT ?item ?label WHERE {{ VALUES (?item) {{ {values} }} ?item rdfs:label ?label . FILTER (LANG(?label) = "{language}" || LANG(?label) = "en") .}}'
-    resp = requests.post(
-      'https://query.wikidata.org/sparql',
-      headers = {
-        'Content-Type': 'application/x-www-form-urlencoded', 
-        'Accept': 'application/sparql-results+json',
-        'User-Agent': 'Labs Client'
-      },
-      data={'query': query}
-    )
-    if resp.status_code == 200:
-      labels = dict([(rec['item']['value'].split('/')[-1],rec['label']['value']) for rec in resp.json()['results']['bindings']])
-      for qid in qids:
-        if qid not in labels:
-          labels[qid] = ''
-    logger.info(f'get_labels: items={len(labels)} qtime={round(now()-start, 2)}')
-    return labels
-
-  def add_labels(self, docs, language='en'):
-    labels = self._cache.get(f'{language}-labels', {})
-    
-    qids = set([])
-    for doc in docs:
-      for fld in ('depicts', 'digital_representation_of'):
-        if fld in doc:
-          recs = doc[fld] if isinstance(doc[fld],list) else [doc[fld]]
-          for rec in recs:
-            if rec['id'] not in labels:
-              qids.add(rec['id'])
-    if len(qids) > 0:
-      labels = {**labels, **self.get_labels(qids, language)}
-      self._update_cache(f'{language}-labels', labels)
+    metadata = {}
+    missing = []
+    waiting = {}
+    titles = set([title.replace('_',' ') for title in titles])
+    cached = await self._metadata.aget_entries(titles)
+    for title in titles:
+      fields = cached[title][0] if title in cached else None
+      if fields is not None:
+        metadata[title] = fields
+        self._metadata_counters['hits'] += 1
+      elif title in self._metadata_inflight:
+        waiting[title] = self._metadata_inflight[title]
+        self._metadata_counters['coalesced'] += 1
+      else:
+        missing.append(title)
+        self._metadata_counters['misses'] += 1
 
-    for doc in docs:
-      for fld in ('depicts', 'digital_representation_of'):
-        if fld in doc:
-          recs = doc[fld] if isinstance(doc[fld],list) else [doc[fld]]
-          for rec in recs:
-            if rec['id'] in labels:
-              rec['label'] = labels[rec['id']]
-    return docs
+    if missing:
+      loop = asyncio.get_running_loop()
+      futures = dict([(title, loop.create_future()) for title in missing])
+      self._metadata_inflight.update(futures)
+      fetched = {}
+      try:
+        for title, md in (await self.get_image_metadata(missing)).items():
+          title = title[5:]
+          fetched[title] = self.metadata_fields(title, md) if md else {}
+        await self._metadata.aset_many(fetched)
+      finally:
+        for title, future in futures.items():
+          future.set_result(fetched.get(title))
+          self._metadata_inflight.pop(title, None)
+      metadata.update(fetched)
+
+    for title, future in waiting.items():
+      fields = await asyncio.shield(future)
+      if fields is not None:
+        metadata[title] = fields
+
+    logger.info(f'image_metadata: titles={len(metadata)} missing={len(missing)} coalesced={len(waiting)} qtime={round(now()-start, 2)}')
+    return metadata
+
+  def extract_text(self, val, lang='en'):
+    return extract_text(val, lang)
+
+  def stats(self):
+    return {
+      'singleflight': self._flights.stats(),
+      'cache': {**self._stale_counters, **self._cache.stats()},
+      'metadata': self._metadata_counters,
+      'depicts_index': {**self._index_counters, **self._depicts_index.stats()} if self._depicts_index else None,
+      'strategies': {**self._strategy_counters, **dict([(name, health.stats()) for name, health in self._health.items()])}
+    }
 
   def image_url(self, title, width=None):
     title = title.replace(' ','_')
@@ -270,69 +403,116 @@ class CommonsClient(object):
       elif extension == 'tif' or extension == 'tiff': img_url += '.jpg'
     return img_url
 
-  def search(self, qid, offset=0, limit=10, language='en', refresh=False, **kwargs):
+  async def collect_depict_images(self, qid):
+    if self._depicts_index is not None:
+      if qid in self._depicts_index:
+        self._index_counters['hits'] += 1
+        return self.index_depict_images(qid)
+      self._index_counters['misses'] += 1
+    by_source = await engine.gather(
+      wikidata=self.wikidata_depict_images(qid),
+      commons=self.commons_depict_images(qid)
+    )
+    return list({
+      **dict([(doc['id'],doc) for doc in by_source.get('wikidata',{})]),
+      **dict([(doc['id'],doc) for doc in by_source.get('commons', {})]),
+    }.values())
+
+  async def depict_images_batch(self, qids, language='en', concurrency=BATCH_CONCURRENCY, label=True):
+    '''Collects depicted images for several QIDs with bounded concurrency, labels
+    them in one pass (unless label is false) and caches the sorted docs per QID.'''
+    semaphore = asyncio.Semaphore(concurrency)
+    async def collect(qid):
+      async with semaphore:
+        return await self.collect_depict_images(qid)
+    docs_by_qid = await engine.gather(**dict([(qid, collect(qid)) for qid in qids]))
+
+    if label:
+      await labels.add_labels([doc for docs in docs_by_qid.values() for doc in docs], language)
+    for qid, docs in docs_by_qid.items():
+      docs_by_qid[qid] = sorted(docs, key=lambda doc: doc['weight'], reverse=True)
+    await engine.gather(**dict([(qid, self._update_cache(qid, docs)) for qid, docs in docs_by_qid.items()]))
+    return docs_by_qid
+
+  async def depict_images(self, qid, language='en', label=True):
+    return (await self.depict_images_batch([qid], language, label=label))[qid]
+
+  def metadata_needed(self, docs, offset=0, limit=10):
+    return [doc['title'] for doc in docs[:offset+(limit*(3 if offset == 0 else 1))] if 'pageid' not in doc]
+
+  def apply_metadata(self, docs, metadata):
+    updated = False
+    for doc in docs:
+      if 'pageid' in doc: continue
+      fields = metadata.get(doc['title'].replace('_',' '))
+      if not fields: continue
+      doc.update(fields)
+      updated = True
+    return updated
+
+  async def search(self, qid, offset=0, limit=10, language='en', refresh=False, label=True, **kwargs):
+    '''Depicted images for qid.  With label false, docs fetched for this search are cached
+    without depicts labels, saving the label round trip.'''
     start = now()
-    docs = self._cache.get(qid) if (not refresh or offset > 0) else None
+    docs, stored = await self.cached_docs(qid, language) if (not refresh or offset > 0) else (None, None)
     from_cache = docs is not None
     if docs is None:
-      by_source = {}
-      with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        futures = {}
-        futures[executor.submit(self.wikidata_depict_images, qid)] = 'wikidata'
-        futures[executor.submit(self.commons_depict_images, qid)] = 'commons'
-
-        for future in concurrent.futures.as_completed(futures):
-          source = futures[future]
-          try:
-            by_source[source] = future.result()
-          except Exception as exc:
-            logger.warning('%r generated an exception: %s' % (source, exc))
-            logger.info(traceback.format_exc())
-      docs = list({
-        **dict([(doc['id'],doc) for doc in by_source.get('wikidata',{})]),
-        **dict([(doc['id'],doc) for doc in by_source.get('commons', {})]),
-      }.values())
-      
-      docs = self.add_labels(docs, language)
-      docs = sorted(docs, key=lambda doc: doc['weight'], reverse=True)
-      self._update_cache(qid, docs)
+      docs = await self._flights.do((qid, language), self.depict_images, qid, language, label)
+      stored = now()
     
-    metadata_needed = [doc['title'] for doc in docs[:offset+(limit*(3 if offset == 0 else 1))] if 'pageid' not in doc]
+    metadata_needed = self.metadata_needed(docs, offset, limit)
     # logger.info(f'offset={offset} limit={limit} metadata_needed={len(metadata_needed)}')
     if len(metadata_needed) > 0:
-      metadata = self.get_image_metadata(metadata_needed)
-      for doc in docs:
-        md = metadata.get(f'File:{doc["title"]}')
-        if md is None: continue
-        doc['pageid'] = md['pageid']
-        # logger.info(json.dumps(md,indent=2))
-        if md is None: continue
-        if 'LicenseUrl' in md:
-            doc['rights'] = md['LicenseUrl']['value']
-        elif md.get('License',{}).get('value') in ('pd', 'pdm'):
-          doc['rights'] = 'https://creativecommons.org/publicdomain/mark/1.0/'
-        if 'ObjectName' in md:
-          doc['title'] = self.extract_text(md['ObjectName']['value'])
-        else:
-          doc['title'] = unquote(doc['id'][3:])
-        if 'ImageDescription' in md:
-          # doc['description'] = md['ImageDescription']['value']
-          doc['description'] = self.extract_text(md['ImageDescription']['value'])
-        for fld in ['Attribution', 'Artist']:
-          if fld in md:
-            # doc['owner'] = md[fld]['value'].replace('<big>','').replace('</big>','')
-            doc['owner'] = self.extract_text(md[fld]['value'].replace('<big>','').replace('</big>',''))
-            break
-      self._update_cache(qid, docs)
+      metadata = await self.image_metadata(metadata_needed)
+      if self.apply_metadata(docs, metadata):
+        await self._enrich_cache(qid, docs, stored)
     
     results = {
       'total': len(docs),
       'docs': docs,
-      'qtime': round(now()-start, 2)
+      'qtime': round(now()-start, 2),
+      'stale': now() - stored > CACHE_SOFT_TTL,
+      'expires': stored + CACHE_SOFT_TTL
     }
-    logger.info(f'commons.search: qid={qid} offset={offset} limit={limit} kwargs={kwargs} fromCache={from_cache} total={results["total"]} docs={len(results["docs"])} qtime={round(now()-start, 2)}')
+    logger.info(f'commons.search: qid={qid} offset={offset} limit={limit} kwargs={kwargs} fromCache={from_cache} stale={results["stale"]} total={results["total"]} docs={len(results["docs"])} qtime={round(now()-start, 2)}')
     return results
 
+  async def search_batch(self, qids, offset=0, limit=10, language='en', refresh=False, concurrency=BATCH_CONCURRENCY, **kwargs):
+    '''Searches several QIDs sharing one label pass and one metadata pass.  QIDs already
+    being fetched by a concurrent search are awaited, the rest are fetched together
+    and registered as in flight so concurrent searches for them coalesce onto the batch.'''
+    start = now()
+    docs_by_qid, stored_by_qid = {}, {}
+    if not refresh or offset > 0:
+      for qid, (docs, stored) in (await engine.gather(**dict([(qid, self.cached_docs(qid, language)) for qid in qids]))).items():
+        if docs is not None:
+          docs_by_qid[qid], stored_by_qid[qid] = docs, stored
+    missing = [qid for qid in qids if qid not in docs_by_qid]
+
+    if missing:
+      to_fetch = [qid for qid in missing if not self._flights.running((qid, language))]
+      batch = asyncio.ensure_future(self.depict_images_batch(to_fetch, language, concurrency)) if to_fetch else None
+      async def from_batch(qid, language):
+        return (await batch)[qid]
+      docs_by_qid.update(await engine.gather(**dict([
+        (qid, self._flights.do((qid, language), from_batch if qid in to_fetch else self.depict_images, qid, language))
+        for qid in missing
+      ])))
+      stored_by_qid.update(dict([(qid, now()) for qid in missing]))
+
+    metadata_needed = set([title for docs in docs_by_qid.values() for title in self.metadata_needed(docs, offset, limit)])
+    if len(metadata_needed) > 0:
+      metadata = await self.image_metadata(list(metadata_needed))
+      for qid, docs in docs_by_qid.items():
+        if self.apply_metadata(docs, metadata):
+          await self._enrich_cache(qid, docs, stored_by_qid[qid])
+
+    logger.info(f'commons.search_batch: qids={len(qids)} missing={len(missing)} offset={offset} limit={limit} qtime={round(now()-start, 2)}')
+    return dict([
+      (qid, {'total': len(docs), 'docs': docs, 'stale': now() - stored_by_qid[qid] > CACHE_SOFT_TTL})
+      for qid, docs in docs_by_qid.items()
+    ])
+
 if __name__ == '__main__':
   logger.setLevel(logging.INFO)
   parser = argparse.ArgumentParser(description='Commons client for image search')
@@ -344,5 +524,5 @@ if __name__ == '__main__':
   # parser.add_argument('--qid', help='Wikidata QID', default='Q42')
 
   client = CommonsClient()
-  results = client.search(**vars(parser.parse_args()))
+  results = asyncio.run(client.search(**vars(parser.parse_args())))
   print(json.dumps(results))
\ No newline at end of file
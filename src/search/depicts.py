@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import argparse
+import bisect
+import gzip
+import json
+import mmap
+import os
+import struct
+from array import array
+from time import time as now
+
+# Offline index of depicted entities, built from the Wikidata and Commons entity dumps.
+#
+# Wikidata items contribute one image per P18 value, depicting the item's truthy P180
+# values.  Commons mediainfo entities contribute their file, depicting all P180 values
+# (with a flag for preferred rank) and a digital representation of its P6243 value.  An
+# image is indexed under each truthy P180 value, as the SPARQL queries in commons.py match.
+#
+# File layout (native byte order, sections 8-byte aligned):
+#   header      MAGIC, then key, posting and image counts (uint32)
+#   keys        sorted QID numbers (uint32)
+#   key_offsets start of each key's postings, plus end (uint32)
+#   postings    image numbers (uint32)
+#   img_offsets start of each image record in records, plus end (uint64)
+#   records     per image: flags (uint8, 1 = from Wikidata), dro QID number (uint32, 0 if none),
+#               depicts count (uint16), depicts as QID number * 2 + preferred (uint32 each),
+#               then the file title (utf-8)
+
+MAGIC = b'DEPICTS1'
+HEADER = struct.Struct('=8sIII')
+RECORD = struct.Struct('=BIH')
+FROM_WIKIDATA = 1
+
+def _align(offset):
+  return (offset + 7) & ~7
+
+def _qnum(qid):
+  return int(qid[1:])
+
+def _values(statements, prop):
+  '''(value, rank) of the statements for prop, skipping novalue/somevalue snaks.'''
+  for stmt in statements.get(prop, []):
+    datavalue = stmt.get('mainsnak', {}).get('datavalue')
+    if datavalue:
+      value = datavalue['value']
+      yield (value['id'] if isinstance(value, dict) else value), stmt.get('rank', 'normal')
+
+def _truthy(values):
+  '''Values of best rank, the statements a wdt: triple matches.'''
+  values = [(value, rank) for value, rank in values if rank != 'deprecated']
+  preferred = [value for value, rank in values if rank == 'preferred']
+  return preferred or [value for value, rank in values]
+
+def read_entities(path):
+  '''Entities with P180 statements from a JSON dump (one entity per line, optionally gzipped).'''
+  with (gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, 'r', encoding='utf-8')) as fp:
+    for line in fp:
+      if '"P180"' not in line:
+        continue
+      line = line.strip().rstrip(',')
+      if line.startswith('{'):
+        yield json.loads(line)
+
+def image_records(entity):
+  '''(title, flags, dro, depicts, matched) for the images of an entity, where depicts is a
+  list of (qid, preferred) and matched the QIDs the image is indexed under.'''
+  statements = entity.get('claims') or entity.get('statements') or {}
+  p180 = [(qid, rank) for qid, rank in _values(statements, 'P180') if qid.startswith('Q')]
+  matched = _truthy(p180)
+  if entity.get('type') == 'mediainfo':
+    dro = [qid for qid in _truthy(_values(statements, 'P6243')) if qid.startswith('Q')]
+    depicts = [(qid, rank == 'preferred') for qid, rank in p180]
+    yield entity['title'].split(':', 1)[-1], 0, dro[0] if dro else None, depicts, matched
+  else:
+    for title in _truthy(_values(statements, 'P18')):
+      yield title, FROM_WIKIDATA, None, [(qid, False) for qid in matched], matched
+
+def build_index(dumps, path):
+  '''Builds the index file at path from one or more entity dumps.'''
+  start = now()
+  records = bytearray()
+  img_offsets = array('Q', [0])
+  pairs = array('Q') # QID number << 32 | image number
+  for dump in dumps:
+    for entity in read_entities(dump):
+      for title, flags, dro, depicts, matched in image_records(entity):
+        image = len(img_offsets) - 1
+        records += RECORD.pack(flags, _qnum(dro) if dro else 0, len(depicts))
+        records += array('I', [_qnum(qid) * 2 + preferred for qid, preferred in depicts]).tobytes()
+        records += title.encode('utf-8')
+        img_offsets.append(len(records))
+        for qid in set(matched):
+          pairs.append(_qnum(qid) << 32 | image)
+  pairs = array('Q', sorted(pairs))
+
+  keys, key_offsets, postings = array('I'), array('I'), array('I')
+  for pair in pairs:
+    qnum = pair >> 32
+    if not keys or keys[-1] != qnum:
+      keys.append(qnum)
+      key_offsets.append(len(postings))
+    postings.append(pair & 0xFFFFFFFF)
+  key_offsets.append(len(postings))
+
+  tmp = f'{path}.tmp'
+  with open(tmp, 'wb') as fp:
+    fp.write(HEADER.pack(MAGIC, len(keys), len(postings), len(img_offsets) - 1))
+    for section in (keys, key_offsets, postings, img_offsets, records):
+      fp.write(b'\0' * (_align(fp.tell()) - fp.tell()))
+      fp.write(section if isinstance(section, bytearray) else section.tobytes())
+  os.replace(tmp, path)
+  logger.info(f'build_index: path={path} keys={len(keys)} images={len(img_offsets) - 1} postings={len(postings)} elapsed={round(now()-start, 2)}')
+
+class DepictsIndex(object):
+  '''Read-only, memory-mapped depicts index (see build_index).  Lookups binary search
+  the sorted keys and decode only the records of the matching images.'''
+
+  def __init__(self, path, **kwargs):
+    self.path = path
+    with open(path, 'rb') as fp:
+      self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, n_keys, n_postings, n_images = HEADER.unpack_from(self._mmap, 0)
+    if magic != MAGIC:
+      raise ValueError(f'{path} is not a depicts index')
+    view = memoryview(self._mmap)
+    offset = HEADER.size
+    sections = []
+    for fmt, count in (('I', n_keys), ('I', n_keys + 1), ('I', n_postings), ('Q', n_images + 1)):
+      offset = _align(offset)
+      size = count * struct.calcsize(fmt)
+      sections.append(view[offset:offset + size].cast(fmt))
+      offset += size
+    self._keys, self._key_offsets, self._postings, self._img_offsets = sections
+    self._records = view[_align(offset):]
+
+  def _key(self, qid):
+    try:
+      qnum = _qnum(qid)
+    except ValueError:
+      return None
+    idx = bisect.bisect_left(self._keys, qnum)
+    return idx if idx < len(self._keys) and self._keys[idx] == qnum else None
+
+  def __contains__(self, qid):
+    return self._key(qid) is not None
+
+  def __len__(self):
+    return len(self._keys)
+
+  def images(self, qid):
+    '''Images indexed under qid as dicts with title, from_wikidata, dro (QID or None) and
+    depicts, a list of (QID, preferred).'''
+    idx = self._key(qid)
+    if idx is None:
+      return []
+    return [self._record(self._postings[pos]) for pos in range(self._key_offsets[idx], self._key_offsets[idx + 1])]
+
+  def _record(self, image):
+    start, end = self._img_offsets[image], self._img_offsets[image + 1]
+    flags, dro, n_depicts = RECORD.unpack_from(self._records, start)
+    start += RECORD.size
+    depicts = self._records[start:start + 4 * n_depicts].cast('I')
+    return {
+      'title': bytes(self._records[start + 4 * n_depicts:end]).decode('utf-8'),
+      'from_wikidata': bool(flags & FROM_WIKIDATA),
+      'dro': f'Q{dro}' if dro else None,
+      'depicts': [(f'Q{value >> 1}', bool(value & 1)) for value in depicts]
+    }
+
+  def stats(self):
+    return {'path': self.path, 'keys': len(self._keys), 'images': len(self._img_offsets) - 1}
+
+if __name__ == '__main__':
+  logger.setLevel(logging.INFO)
+  parser = argparse.ArgumentParser(description='Offline depicts index')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+  build = subparsers.add_parser('build', help='Build the index from Wikidata and Commons entity dumps')
+  build.add_argument('dumps', nargs='+', help='JSON entity dumps, optionally gzipped')
+  build.add_argument('--out', help='Index file', default='depicts.idx')
+  lookup = subparsers.add_parser('lookup', help='Images depicting a QID')
+  lookup.add_argument('qid', help='Wikidata QID')
+  lookup.add_argument('--index', help='Index file', default='depicts.idx')
+  args = parser.parse_args()
+
+  if args.command == 'build':
+    build_index(args.dumps, args.out)
+  else:
+    start = now()
+    images = DepictsIndex(args.index).images(args.qid)
+    logger.info(f'lookup: qid={args.qid} images={len(images)} qtime={round((now()-start)*1e6)}us')
+    print(json.dumps(images, indent=2))
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import os, sys
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+import argparse
+import bisect
+import gzip
+import json
+import mmap
+import struct
+import threading
+import unicodedata
+from array import array
+from time import time as now
+
+# Offline index of entity labels and aliases, built from a Wikidata entity dump and, optionally,
+# the labels resolved at runtime as saved in a cache snapshot (see cache/snapshot.py).
+#
+# File layout (native byte order, sections 8-byte aligned):
+#   header      MAGIC, then string, label and term counts and the length of meta (uint32)
+#   meta        JSON object with the indexed languages, in language number order
+#   str_offsets start of each string in strings, plus end (uint64)
+#   labels      label rows sorted by QID number then language, as three columns:
+#               QID number, language number, label string (uint32 each)
+#   terms       term rows sorted by normalized term then QID number, as four columns:
+#               normalized term string, QID number, language number * 2 + alias, label or
+#               alias string (uint32 each)
+#   strings     utf-8, interned
+
+ENTITY_INDEX = os.environ.get('ENTITY_INDEX') # offline entity label index, runtime labels only when unset
+OVERLAY_MAX = 100000    # labels resolved at runtime kept in memory alongside the index
+LOOKUP_SCAN = 1000      # term rows read per lookup from the index and from the overlay, in term order from the prefix
+FALLBACK_LANGUAGE = 'en'
+
+MAGIC = b'ENTITY01'
+HEADER = struct.Struct('=8sIIII')
+
+def _align(offset):
+  return (offset + 7) & ~7
+
+def _qnum(qid):
+  return int(qid[1:])
+
+def normalize(text):
+  '''Case and accent insensitive form of text that terms are indexed and looked up by.'''
+  text = unicodedata.normalize('NFKD', text)
+  return ' '.join(''.join([c for c in text if not unicodedata.combining(c)]).casefold().split())
+
+def read_entities(path):
+  '''Items from a JSON dump (one entity per line, optionally gzipped).'''
+  with (gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, 'r', encoding='utf-8')) as fp:
+    for line in fp:
+      line = line.strip().rstrip(',')
+      if line.startswith('{'):
+        entity = json.loads(line)
+        if entity.get('type') == 'item':
+          yield entity
+
+def entity_terms(entity, languages):
+  '''(qid, language, label, aliases) of an item for each of languages it has a label or aliases in.'''
+  for language in languages:
+    label = entity.get('labels', {}).get(language, {}).get('value')
+    aliases = [alias['value'] for alias in entity.get('aliases', {}).get(language, [])]
+    if label or aliases:
+      yield entity['id'], language, label, aliases
+
+def snapshot_terms(location, languages):
+  '''(qid, language, label, []) of the runtime labels in a cache snapshot.'''
+  from cache.snapshot import decode, open_store
+  data = open_store(location).read()
+  namespaces = decode(data) if data else None
+  for key, label, stored, expires in (namespaces or {}).get('labels', []):
+    language, qid = key.split(':', 1)
+    if label and language in languages and qid[1:].isdigit():
+      yield qid, language, label, []
+
+def build_index(dumps, path, languages=(FALLBACK_LANGUAGE,), snapshot=None):
+  '''Builds the index file at path from entity dumps and the labels of a cache snapshot.
+  Labels from the dumps take precedence.'''
+  start = now()
+  languages = list(languages)
+  strings, string_ids = bytearray(), {}
+  str_offsets = array('Q', [0])
+  def intern(text):
+    if text not in string_ids:
+      string_ids[text] = len(str_offsets) - 1
+      strings.extend(text.encode('utf-8'))
+      str_offsets.append(len(strings))
+    return string_ids[text]
+
+  labels, terms = {}, set()
+  def add(qid, language, label, aliases):
+    qnum, lang = _qnum(qid), languages.index(language)
+    if label and (qnum, lang) not in labels:
+      labels[(qnum, lang)] = label
+      terms.add((normalize(label), qnum, lang * 2, label))
+    for alias in aliases:
+      terms.add((normalize(alias), qnum, lang * 2 + 1, alias))
+
+  for dump in dumps:
+    for entity in read_entities(dump):
+      for rec in entity_terms(entity, languages):
+        add(*rec)
+  if snapshot:
+    for rec in snapshot_terms(snapshot, languages):
+      add(*rec)
+
+  label_qnums, label_langs, label_strs = array('I'), array('I'), array('I')
+  for (qnum, lang), label in sorted(labels.items()):
+    label_qnums.append(qnum)
+    label_langs.append(lang)
+    label_strs.append(intern(label))
+  term_strs, term_qnums, term_langs, term_texts = array('I'), array('I'), array('I'), array('I')
+  for term, qnum, lang, text in sorted(terms): # code point order, the byte order of the utf-8 terms
+    if not term:
+      continue
+    term_strs.append(intern(term))
+    term_qnums.append(qnum)
+    term_langs.append(lang)
+    term_texts.append(intern(text))
+
+  meta = json.dumps({'languages': languages}).encode('utf-8')
+  tmp = f'{path}.tmp'
+  with open(tmp, 'wb') as fp:
+    fp.write(HEADER.pack(MAGIC, len(str_offsets) - 1, len(label_qnums), len(term_strs), len(meta)))
+    fp.write(meta)
+    for section in (str_offsets, label_qnums, label_langs, label_strs, term_strs, term_qnums, term_langs, term_texts, strings):
+      fp.write(b'\0' * (_align(fp.tell()) - fp.tell()))
+      fp.write(section if isinstance(section, bytearray) else section.tobytes())
+  os.replace(tmp, path)
+  logger.info(f'build_index: path={path} languages={languages} labels={len(label_qnums)} terms={len(term_strs)} strings={len(str_offsets) - 1} elapsed={round(now()-start, 2)}')
+
+class EntityIndex(object):
+  '''Read-only, memory-mapped entity label index (see build_index).  Label lookups binary
+  search the QID column, prefix lookups the sorted terms.'''
+
+  def __init__(self, path, **kwargs):
+    self.path = path
+    with open(path, 'rb') as fp:
+      self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, n_strings, n_labels, n_terms, meta_len = HEADER.unpack_from(self._mmap, 0)
+    if magic != MAGIC:
+      raise ValueError(f'{path} is not an entity index')
+    self.languages = json.loads(self._mmap[HEADER.size:HEADER.size + meta_len])['languages']
+    view = memoryview(self._mmap)
+    offset = HEADER.size + meta_len
+    sections = []
+    for fmt, count in [('Q', n_strings + 1)] + [('I', n_labels)] * 3 + [('I', n_terms)] * 4:
+      offset = _align(offset)
+      size = count * struct.calcsize(fmt)
+      sections.append(view[offset:offset + size].cast(fmt))
+      offset += size
+    self._str_offsets, self._label_qnums, self._label_langs, self._label_strs = sections[:4]
+    self._term_strs, self._term_qnums, self._term_langs, self._term_texts = sections[4:]
+    self._strings = view[_align(offset):]
+
+  def _bytes(self, idx):
+    return bytes(self._strings[self._str_offsets[idx]:self._str_offsets[idx + 1]])
+
+  def _string(self, idx):
+    return self._bytes(idx).decode('utf-8')
+
+  def _lang(self, language):
+    return self.languages.index(language) if language in self.languages else None
+
+  def __len__(self):
+    return len(self._label_qnums)
+
+  def label(self, qid, language=FALLBACK_LANGUAGE, fallback=True):
+    '''Label of qid in language, else (with fallback) in the fallback language, None if the
+    index has neither.'''
+    try:
+      qnum = _qnum(qid)
+    except ValueError:
+      return None
+    found = {}
+    pos = bisect.bisect_left(self._label_qnums, qnum)
+    while pos < len(self._label_qnums) and self._label_qnums[pos] == qnum:
+      found[self._label_langs[pos]] = self._label_strs[pos]
+      pos += 1
+    for lang in (self._lang(language), self._lang(FALLBACK_LANGUAGE) if fallback else None):
+      if lang is not None and lang in found:
+        return self._string(found[lang])
+    return None
+
+  def _lower_bound(self, prefix):
+    lo, hi = 0, len(self._term_strs)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._bytes(self._term_strs[mid]) < prefix:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def terms(self, prefix, scan=LOOKUP_SCAN):
+    '''Up to scan (normalized term, QID number, language, alias, text) rows whose term starts
+    with prefix, a normalized term, in term order.'''
+    key = prefix.encode('utf-8')
+    pos = self._lower_bound(key)
+    for pos in range(pos, min(pos + scan, len(self._term_strs))):
+      term = self._bytes(self._term_strs[pos])
+      if not term.startswith(key):
+        break
+      lang = self._term_langs[pos]
+      yield term.decode('utf-8'), self._term_qnums[pos], self.languages[lang >> 1], bool(lang & 1), self._string(self._term_texts[pos])
+
+  def stats(self):
+    return {'path': self.path, 'languages': self.languages, 'labels': len(self._label_qnums), 'terms': len(self._term_strs)}
+
+class EntityLabels(object):
+  '''QID to label and label prefix lookups over the offline index and the labels resolved
+  at runtime, without network calls.
+
+  Runtime labels are kept in an in-memory overlay of up to overlay_max labels, oldest
+  dropped first, searched alongside the index.'''
+
+  def __init__(self, path=ENTITY_INDEX, overlay_max=OVERLAY_MAX, **kwargs):
+    self.index = EntityIndex(path) if path else None
+    self.overlay_max = overlay_max
+    self._overlay = {} # (language, qid) -> label
+    self._terms = []   # sorted (normalized label, QID number, language) of the overlay
+    self._lock = threading.Lock()
+    self.counters = {'hits': 0, 'misses': 0, 'lookups': 0, 'added': 0}
+
+  def add(self, labels, language=FALLBACK_LANGUAGE):
+    '''Adds runtime labels, a dict of QID to label, not already in the index.'''
+    with self._lock:
+      for qid, label in labels.items():
+        if not label or not qid[1:].isdigit() or self._overlay.get((language, qid)) == label:
+          continue
+        if (language, qid) not in self._overlay and self.index is not None and self.index.label(qid, language, fallback=False) == label:
+          continue
+        self._forget((language, qid))
+        while len(self._overlay) >= self.overlay_max:
+          self._forget(next(iter(self._overlay)))
+        self._overlay[(language, qid)] = label
+        bisect.insort(self._terms, (normalize(label), _qnum(qid), language))
+        self.counters['added'] += 1
+
+  def _forget(self, key):
+    label = self._overlay.pop(key, None)
+    if label is not None:
+      language, qid = key
+      term = (normalize(label), _qnum(qid), language)
+      pos = bisect.bisect_left(self._terms, term)
+      if pos < len(self._terms) and self._terms[pos] == term:
+        del self._terms[pos]
+
+  def _label(self, qid, language, fallback=True):
+    label = self._overlay.get((language, qid))
+    if label is None and self.index is not None:
+      label = self.index.label(qid, language, fallback)
+    return label
+
+  def label(self, qid, language=FALLBACK_LANGUAGE, fallback=True):
+    '''Label of qid in language, else (with fallback) in the fallback language, None if
+    neither is known.'''
+    label = self._label(qid, language, fallback)
+    self.counters['hits' if label is not None else 'misses'] += 1
+    return label
+
+  def indexed_label(self, qid, language=FALLBACK_LANGUAGE, fallback=True):
+    '''Label of qid in the offline index only.  Runtime labels are not consulted as they
+    do not expire.'''
+    label = self.index.label(qid, language, fallback) if self.index is not None else None
+    self.counters['hits' if label is not None else 'misses'] += 1
+    return label
+
+  def labels(self, qids, language=FALLBACK_LANGUAGE):
+    '''Labels of the QIDs found, by QID.'''
+    labels = {}
+    for qid in set(qids):
+      label = self.label(qid, language)
+      if label is not None:
+        labels[qid] = label
+    return labels
+
+  def _overlay_terms(self, prefix):
+    with self._lock:
+      pos = bisect.bisect_left(self._terms, (prefix,))
+      rows = self._terms[pos:pos + LOOKUP_SCAN]
+    for term, qnum, language in rows:
+      if not term.startswith(prefix):
+        break
+      yield term, qnum, language, False, self._overlay.get((language, f'Q{qnum}'), term)
+
+  def lookup(self, q, language=FALLBACK_LANGUAGE, limit=10):
+    '''Entities with a label or alias in language, or the fallback language, starting with q
+    (case and accent insensitive).  Exact matches rank first, then labels before aliases,
+    the requested language before the fallback, shorter terms and lower QIDs.'''
+    start = now()
+    self.counters['lookups'] += 1
+    prefix = normalize(q)
+    if not prefix:
+      return []
+    best = {}
+    rows = list(self._overlay_terms(prefix))
+    if self.index is not None:
+      rows += list(self.index.terms(prefix))
+    for term, qnum, term_language, alias, text in rows:
+      if term_language not in (language, FALLBACK_LANGUAGE):
+        continue
+      rank = (term != prefix, alias, term_language != language, len(term), qnum)
+      if qnum not in best or rank < best[qnum][0]:
+        best[qnum] = (rank, text)
+    results = []
+    for rank, text in sorted(best.values())[:limit]:
+      qid = f'Q{rank[-1]}'
+      results.append({'id': qid, 'label': self._label(qid, language) or text, 'match': text})
+    logger.debug(f'lookup: q={q} language={language} rows={len(rows)} results={len(results)} qtime={round((now()-start)*1e6)}us')
+    return results
+
+  def stats(self):
+    return {
+      **self.counters,
+      'overlay': len(self._overlay),
+      'index': self.index.stats() if self.index is not None else None
+    }
+
+entities = EntityLabels()
+
+if __name__ == '__main__':
+  logger.setLevel(logging.INFO)
+  parser = argparse.ArgumentParser(description='Offline entity label index')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+  build = subparsers.add_parser('build', help='Build the index from Wikidata entity dumps')
+  build.add_argument('dumps', nargs='*', help='JSON entity dumps, optionally gzipped')
+  build.add_argument('--out', help='Index file', default='entities.idx')
+  build.add_argument('--languages', help='Comma-separated label languages', default=FALLBACK_LANGUAGE)
+  build.add_argument('--snapshot', help='Cache snapshot (local path, gs:// or s3:// location) with runtime labels to include')
+  lookup = subparsers.add_parser('lookup', help='Entities with a label or alias starting with a prefix')
+  lookup.add_argument('q', help='Label prefix')
+  lookup.add_argument('--language', help='Label language', default=FALLBACK_LANGUAGE)
+  lookup.add_argument('--limit', help='Max results', type=int, default=10)
+  lookup.add_argument('--index', help='Index file', default='entities.idx')
+  label = subparsers.add_parser('label', help='Labels of QIDs')
+  label.add_argument('qids', help='Wikidata QIDs', nargs='+')
+  label.add_argument('--language', help='Label language', default=FALLBACK_LANGUAGE)
+  label.add_argument('--index', help='Index file', default='entities.idx')
+  args = parser.parse_args()
+
+  if args.command == 'build':
+    languages = [language.strip() for language in args.languages.split(',') if language.strip()]
+    if FALLBACK_LANGUAGE not in languages:
+      languages.append(FALLBACK_LANGUAGE)
+    build_index(args.dumps, args.out, languages, args.snapshot)
+  else:
+    service = EntityLabels(args.index)
+    start = now()
+    results = service.lookup(args.q, args.language, args.limit) if args.command == 'lookup' else service.labels(args.qids, args.language)
+    logger.info(f'{args.command}: results={len(results)} qtime={round((now()-start)*1e6)}us')
+    print(json.dumps(results, indent=2, ensure_ascii=False))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import asyncio
+from collections import deque
+from time import time as now
+
+HEALTH_WINDOW = 20      # recent outcomes kept per strategy
+HEALTH_MIN_SAMPLES = 5  # outcomes needed before a strategy is judged healthy or unhealthy
+HEALTHY_RATE = 0.9      # success rate at or above which a strategy is healthy
+UNHEALTHY_RATE = 0.5    # success rate below which a strategy is unhealthy
+PROBE_INTERVAL = 60     # seconds between attempts of an unhealthy strategy
+
+class StrategyHealth(object):
+  '''Rolling success rate and latency of one strategy for answering a query.
+
+  A strategy is healthy or unhealthy once its success rate over the last window
+  outcomes crosses the thresholds, and uncertain before that or in between.  An
+  unhealthy strategy is due a probe every probe_interval seconds so it can
+  recover.'''
+
+  def __init__(self, name, window=HEALTH_WINDOW, probe_interval=PROBE_INTERVAL, **kwargs):
+    self.name = name
+    self.probe_interval = probe_interval
+    self._outcomes = deque(maxlen=window) # (ok, elapsed)
+    self._last_attempt = 0
+    self.counters = {'attempts': 0, 'failures': 0, 'cancelled': 0, 'probes': 0}
+
+  def record(self, ok, elapsed):
+    self._outcomes.append((ok, elapsed))
+    if not ok:
+      self.counters['failures'] += 1
+
+  def success_rate(self):
+    return sum(ok for ok, _ in self._outcomes) / len(self._outcomes) if self._outcomes else None
+
+  @property
+  def state(self):
+    if len(self._outcomes) < HEALTH_MIN_SAMPLES:
+      return 'uncertain'
+    rate = self.success_rate()
+    return 'healthy' if rate >= HEALTHY_RATE else 'unhealthy' if rate < UNHEALTHY_RATE else 'uncertain'
+
+  def probe_due(self):
+    '''True, at most once per probe_interval, when an unhealthy strategy should be tried.'''
+    if now() - self._last_attempt < self.probe_interval:
+      return False
+    self.counters['probes'] += 1
+    return True
+
+  async def run(self, fn, *args, **kwargs):
+    '''Awaits fn, recording the outcome.  A None result or an exception is a failure,
+    returned as None.  A cancelled attempt, e.g. the loser of a race, is not an outcome.'''
+    start = now()
+    self._last_attempt = start
+    self.counters['attempts'] += 1
+    try:
+      result = await fn(*args, **kwargs)
+    except asyncio.CancelledError:
+      self.counters['cancelled'] += 1
+      raise
+    except Exception as exc:
+      logger.warning(f'{self.name}: failed: {exc}')
+      result = None
+    self.record(result is not None, now() - start)
+    return result
+
+  def stats(self):
+    latencies = sorted([elapsed for ok, elapsed in self._outcomes if ok])
+    rate = self.success_rate()
+    return {
+      **self.counters,
+      'state': self.state,
+      'success_rate': round(rate, 3) if rate is not None else None,
+      'p50_ms': round(latencies[len(latencies)//2] * 1000) if latencies else None
+    }
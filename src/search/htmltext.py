@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+from functools import lru_cache
+
+from lxml import etree
+import lxml.html
+
+from bs4 import BeautifulSoup
+
+def extract_text_html5lib(val, lang='en'):
+  '''Reference implementation, builds a full html5lib tree.'''
+  soup = BeautifulSoup(val, 'html5lib')
+  _elem = soup.select_one(f'[lang="{lang}"]')
+  return (_elem.text if _elem else soup.text).strip()
+
+@lru_cache(maxsize=20000)
+def extract_text(val, lang='en'):
+  '''Text of an HTML fragment such as a Commons extmetadata value.  If an element with
+  a matching lang attribute exists the text of the first one is returned, otherwise
+  the text of the whole fragment.  Results are memoized by (val, lang).'''
+  if '<' not in val and '&' not in val:
+    return val.strip()
+  try:
+    root = lxml.html.fragment_fromstring(val, create_parent='div')
+  except (etree.ParserError, ValueError):
+    return extract_text_html5lib(val, lang)
+  for elem in root.iter(etree.Element):
+    if elem.get('lang') == lang:
+      return elem.text_content().strip()
+  return root.text_content().strip()
@@ -6,24 +6,29 @@ logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(messa
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-import os
+import os, sys
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 BASEDIR = SCRIPT_DIR
+sys.path.append(os.path.dirname(SCRIPT_DIR))
 
 import argparse
+import asyncio
 import json
 import re
-import traceback
 from time import time as now
 from urllib.parse import quote
 
-import concurrent.futures
+from upstream import engine
+from cache import open_cache
 
-import requests
-logging.getLogger('requests').setLevel(logging.WARNING)
-
-import dill
-from expiringdict import ExpiringDict
+try:
+  from .labels import labels
+  from .pipeline import Pipeline
+  from .singleflight import SingleFlight
+except:
+  from labels import labels
+  from pipeline import Pipeline
+  from singleflight import SingleFlight
 
 rights = {
   'Creative Commons: Free Reuse (CC0)': 'https://creativecommons.org/publicdomain/zero/1.0/',
@@ -35,88 +40,65 @@ rights = {
   'Creative Commons: Attribution-NonCommercial-NoDerivs': 'https://creativecommons.org/licenses/by-nc-nd/4.0/'
 }
 
+BATCH_CONCURRENCY = 8  # QIDs searched concurrently in batch searches
+CACHE_SOFT_TTL = 1800  # results older than this are served stale and refreshed in the background
+CACHE_HARD_TTL = 86400 # results older than this are dropped
+CACHE_MEMORY_BYTES = int(os.environ.get('SEARCH_CACHE_MEMORY_MB', 64)) * 2**20  # per source, in-memory tier
+CACHE_DISK_BYTES = int(os.environ.get('SEARCH_CACHE_DISK_MB', 1024)) * 2**20    # per source, on-disk tier
+STAGES_TTL = CACHE_HARD_TTL # query stages live as long as the results paged with them
+
 class JSTORClient(object):
 
   def __init__(self, **kwargs):
-    try:
-      self._cache = dill.load(open('jstor.cache', 'rb'))
-    except:
-      self._cache = ExpiringDict(max_len=100, max_age_seconds=1800) # cache images for 30 minutes
+    self._cache = open_cache('jstor', max_len=None, max_age_seconds=CACHE_HARD_TTL, memory_bytes=CACHE_MEMORY_BYTES, disk_bytes=CACHE_DISK_BYTES)
+    self._flights = SingleFlight()
+    self._stale_counters = {'fresh': 0, 'stale': 0}
+    self._stages = open_cache('jstor-stages', max_len=10000, max_age_seconds=STAGES_TTL)
+    self._stage_counters = {'hits': 0, 'misses': 0}
+    self._stage_flights = SingleFlight() # query stage lookups, coalesced per QID across pages and searches
+    self._stage_timings = {}
     self.labs_api_token = os.environ.get("LABS_API_TOKEN")
 
-  def _update_cache(self, key, data):
-    self._cache[key] = data
-    dill.dump(self._cache, open('jstor.cache', 'wb'))
+  async def _update_cache(self, key, data):
+    await self._cache.aset(key, data)
+
+  async def cached_results(self, qid):
+    '''Returns (results, stored) from the cache, or (None, None).  Entries past the soft TTL
+    are still returned, and a background refresh of the first page is started for them.'''
+    entry = await self._cache.aget_entry(qid)
+    if entry is None:
+      return None, None
+    results, stored = entry
+    if now() - stored > CACHE_SOFT_TTL:
+      self._stale_counters['stale'] += 1
+      self._flights.spawn((qid, None), self.next_page, qid, None)
+    else:
+      self._stale_counters['fresh'] += 1
+    return results, stored
 
   def jstor_depict_images(self, qid):
     docs = []
     # TODO
     return docs
 
-  def get_labels(self, qids, language='en'):
-    labels = {}
-    values = ' '.join([f'(<http://www.wikidata.org/entity/{qid}>)' for qid in qids])
-    query = f'SELECT ?item ?label WHERE {{ VALUES (?item) {{ {values} }} ?item rdfs:label ?label . FILTER (LANG(?label) = "{language}" || LANG(?label) = "en") .}}'
-    resp = requests.post(
-      'https://query.wikidata.org/sparql',
-      headers = {
-        'Content-Type': 'application/x-www-form-urlencoded', 
-        'Accept': 'application/sparql-results+json',
-        'User-Agent': 'Labs Client'
-      },
-      data={'query': query}
-    )
-    if resp.status_code == 200:
-      labels = dict([(rec['item']['value'].split('/')[-1],rec['label']['value']) for rec in resp.json()['results']['bindings']])
-      for qid in qids:
-        if qid not in labels:
-          labels[qid] = ''
-    return labels
-
-  def add_labels(self, docs, language='en'):
-    labels = self._cache.get(f'{language}-labels', {})
-    
-    qids = set([])
-    for doc in docs:
-      for fld in ('depicts', 'digital_representation_of'):
-        if fld in doc:
-          recs = doc[fld] if isinstance(doc[fld],list) else [doc[fld]]
-          for rec in recs:
-            if rec['id'] not in labels:
-              qids.add(rec['id'])
-    if len(qids) > 0:
-      labels = {**labels, **self.get_labels(qids, language)}
-      self._update_cache(f'{language}-labels', labels)
-
-    for doc in docs:
-      if 'digital_representation_of' in doc and doc['digital_representation_of']['id'] in labels:
-        doc['digital_representation_of']['label'] = labels[doc['digital_representation_of']['id']]
-      if 'depicts' in doc:
-        recs = doc['depicts'] if isinstance(doc['depicts'],list) else [doc['depicts']]
-        for rec in recs:
-          if rec['id'] in labels:
-            rec['label'] = labels[rec['id']]
-    return docs
-
-  def get_wd_entity(self, qid):
-    resp = requests.get(f'https://www.wikidata.org/wiki/Special:EntityData/{qid}.json')
+  async def get_wd_entity(self, qid):
+    resp = await engine.get(f'https://www.wikidata.org/wiki/Special:EntityData/{qid}.json')
     if resp.status_code == 200:
       results = resp.json()
       return results['entities'][qid] if qid in results['entities'] else {}
   
-  def get_jstor_items(self, dois):
+  async def get_jstor_items(self, dois):
     search_args = {
       'query': f'doi:({" OR ".join(dois)})',
       'limit': len(dois),
       'filter_queries': [],
       'tokens': ['16124', '24905214', '25794673', '24905191', '25794673', '24905216']
     }
-    resp = requests.post(
+    resp = await engine.post(
       'https://www.jstor.org/api/labs-search-service/jstor/basic/',
       headers = {
         'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'User-Agent': 'Labs client'
+        'Accept': 'application/json'
       },
       json = search_args
     )
@@ -153,14 +135,13 @@ class JSTORClient(object):
   #LIMIT 50
   '''
 
-  def get_depicts_dois_labs(self, qid):
+  async def get_depicts_dois_labs(self, qid):
     dois = []
-    resp = requests.post(
+    resp = await engine.post(
       'https://www.jstor.org/api/labs-search-service/labs/about/',
       headers = {
         'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'User-Agent': 'Labs client'
+        'Accept': 'application/json'
       },
       json = {
         'query': {
@@ -180,16 +161,15 @@ class JSTORClient(object):
     logger.info(f'get_depicts_dois_labs: status={resp.status_code} dois={dois}')
     return dois
 
-  def get_depicts_dois_wikidata(self, qid):
+  async def get_depicts_dois_wikidata(self, qid):
     dois = []
     query = f'SELECT ?jstorId WHERE {{ ?entity wdt:P10187 ?jstorId ; wdt:P180 wd:{qid} . }}'
     logger.info(query)
-    resp = requests.get(
+    resp = await engine.get(
       f'https://query.wikidata.org/sparql?query={quote(query)}',
       headers = {
         'Content-Type': 'application/x-www-form-urlencoded', 
-        'Accept': 'application/sparql-results+json',
-        'User-Agent': 'Labs Client'
+        'Accept': 'application/sparql-results+json'
       }
     )
     if resp.status_code == 200:
@@ -197,17 +177,16 @@ class JSTORClient(object):
     logger.info(f'get_depicts_dois_wikidata: status={resp.status_code} dois={len(dois)}')
     return dois
 
-  def get_depicts_items_labs(self, ids):
+  async def get_depicts_items_labs(self, ids):
     depicts = {}
     dro = {}
     ids = '" OR "'.join([doi.replace('10.2307/','') for doi in ids])
     query =  f'id:("{ids}") AND statements.P854.mainsnak.datavalue.value:(jstor or https://www.jstor.org)'
-    resp = requests.post(
+    resp = await engine.post(
       'https://www.jstor.org/api/labs-search-service/labs/about/',
       headers = {
         'Content-Type': 'application/json',
         'Accept': 'application/json',
-        'User-Agent': 'Labs client',
         #'Authorization': f'Bearer {self.labs_api_token}'
       },
       json = {
@@ -238,7 +217,7 @@ class JSTORClient(object):
     logger.info(f'get_depicts_items_labs: status={resp.status_code} items={len(depicts)}')
     return depicts, dro
 
-  def get_depicts_items_wikidata(self, ids):
+  async def get_depicts_items_wikidata(self, ids):
     depicts = {}
     dro = {}
     jstorid_filter = ', '.join([f'"{id}"' for id in ids])
@@ -248,12 +227,11 @@ class JSTORClient(object):
                 wdt:P180 ?depicts .
         FILTER(?jstorId IN (%s))
       }''' % (jstorid_filter)
-    resp = requests.get(
+    resp = await engine.get(
       f'https://query.wikidata.org/sparql?query={quote(query)}',
       headers = {
         'Content-Type': 'application/x-www-form-urlencoded', 
-        'Accept': 'application/sparql-results+json',
-        'User-Agent': 'Labs Client'
+        'Accept': 'application/sparql-results+json'
       }
     )
     if resp.status_code == 200:
@@ -267,12 +245,11 @@ class JSTORClient(object):
     logger.info(f'get_depicts_items_wikidata: status={resp.status_code} items={len(depicts)}')
     return depicts, dro
 
-  def get_related_entities(self, docid, source='jstor'):
+  async def get_related_entities(self, docid, source='jstor'):
     query = f'id:"{docid}" AND statements.P854.mainsnak.datavalue.value:"{source}"'
-    resp = requests.post(
+    resp = await engine.post(
       'https://www.jstor.org/api/labs-search-service/labs/about/',
       headers = {
-        'User-Agent': 'Labs client',
         'Content-Type': 'application/json',
         'Accept': 'application/json',
         'Authorization': f'Bearer {os.environ.get("JSTOR_API_KEY")}'
@@ -293,7 +270,7 @@ class JSTORClient(object):
               })
     return related
 
-  def jstor_image_search(self, query, limit=10, page_mark=None, filter_queries=None):
+  async def jstor_image_search(self, query, limit=10, page_mark=None, filter_queries=None):
     results = {}
     search_args = {
       'query': query,
@@ -306,12 +283,11 @@ class JSTORClient(object):
       search_args['page_mark'] = page_mark
     if filter_queries:
       search_args['filter_queries'] += filter_queries
-    resp = requests.post(
+    resp = await engine.post(
       'https://www.jstor.org/api/labs-search-service/jstor/basic/',
       headers = {
         'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'User-Agent': 'Labs client'
+        'Accept': 'application/json'
       },
       json = search_args
     )
@@ -337,67 +313,40 @@ class JSTORClient(object):
       transformed.append(doc)
     return transformed
 
-  def jstor_search(self, qid, page_mark=None):
-    results = {'total': 0, 'docs': [], 'page_mark': ''}
-
-    entity = None
-    depicts_dois = set()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-      futures = {}
-      futures[executor.submit(self.get_wd_entity, qid)] = 'wikidata_entity'
-      futures[executor.submit(self.get_depicts_dois_labs, qid)] = 'depicts_dois_labs'
-      futures[executor.submit(self.get_depicts_dois_wikidata, qid)] = 'depicts_dois_wikidata'
-
-      for future in concurrent.futures.as_completed(futures):
-        source = futures[future]
-        try:
-          if source == 'wikidata_entity': entity = future.result()
-          elif source.startswith('depicts_dois'): depicts_dois.update(future.result())
-        except Exception as exc:
-          logger.warning('%r generated an exception: %s' % (source, exc))
-          logger.info(traceback.format_exc())
-
-    depicts_dois = list(depicts_dois)
-    # query expression for metadata search using entity label and aliases
-    label = entity['labels'].get('en',{}).get('value')
-    label = f'"{label}"' if ' ' in label else label
+  def metadata_search_query(self, entity):
+    '''Query expression for metadata search using entity label and aliases.'''
+    entity_label = entity['labels'].get('en',{}).get('value')
+    entity_label = f'"{entity_label}"' if ' ' in entity_label else entity_label
     aliases = [f'"{alias["value"]}"' if ' ' in alias['value'] else alias['value'] for alias in entity.get('aliases',{}).get('en',[]) if alias['language'] == 'en']
-    metadata_search_query = f'{label}^10'
+    metadata_search_query = f'{entity_label}^10'
     for alias in aliases:
       next_term = f' OR {alias}'
       if (len(metadata_search_query) + len(next_term)) < 250:
         metadata_search_query += next_term
       else:
         break
-    
-      # query expression for dois associated with items that depict qid
-      joined_dois = '" OR "'.join(depicts_dois)
-      depicts_dois_query = f'doi:("{joined_dois}")'
-      depicts_dois_exclude_query = f'-doi:("{joined_dois}")'
-    
-    metadata_search_results = {'total':0, 'results':[]}
-    depicts_dois_search_results = {'total':0, 'results':[]}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-      futures = {}
-      futures[executor.submit(self.jstor_image_search, metadata_search_query, 100, page_mark, filter_queries=[depicts_dois_exclude_query])] = 'metadata_search_query'
-      if page_mark is None: futures[executor.submit(self.jstor_image_search, '*:*', 500, filter_queries=[depicts_dois_query])] = 'depicts_dois_query'
-
-      for future in concurrent.futures.as_completed(futures):
-        source = futures[future]
-        try:
-          if source == 'metadata_search_query': metadata_search_results = future.result()
-          elif source == 'depicts_dois_query': depicts_dois_search_results = future.result()
-        except Exception as exc:
-          logger.warning('%r generated an exception: %s' % (source, exc))
-          logger.info(traceback.format_exc())
-
-    # logger.info(f'metadata_search_results={metadata_search_results is not None} depicts_dois_search_results={depicts_dois_search_results is not None}')
-    
-    docs = self.transform_results_docs(depicts_dois_search_results['results'], 1) + self.transform_results_docs(metadata_search_results['results'])
-    docs = sorted(docs, key=lambda doc: doc['weight'], reverse=True)
+    return {'label': entity_label, 'aliases': aliases, 'metadata_search_query': metadata_search_query}
+
+  def depicts_dois_queries(self, depicts_dois_labs, depicts_dois_wikidata):
+    '''Query expressions for dois associated with items that depict the entity.'''
+    depicts_dois = list(set(depicts_dois_labs) | set(depicts_dois_wikidata))
+    joined_dois = '" OR "'.join(depicts_dois)
+    return {
+      'depicts_dois': depicts_dois,
+      'depicts_dois_query': f'doi:("{joined_dois}")',
+      'depicts_dois_exclude_query': f'-doi:("{joined_dois}")'
+    }
 
-    depicts_items_labs, dro_items_labs = self.get_depicts_items_labs([doc['id'].replace('jstor:','10.2307/') for doc in docs])
-    depicts_items_wd, dro_items_wd = self.get_depicts_items_wikidata([doc['id'].replace('jstor:community.','') for doc in docs])
+  async def depicts_items(self, docs):
+    '''Depicted entities (QID -> prominent) and digital representation of, by DOI, for docs.'''
+    if not docs:
+      return {}, {}
+    found = await engine.gather(
+      labs=self.get_depicts_items_labs([doc['id'].replace('jstor:','10.2307/') for doc in docs]),
+      wikidata=self.get_depicts_items_wikidata([doc['id'].replace('jstor:community.','') for doc in docs])
+    )
+    depicts_items_labs, dro_items_labs = found.get('labs', ({}, {}))
+    depicts_items_wd, dro_items_wd = found.get('wikidata', ({}, {}))
 
     depicts_items = {}
     for doi, depicts in depicts_items_wd.items():
@@ -409,57 +358,175 @@ class JSTORClient(object):
         depicts_items[doi].update(dict([(d['id'], d.get('prominent', False)) for d in depicts]))
       else:
         depicts_items[doi] = dict([(d['id'], d.get('prominent', False)) for d in depicts])
-    dro_items = {**dro_items_wd, **dro_items_labs}
+    return depicts_items, {**dro_items_wd, **dro_items_labs}
 
-    logger.info(depicts_items)
+  def apply_depicts_items(self, qid, docs, depicts_items, dro_items):
     for doc in docs:
       doi = doc['id'].replace('jstor:','10.2307/')
-      logger.info(f'{doi} {doi in depicts_items}')
       if doi in depicts_items:
-        doc['depicts'] = [{'id': qid, 'prominent': depicts_items[doi][qid]} for qid in depicts_items[doi]]
+        doc['depicts'] = [{'id': depicts_qid, 'prominent': depicts_items[doi][depicts_qid]} for depicts_qid in depicts_items[doi]]
         doc['weight'] = 3 if depicts_items[doi].get(qid) else 2
       if doi in dro_items:
         doc['digital_representation_of'] = dro_items[doi]
         doc['weight'] = 4 if dro_items[doi]['id'] == qid else 3
-    self.add_labels(docs)
+    return docs
+
+  def search_pipeline(self, qid, page_mark=None, label=True, stages=None):
+    '''The stages of a search as a Pipeline.  The searches need the query stages (entity
+    label and aliases, depicts DOIs), unless the cached stages are given, each search's
+    docs are enriched with depicted entities as soon as the search returns, and labels
+    are added once docs are merged.  The upstream lookups of the query stages are
+    coalesced per QID, so concurrent searches of a QID (first pages and later pages
+    whose stages are no longer cached) share them.'''
+    no_results = {'total': 0, 'results': []}
+    pipeline = Pipeline('jstor_search')
+
+    if stages:
+      pipeline.value('metadata_query', stages).value('dois_queries', stages)
+    else:
+      pipeline.add('entity', lambda: self._stage_flights.do(('entity', qid), self.get_wd_entity, qid))
+      pipeline.add('depicts_dois_labs', lambda: self._stage_flights.do(('depicts_dois_labs', qid), self.get_depicts_dois_labs, qid), default=[])
+      pipeline.add('depicts_dois_wikidata', lambda: self._stage_flights.do(('depicts_dois_wikidata', qid), self.get_depicts_dois_wikidata, qid), default=[])
+      pipeline.add('metadata_query', self.metadata_search_query, ['entity'])
+      pipeline.add('dois_queries', self.depicts_dois_queries, ['depicts_dois_labs', 'depicts_dois_wikidata'])
+      pipeline.add('stages', lambda metadata_query, dois_queries: self._stages.aset(qid, {**metadata_query, **dois_queries}), ['metadata_query', 'dois_queries'])
+
+    pipeline.add('metadata_search',
+      lambda metadata_query, dois_queries: self.jstor_image_search(metadata_query['metadata_search_query'], 100, page_mark, filter_queries=[dois_queries['depicts_dois_exclude_query']]),
+      ['metadata_query', 'dois_queries'], default=no_results)
+    if page_mark is None:
+      pipeline.add('dois_search',
+        lambda dois_queries: self.jstor_image_search('*:*', 500, filter_queries=[dois_queries['depicts_dois_query']]) if dois_queries['depicts_dois'] else no_results,
+        ['dois_queries'], default=no_results)
+    else:
+      pipeline.value('dois_search', no_results)
+
+    pipeline.add('metadata_docs', lambda results: self.transform_results_docs(results.get('results', [])), ['metadata_search'])
+    pipeline.add('dois_docs', lambda results: self.transform_results_docs(results.get('results', []), 1), ['dois_search'])
+    pipeline.add('metadata_items', self.depicts_items, ['metadata_docs'], default=({}, {}))
+    pipeline.add('dois_items', self.depicts_items, ['dois_docs'], default=({}, {}))
+    pipeline.add('docs',
+      lambda dois_docs, metadata_docs, dois_items, metadata_items: self.apply_depicts_items(
+        qid, dois_docs + metadata_docs, {**metadata_items[0], **dois_items[0]}, {**metadata_items[1], **dois_items[1]}),
+      ['dois_docs', 'metadata_docs', 'dois_items', 'metadata_items'])
+    if label:
+      pipeline.add('labels', labels.add_labels, ['docs'])
+    return pipeline
+
+  async def jstor_search(self, qid, page_mark=None, label=True):
+    start = now()
+    # the first page rebuilds the query stages, later pages reuse the stages their page_mark came from
+    stages = await self._stages.aget(qid) if page_mark is not None else None
+    self._stage_counters['hits' if stages else 'misses'] += 1
+    pipeline = self.search_pipeline(qid, page_mark, label, stages)
+    stages = await pipeline.run()
+    for name, (stage_start, stage_end) in pipeline.timings.items():
+      timing = self._stage_timings.setdefault(name, {'count': 0, 'total': 0, 'max': 0})
+      timing['count'] += 1
+      timing['total'] += stage_end - stage_start
+      timing['max'] = max(timing['max'], stage_end - stage_start)
 
     results = {
-      'total': metadata_search_results['total'] + depicts_dois_search_results['total'],
-      'docs': docs,
-      'page_mark': metadata_search_results.get('paging',{}).get('next')
+      'total': stages['metadata_search'].get('total', 0) + stages['dois_search'].get('total', 0),
+      'docs': stages['docs'],
+      'page_mark': stages['metadata_search'].get('paging',{}).get('next')
     }
-    # logger.info(f'jstor_search: qid={qid} limit={limit} page_mark={page_mark} total={results["total"]} dois={len(results["docs"])}')
- 
+    logger.info(f'jstor_search: qid={qid} page_mark={page_mark} total={results["total"]} docs={len(results["docs"])} timings={pipeline.timings} qtime={round(now()-start, 2)}')
     return results
 
-  def search(self, qid, offset=0, limit=10, refresh=False, **kwargs):
+  async def next_page(self, qid, results=None, stored=None, label=True):
+    '''Fetches the page of results following results (or the first page) and caches the combined results.
+    Further pages keep the stored time of the results they extend, and are not cached if a refresh
+    has replaced those results in the meantime.'''
+    current_results = await self.jstor_search(qid, results['page_mark'] if results else None, label)
+    current_results['docs'] = sorted(current_results['docs'], key=lambda doc: doc['weight'], reverse=True)
+    if results:
+      entry = await self._cache.aget_entry(qid)
+      extended = {**results, 'docs': results['docs'] + current_results['docs'], 'page_mark': current_results['page_mark']}
+      if entry is not None and entry[1] <= stored:
+        await self._cache.aset(qid, extended, stored=stored)
+      return extended
+    await self._update_cache(qid, current_results)
+    return current_results
+
+  async def first_pages(self, qids, concurrency=BATCH_CONCURRENCY):
+    '''Fetches the first page of results for several QIDs with bounded concurrency,
+    labelling the docs of all QIDs in one pass.'''
+    semaphore = asyncio.Semaphore(concurrency)
+    async def fetch(qid):
+      async with semaphore:
+        return await self.jstor_search(qid, label=False)
+    results_by_qid = await engine.gather(**dict([(qid, fetch(qid)) for qid in qids]))
+
+    await labels.add_labels([doc for results in results_by_qid.values() for doc in results['docs']])
+    for qid, results in results_by_qid.items():
+      results['docs'] = sorted(results['docs'], key=lambda doc: doc['weight'], reverse=True)
+    await engine.gather(**dict([(qid, self._update_cache(qid, results)) for qid, results in results_by_qid.items()]))
+    return results_by_qid
+
+  def stats(self):
+    return {
+      'singleflight': self._flights.stats(),
+      'cache': {**self._stale_counters, **self._cache.stats()},
+      'stages': {**self._stage_counters, 'singleflight': self._stage_flights.stats()},
+      'pipeline': dict([
+        (name, {'count': timing['count'], 'mean_ms': round(timing['total'] / timing['count'] * 1000), 'max_ms': round(timing['max'] * 1000)})
+        for name, timing in self._stage_timings.items()
+      ])
+    }
+
+  async def search(self, qid, offset=0, limit=10, refresh=False, label=True, **kwargs):
+    '''JSTOR results for qid.  With label false, pages fetched for this search are cached
+    without depicts labels, saving the label round trip.'''
     start = now()
-    results = self._cache.get(qid) if (not refresh or offset > 0) else None
+    results, stored = await self.cached_results(qid) if (not refresh or offset > 0) else (None, None)
     from_cache = results is not None
     docs_needed = offset+limit
     docs_available = len(results['docs']) if results else 0
     # logger.info(f'fromCache={from_cache} docs_needed={docs_needed} docs_available={docs_available} total={results["total"] if results else 0}')
   
     if results is None or (docs_needed > docs_available and docs_available < results['total']):
+      # JSTOR results are not language specific, concurrent requests are coalesced per page of upstream results
       page_mark = results['page_mark'] if results else None
-      current_results = self.jstor_search(qid, page_mark)
-      current_results['docs'] = sorted(current_results['docs'], key=lambda doc: doc['weight'], reverse=True)
-      self.add_labels(current_results['docs'])
-      if results:
-        results['docs'] += current_results['docs']
-        results['page_mark'] = current_results['page_mark']
-      else:
-        results = current_results
-      self._update_cache(qid, results)
+      results = await self._flights.do((qid, page_mark), self.next_page, qid, results, stored, label)
+      stored = stored or now()
 
     to_return = {
       'total': results['total'],
       'docs': results['docs'],
-      'qtime': round(now()-start, 2)
+      'qtime': round(now()-start, 2),
+      'stale': now() - stored > CACHE_SOFT_TTL,
+      'expires': stored + CACHE_SOFT_TTL
     }
-    logger.info(f'jstor.search: qid={qid} offset={offset} limit={limit} refresh={refresh} kwargs={kwargs} from_cache={from_cache} total={to_return["total"]} docs={len(to_return["docs"])} qtime={round(now()-start, 2)}')
+    logger.info(f'jstor.search: qid={qid} offset={offset} limit={limit} refresh={refresh} kwargs={kwargs} from_cache={from_cache} stale={to_return["stale"]} total={to_return["total"]} docs={len(to_return["docs"])} qtime={round(now()-start, 2)}')
     return to_return
 
+  async def search_batch(self, qids, offset=0, limit=10, refresh=False, concurrency=BATCH_CONCURRENCY, **kwargs):
+    '''Searches several QIDs, fetching uncached first pages together (see first_pages).
+    QIDs already being fetched by a concurrent search are awaited, the rest are registered
+    as in flight so concurrent searches for them coalesce onto the batch.'''
+    start = now()
+    cached = {} if refresh and offset == 0 else await self._cache.aget_entries(qids)
+    missing = [qid for qid in qids if qid not in cached]
+    if missing:
+      to_fetch = [qid for qid in missing if not self._flights.running((qid, None))]
+      batch = asyncio.ensure_future(self.first_pages(to_fetch, concurrency)) if to_fetch else None
+      async def from_batch(qid, results):
+        return (await batch)[qid]
+      await engine.gather(**dict([
+        (qid, self._flights.do((qid, None), from_batch if qid in to_fetch else self.next_page, qid, None))
+        for qid in missing
+      ]))
+
+    # first pages are now cached, further pages are fetched per QID where the requested page needs them
+    semaphore = asyncio.Semaphore(concurrency)
+    async def search(qid):
+      async with semaphore:
+        return await self.search(qid, offset, limit, **kwargs)
+    results = await engine.gather(**dict([(qid, search(qid)) for qid in qids]))
+    logger.info(f'jstor.search_batch: qids={len(qids)} missing={len(missing)} offset={offset} limit={limit} qtime={round(now()-start, 2)}')
+    return results
+
 if __name__ == '__main__':
   logger.setLevel(logging.INFO)
   parser = argparse.ArgumentParser(description='JSTOR client for image search')
@@ -471,7 +538,7 @@ if __name__ == '__main__':
   # parser.add_argument('--qid', help='Wikidata QID', default='Q42')
 
   client = JSTORClient()
-  results = client.search(**vars(parser.parse_args()))
+  results = asyncio.run(client.search(**vars(parser.parse_args())))
   print(json.dumps(results))  
 
   '''
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import os, sys
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+import argparse
+import asyncio
+import json
+import re
+from time import time as now
+
+from upstream import engine
+from cache import open_cache
+
+try:
+  from .entities import FALLBACK_LANGUAGE, entities
+except:
+  from entities import FALLBACK_LANGUAGE, entities
+
+LABELS_TTL = 86400 # entity labels rarely change, keep them for a day
+CHUNK_SIZE = 200   # QIDs per SPARQL VALUES query
+LABELLED_FIELDS = ('depicts', 'digital_representation_of') # doc fields holding entities to label
+QID_PATTERN = r'^Q[1-9][0-9]*$'
+LANGUAGE_PATTERN = r'^[a-z]{2,3}(-[A-Za-z0-9]{1,8})*$' # BCP 47 style language tag, e.g. en, pt-br
+
+def entity_recs(doc):
+  for fld in LABELLED_FIELDS:
+    if doc.get(fld):
+      yield from doc[fld] if isinstance(doc[fld], list) else [doc[fld]]
+
+def unlabelled(doc):
+  '''True if any entity of doc has no label yet.'''
+  return any('label' not in rec for rec in entity_recs(doc))
+
+class LabelService(object):
+  '''Resolves Wikidata labels for QIDs, shared by all search clients.
+
+  Labels are cached per (language, QID) with their own TTL, then looked up in the
+  offline entity label index.  Misses are split into chunks queried concurrently, and
+  QIDs already being fetched by another caller are awaited rather than queried again.
+  Resolved labels are added to the index overlay for entity lookups.
+
+  Malformed QIDs are skipped and a malformed language raises ValueError, as both are
+  pasted into the SPARQL query.  Only labels in the requested language count as hits.
+  A QID queried without a label in the language is cached with an empty label for it
+  and answered with its fallback language label.'''
+
+  def __init__(self, namespace='labels', ttl=LABELS_TTL, chunk_size=CHUNK_SIZE, **kwargs):
+    self._cache = open_cache(namespace, max_len=100000, max_age_seconds=ttl)
+    self.chunk_size = chunk_size
+    self._inflight = {}
+    self.counters = {'hits': 0, 'indexed': 0, 'misses': 0, 'coalesced': 0, 'queries': 0}
+
+  async def _query(self, qids, language):
+    '''Labels of qids in language and in the fallback language, as a dict of labels by QID
+    per language.  QIDs without a label in a language get an empty one, unless the query
+    failed.'''
+    languages = list(dict.fromkeys([language, FALLBACK_LANGUAGE]))
+    values = ' '.join([f'(<http://www.wikidata.org/entity/{qid}>)' for qid in qids])
+    query = f'SELECT ?item ?label WHERE {{ VALUES (?item) {{ {values} }} ?item rdfs:label ?label . FILTER (LANG(?label) = "{language}" || LANG(?label) = "{FALLBACK_LANGUAGE}") .}}'
+    self.counters['queries'] += 1
+    resp = await engine.post(
+      'https://query.wikidata.org/sparql',
+      headers = {
+        'Content-Type': 'application/x-www-form-urlencoded', 
+        'Accept': 'application/sparql-results+json'
+      },
+      data={'query': query}
+    )
+    labels = dict([(lang, {}) for lang in languages])
+    if resp.status_code == 200:
+      requested = set(qids)
+      for rec in resp.json()['results']['bindings']:
+        lang = rec.get('label', {}).get('xml:lang', language)
+        qid = rec.get('item', {}).get('value', '').split('/')[-1]
+        if lang in labels and qid in requested:
+          labels[lang][qid] = rec['label']['value']
+      for by_qid in labels.values():
+        for qid in qids:
+          by_qid.setdefault(qid, '')
+    return labels
+
+  async def _fetch(self, qids, language):
+    '''Queries the labels of qids, caching them per language.  Returns the labels in
+    language, or the fallback language, by QID.'''
+    chunks = [qids[i:i+self.chunk_size] for i in range(0, len(qids), self.chunk_size)]
+    by_language = {}
+    for chunk_labels in (await engine.gather(**dict([(f'labels-{idx}', self._query(chunk, language)) for idx, chunk in enumerate(chunks)]))).values():
+      for lang, labels in chunk_labels.items():
+        by_language.setdefault(lang, {}).update(labels)
+    await self._cache.aset_many(dict([(f'{lang}:{qid}', label) for lang, labels in by_language.items() for qid, label in labels.items()]))
+    for lang, labels in by_language.items():
+      entities.add(labels, lang)
+    fallback = by_language.get(FALLBACK_LANGUAGE, {})
+    return dict([(qid, label or fallback.get(qid, '')) for qid, label in by_language.get(language, {}).items()])
+
+  async def get_labels(self, qids, language='en'):
+    start = now()
+    labels = {}
+    missing = []
+    waiting = {}
+    if not re.match(LANGUAGE_PATTERN, language or ''):
+      raise ValueError(f'invalid language: {language}')
+    qids = set([qid for qid in qids if isinstance(qid, str) and re.match(QID_PATTERN, qid)])
+    keys = [f'{lang}:{qid}' for qid in qids for lang in dict.fromkeys([language, FALLBACK_LANGUAGE])]
+    entries = await self._cache.aget_entries(keys)
+    for qid in qids:
+      label = entries[f'{language}:{qid}'][0] if f'{language}:{qid}' in entries else None
+      if label == '' and language != FALLBACK_LANGUAGE:
+        # no label in language, answered with the fallback label if it is cached too
+        label = entries[f'{FALLBACK_LANGUAGE}:{qid}'][0] if f'{FALLBACK_LANGUAGE}:{qid}' in entries else None
+      if label is not None:
+        labels[qid] = label
+        self.counters['hits'] += 1
+        continue
+      # the offline index only, runtime labels are answered from the cache while they last
+      label = entities.indexed_label(qid, language, fallback=False)
+      if label is not None:
+        labels[qid] = label
+        self.counters['indexed'] += 1
+      elif (language, qid) in self._inflight:
+        waiting[qid] = self._inflight[(language, qid)]
+        self.counters['coalesced'] += 1
+      else:
+        missing.append(qid)
+        self.counters['misses'] += 1
+
+    if missing:
+      loop = asyncio.get_running_loop()
+      futures = dict([(qid, loop.create_future()) for qid in missing])
+      self._inflight.update(dict([((language, qid), future) for qid, future in futures.items()]))
+      fetched = {}
+      try:
+        fetched = await self._fetch(missing, language)
+      finally:
+        for qid, future in futures.items():
+          future.set_result(fetched.get(qid))
+          self._inflight.pop((language, qid), None)
+      labels.update(fetched)
+
+    for qid, future in waiting.items():
+      label = await asyncio.shield(future)
+      if label is not None:
+        labels[qid] = label
+
+    logger.info(f'get_labels: items={len(labels)} missing={len(missing)} coalesced={len(waiting)} qtime={round(now()-start, 2)}')
+    return labels
+
+  async def add_labels(self, docs, language='en'):
+    qids = set([rec['id'] for doc in docs for rec in entity_recs(doc)])
+    labels = await self.get_labels(qids, language) if len(qids) > 0 else {}
+
+    for doc in docs:
+      for rec in entity_recs(doc):
+        if rec['id'] in labels:
+          rec['label'] = labels[rec['id']]
+    return docs
+
+  def stats(self):
+    return {**self.counters, 'inflight': len(self._inflight), 'entities': entities.stats()}
+
+labels = LabelService()
+
+if __name__ == '__main__':
+  logger.setLevel(logging.INFO)
+  parser = argparse.ArgumentParser(description='Wikidata label resolver')
+  parser.add_argument('qids', help='Wikidata QIDs', nargs='+')
+  parser.add_argument('--language', help='Label language', default='en')
+
+  args = parser.parse_args()
+  print(json.dumps(asyncio.run(labels.get_labels(args.qids, args.language))))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import json
+from collections import OrderedDict
+from time import time as now
+
+PAGES_MAX_LEN = 2000
+PAGES_TTL = 1800 # matches the source result caches
+
+def project(rec, fields):
+  return dict([(fld, rec[fld]) for fld in fields if fld in rec])
+
+def project_docs(docs, doc_fields, depicts_fields):
+  '''Docs limited to the response model fields set on them, in model field order, so
+  internal keys of the cached docs are not emitted.'''
+  projected = []
+  for doc in docs:
+    doc = project(doc, doc_fields)
+    if 'depicts' in doc:
+      doc['depicts'] = [project(rec, depicts_fields) for rec in doc['depicts']]
+    if doc.get('digital_representation_of'):
+      doc['digital_representation_of'] = project(doc['digital_representation_of'], depicts_fields)
+    projected.append(doc)
+  return projected
+
+def encode_docs(docs, doc_fields, depicts_fields):
+  '''JSON encodes docs as FastAPI would for the response model with exclude_unset:
+  only fields set on the doc, in model field order, compact separators.'''
+  return json.dumps(project_docs(docs, doc_fields, depicts_fields), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+class PageCache(object):
+  '''LRU of encoded search result pages, keyed by (qid, source, offset, limit, language,
+  doc_fields, depicts_fields).
+  Entries hold the total and the encoded docs array, qtime is added per response.'''
+
+  def __init__(self, max_len=PAGES_MAX_LEN, max_age_seconds=PAGES_TTL, **kwargs):
+    self.max_len = max_len
+    self.max_age_seconds = max_age_seconds
+    self._pages = OrderedDict()
+    self.counters = {'hits': 0, 'misses': 0}
+
+  def get(self, key):
+    entry = self._pages.get(key)
+    if entry is None or entry[0] < now():
+      self._pages.pop(key, None)
+      self.counters['misses'] += 1
+      return None
+    self._pages.move_to_end(key)
+    self.counters['hits'] += 1
+    return entry[1]
+
+  def set(self, key, total, docs_json, expires=None):
+    '''Caches a page until max_age_seconds have passed, or until expires when the
+    source results it was built from go stale sooner.'''
+    expires = min(now() + self.max_age_seconds, expires or float('inf'))
+    self._pages[key] = (expires, (total, docs_json))
+    self._pages.move_to_end(key)
+    while len(self._pages) > self.max_len:
+      self._pages.popitem(last=False)
+
+  def invalidate(self, qid):
+    for key in [key for key in self._pages if key[0] == qid]:
+      del self._pages[key]
+
+  def stats(self):
+    return {**self.counters, 'pages': len(self._pages)}
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import asyncio
+import traceback
+from time import time as now
+
+REQUIRED = object()
+
+class Pipeline(object):
+  '''Dependency graph of async stages.
+
+  Each stage is started as soon as the stages it depends on have finished, and
+  is called with their results as positional arguments.  A stage that fails
+  yields its default if it has one, otherwise the failure propagates to the
+  stages depending on it and to run.  Stage timings (seconds from pipeline start
+  to stage start and end) are kept in timings.'''
+
+  def __init__(self, name='pipeline'):
+    self.name = name
+    self._stages = {}
+    self.timings = {}
+
+  def add(self, name, fn, deps=(), default=REQUIRED):
+    '''Adds a stage calling fn, a coroutine function or plain function, with the
+    results of deps.'''
+    self._stages[name] = (fn, tuple(deps), default)
+    return self
+
+  def value(self, name, value):
+    '''Adds a stage that is already done.'''
+    return self.add(name, lambda: value)
+
+  async def run(self):
+    '''Runs all stages, returns their results by name.'''
+    start = now()
+    tasks = {}
+
+    async def run_stage(name):
+      fn, deps, default = self._stages[name]
+      inputs = [await tasks[dep] for dep in deps]
+      stage_start = now()
+      try:
+        result = fn(*inputs)
+        if asyncio.iscoroutine(result):
+          result = await result
+      except Exception as exc:
+        if default is REQUIRED:
+          raise
+        logger.warning(f'{self.name}: stage {name} failed: {exc}')
+        logger.info(traceback.format_exc())
+        result = default
+      finally:
+        self.timings[name] = (round(stage_start - start, 3), round(now() - start, 3))
+      return result
+
+    for name in self._stages:
+      tasks[name] = asyncio.ensure_future(run_stage(name))
+    try:
+      results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+    except Exception:
+      for task in tasks.values():
+        task.cancel()
+      await asyncio.gather(*tasks.values(), return_exceptions=True)
+      raise
+    logger.debug(f'{self.name}: timings={self.timings} elapsed={round(now()-start, 3)}')
+    return results
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import asyncio
+import weakref
+from collections import OrderedDict
+from time import time as now
+
+PREFETCH_MAX_DEPTH = 500    # queued QIDs, further QIDs are dropped
+PREFETCH_RATE = 4           # prefetches started per second
+PREFETCH_CONCURRENCY = 2    # prefetches running at once
+PREFETCH_WINDOW = 1800      # a QID is not prefetched again within this many seconds
+PREFETCH_MAX_RECENT = 10000 # prefetched QIDs remembered for deduplication and hit counting
+
+class Prefetcher(object):
+  '''Bounded background queue warming caches for QIDs before they are searched.
+
+  warm(qid, language) is the coroutine doing the work.  QIDs queued, running or
+  prefetched within the window are skipped, prefetches are started at no more
+  than rate per second, and a QID searched after its prefetch completed counts
+  as a hit.  Queue and workers are created per event loop on first use; outside
+  a running loop enqueue does nothing.'''
+
+  def __init__(self, warm, max_depth=PREFETCH_MAX_DEPTH, rate=PREFETCH_RATE, concurrency=PREFETCH_CONCURRENCY, window=PREFETCH_WINDOW, **kwargs):
+    self.warm = warm
+    self.max_depth = max_depth
+    self.rate = rate
+    self.concurrency = concurrency
+    self.window = window
+    self._loops = weakref.WeakKeyDictionary()
+    self._recent = OrderedDict() # (qid, language) -> (time prefetched, searched since)
+    self._next_start = 0
+    self.counters = {'enqueued': 0, 'deduplicated': 0, 'dropped': 0, 'completed': 0, 'failed': 0, 'hits': 0, 'late': 0}
+
+  def _state(self):
+    loop = asyncio.get_running_loop()
+    state = self._loops.get(loop)
+    if state is None:
+      state = {'queue': asyncio.Queue(self.max_depth), 'pending': set()} # pending: (qid, language) queued or running
+      state['workers'] = [asyncio.ensure_future(self._worker(state)) for _ in range(self.concurrency)]
+      self._loops[loop] = state
+    return state
+
+  def enqueue(self, qids, language='en'):
+    '''Queues QIDs for prefetching, returns the number queued.'''
+    try:
+      state = self._state()
+    except RuntimeError:
+      return 0
+    queued = 0
+    for qid in qids:
+      key = (qid, language)
+      prefetched = self._recent.get(key)
+      if key in state['pending'] or (prefetched and now() - prefetched[0] < self.window):
+        self.counters['deduplicated'] += 1
+        continue
+      try:
+        state['queue'].put_nowait(key)
+      except asyncio.QueueFull:
+        self.counters['dropped'] += 1
+        continue
+      state['pending'].add(key)
+      self.counters['enqueued'] += 1
+      queued += 1
+    return queued
+
+  def claim(self, qid, language='en'):
+    '''Records a search for qid, counting a hit if it was prefetched.'''
+    key = (qid, language)
+    prefetched = self._recent.get(key)
+    if prefetched and not prefetched[1]:
+      self.counters['hits'] += 1
+      self._recent[key] = (prefetched[0], True)
+    elif any(key in state['pending'] for state in self._loops.values()):
+      self.counters['late'] += 1
+
+  async def _throttle(self):
+    start = max(now(), self._next_start)
+    self._next_start = start + 1 / self.rate
+    await asyncio.sleep(start - now())
+
+  async def _worker(self, state):
+    while True:
+      key = await state['queue'].get()
+      try:
+        await self._throttle()
+        await self.warm(*key)
+        self.counters['completed'] += 1
+        self._recent[key] = (now(), False)
+        self._recent.move_to_end(key)
+        while len(self._recent) > PREFETCH_MAX_RECENT:
+          self._recent.popitem(last=False)
+      except asyncio.CancelledError:
+        raise
+      except Exception as exc:
+        self.counters['failed'] += 1
+        logger.warning(f'prefetch: qid={key[0]} failed: {exc}')
+      finally:
+        state['pending'].discard(key)
+        state['queue'].task_done()
+
+  def stats(self):
+    depth = sum(state['queue'].qsize() for state in self._loops.values())
+    return {
+      **self.counters,
+      'depth': depth,
+      'hit_rate': round(self.counters['hits'] / self.counters['completed'], 3) if self.counters['completed'] else None
+    }
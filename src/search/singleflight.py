@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import asyncio
+
+class SingleFlight(object):
+  '''Coalesces concurrent calls sharing a key onto one in-flight computation.
+
+  The first caller for a key starts the computation as a task; callers arriving
+  while it runs await the same task.  Waiters are shielded so a cancelled caller
+  does not cancel the computation for the others.'''
+
+  def __init__(self, **kwargs):
+    self._inflight = {}
+    self._background = set()
+    self.counters = {'calls': 0, 'executed': 0, 'coalesced': 0}
+
+  async def do(self, key, fn, *args, **kwargs):
+    self.counters['calls'] += 1
+    task = self._inflight.get(key)
+    if task is None:
+      self.counters['executed'] += 1
+      task = asyncio.ensure_future(fn(*args, **kwargs))
+      self._inflight[key] = task
+      task.add_done_callback(lambda done: self._inflight.pop(key) if self._inflight.get(key) is done else None)
+    else:
+      self.counters['coalesced'] += 1
+      logger.debug(f'singleflight: coalesced key={key}')
+    return await asyncio.shield(task)
+
+  def spawn(self, key, fn, *args, **kwargs):
+    '''Starts fn for key in the background unless it is already in flight.'''
+    if key in self._inflight:
+      return
+    task = asyncio.ensure_future(self.do(key, fn, *args, **kwargs))
+    self._background.add(task)
+    task.add_done_callback(self._background_done)
+
+  def _background_done(self, task):
+    self._background.discard(task)
+    if not task.cancelled() and task.exception():
+      logger.warning(f'singleflight: background task failed: {task.exception()}')
+
+  def running(self, key):
+    return key in self._inflight
+
+  def stats(self):
+    return {**self.counters, 'inflight': len(self._inflight)}
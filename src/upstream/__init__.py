@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from upstream.engine import UpstreamEngine, engine
+from upstream.policy import CircuitBreaker, CircuitOpenError, UpstreamPolicy, policy
+from upstream.sessions import SessionRegistry, sessions
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import asyncio
+import traceback
+import weakref
+from time import time as now
+from urllib.parse import urlparse
+
+import httpx
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+from upstream.policy import policy
+from upstream.sessions import REJECT_COOKIES, default_headers, sessions
+
+# Maximum number of in-flight requests per upstream host.  Requests beyond the
+# limit wait on the host semaphore rather than opening more connections.
+HOST_LIMITS = {
+  'query.wikidata.org': 10,
+  'wcqs-beta.wmflabs.org': 4,
+  'commons.wikimedia.org': 10,
+  'www.wikidata.org': 10,
+  'www.jstor.org': 10
+}
+DEFAULT_HOST_LIMIT = 10
+
+class UpstreamEngine(object):
+  '''Async HTTP engine shared by all search sources.
+
+  A single httpx.AsyncClient (and its connection pool) is kept per event loop,
+  and concurrency is bounded per upstream host by a semaphore.  State is kept
+  per loop as asyncio primitives cannot be shared across loops.  Requests get
+  the host's deadlines and circuit breaker from the upstream policy, and GETs to
+  hedged hosts are duplicated when slower than the host's p95.'''
+
+  def __init__(self, limits=None, max_connections=100, transport=None, **kwargs):
+    self.limits = {**HOST_LIMITS, **(limits or {})}
+    self.max_connections = max_connections
+    self.transport = transport # httpx transport for clients created from now on, e.g. to replay recorded responses
+    self._loops = weakref.WeakKeyDictionary()
+
+  def _state(self):
+    loop = asyncio.get_running_loop()
+    state = self._loops.get(loop)
+    if state is None:
+      state = {
+        'client': httpx.AsyncClient(
+          timeout=None,
+          follow_redirects=True,
+          transport=self.transport,
+          limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        ),
+        'semaphores': {}
+      }
+      state['client'].cookies.jar.set_policy(REJECT_COOKIES)
+      self._loops[loop] = state
+    return state
+
+  def _semaphore(self, state, host):
+    if host not in state['semaphores']:
+      state['semaphores'][host] = asyncio.Semaphore(self.limits.get(host, DEFAULT_HOST_LIMIT))
+    return state['semaphores'][host]
+
+  async def _send(self, state, host, method, url, headers=None, **kwargs):
+    merged = httpx.Headers(default_headers(host))
+    merged.update(headers or {})
+    async with self._semaphore(state, host):
+      return await state['client'].request(method, url, headers=merged, **kwargs)
+
+  async def _hedged(self, state, host, delay, method, url, **kwargs):
+    '''Sends a duplicate request if the first has not completed after delay,
+    returning the first successful response.'''
+    first = asyncio.ensure_future(self._send(state, host, method, url, **kwargs))
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+      return first.result()
+    policy.counters['hedges'] += 1
+    hedge = asyncio.ensure_future(self._send(state, host, method, url, **kwargs))
+    pending = {first, hedge}
+    try:
+      while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+          if task.exception() is None:
+            if task is hedge:
+              policy.counters['hedge_wins'] += 1
+            return task.result()
+      return first.result()
+    finally:
+      for task in pending:
+        task.cancel()
+
+  async def request(self, method, url, timeout=None, **kwargs):
+    '''Sends a request, raising CircuitOpenError without calling the host while
+    its breaker is open.  Responses with a 5xx status and transport errors count
+    as failures of the host.'''
+    host = urlparse(url).hostname
+    probe = policy.allow(host)
+    if timeout is None:
+      connect, read = policy.timeout(host)
+      timeout = httpx.Timeout(read, connect=connect)
+    state = self._state()
+    delay = policy.hedge_delay(host) if method == 'GET' else None
+    start = now()
+    try:
+      if delay is None:
+        resp = await self._send(state, host, method, url, timeout=timeout, **kwargs)
+      else:
+        resp = await self._hedged(state, host, delay, method, url, timeout=timeout, **kwargs)
+    except httpx.HTTPError as exc:
+      policy.observe(host, now() - start, ok=False, timed_out=isinstance(exc, httpx.TimeoutException))
+      raise
+    except BaseException:
+      # cancelled, or failed before reaching the host
+      policy.release(host, probe)
+      raise
+    policy.observe(host, now() - start, ok=resp.status_code < 500)
+    return resp
+
+  async def get(self, url, **kwargs):
+    return await self.request('GET', url, **kwargs)
+
+  async def post(self, url, **kwargs):
+    return await self.request('POST', url, **kwargs)
+
+  async def gather(self, **aws):
+    '''Runs named awaitables concurrently, returning a dict of results by name.
+    Failures are logged and omitted from the results.'''
+    names = list(aws)
+    results = {}
+    for name, result in zip(names, await asyncio.gather(*aws.values(), return_exceptions=True)):
+      if isinstance(result, Exception):
+        logger.warning('%r generated an exception: %s' % (name, result))
+        logger.info(''.join(traceback.format_exception(type(result), result, result.__traceback__)))
+      else:
+        results[name] = result
+    return results
+
+  def stats(self):
+    return {**policy.stats(), 'sessions': sessions.stats()}
+
+  async def close(self):
+    state = self._loops.pop(asyncio.get_running_loop(), None)
+    if state:
+      await state['client'].aclose()
+
+engine = UpstreamEngine()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import os
+import threading
+from collections import deque
+from time import time as now
+
+# Per-host deadlines in seconds: connect (TCP and TLS) and read (time between bytes
+# of the response).  SPARQL endpoints get longer reads as their queries are slow.
+HOST_TIMEOUTS = {
+  'query.wikidata.org': {'connect': 3, 'read': 20},
+  'wcqs-beta.wmflabs.org': {'connect': 3, 'read': 10},
+  'commons.wikimedia.org': {'connect': 3, 'read': 10},
+  'www.wikidata.org': {'connect': 3, 'read': 10},
+  'www.jstor.org': {'connect': 3, 'read': 15},
+  'api.github.com': {'connect': 3, 'read': 10},
+  'raw.githubusercontent.com': {'connect': 3, 'read': 10}
+}
+DEFAULT_TIMEOUT = {'connect': 5, 'read': 30}
+
+# Hosts whose idempotent GETs may be hedged: when a request has not completed after
+# the host's p95 latency, a duplicate is sent and the first response wins.
+HEDGED_HOSTS = {'query.wikidata.org', 'wcqs-beta.wmflabs.org'}
+HEDGING = os.environ.get('UPSTREAM_HEDGING', 'true').lower() in ('1', 'true', 'yes')
+HEDGE_MIN_SAMPLES = 20  # latencies observed before a host is hedged
+HEDGE_MIN_DELAY = 0.1   # seconds, floor for the hedge delay
+
+BREAKER_THRESHOLD = 5   # consecutive failures opening a host's breaker
+BREAKER_RESET = 30      # seconds a breaker stays open before a probe is let through
+LATENCY_WINDOW = 200    # recent latencies kept per host
+
+class CircuitOpenError(Exception):
+  '''Raised instead of calling a host whose circuit breaker is open.'''
+
+  def __init__(self, host, retry_in):
+    super().__init__(f'circuit open for {host}, retry in {round(retry_in, 1)}s')
+    self.host = host
+    self.retry_in = retry_in
+
+class CircuitBreaker(object):
+  '''Consecutive-failure circuit breaker for one host.
+
+  Closed, requests pass.  After threshold consecutive failures it opens and
+  requests fail fast for reset_seconds, after which it is half open: a single
+  probe is let through, closing the breaker on success and reopening it on
+  failure.  A probe that ends without an outcome (cancelled, or failed before
+  reaching the host) must be released, and one neither recorded nor released
+  within reset_seconds is assumed lost and replaced.'''
+
+  def __init__(self, host, threshold=BREAKER_THRESHOLD, reset_seconds=BREAKER_RESET):
+    self.host = host
+    self.threshold = threshold
+    self.reset_seconds = reset_seconds
+    self.state = 'closed'
+    self._failures = 0
+    self._opened = 0
+    self._probing = False
+    self._probe_started = 0
+    self._lock = threading.Lock()
+    self.counters = {'trips': 0, 'rejected': 0, 'probes': 0}
+
+  def allow(self):
+    '''Checks a request may be sent, raises CircuitOpenError if not.  Returns True
+    if the request is the half-open probe.'''
+    with self._lock:
+      if self.state == 'closed':
+        return False
+      retry_in = self._opened + self.reset_seconds - now()
+      if self.state == 'open' and retry_in <= 0:
+        self.state = 'half_open'
+      if self.state == 'half_open' and (not self._probing or now() - self._probe_started > self.reset_seconds):
+        self._probing = True
+        self._probe_started = now()
+        self.counters['probes'] += 1
+        return True
+      self.counters['rejected'] += 1
+    raise CircuitOpenError(self.host, max(retry_in, 0))
+
+  def release(self):
+    '''Lets another probe through after the probe ended without an outcome.'''
+    with self._lock:
+      self._probing = False
+
+  def record(self, ok):
+    with self._lock:
+      self._probing = False
+      if ok:
+        self._failures = 0
+        self.state = 'closed'
+        return
+      self._failures += 1
+      if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.threshold):
+        if self.state == 'closed':
+          self.counters['trips'] += 1
+          logger.warning(f'CircuitBreaker: {self.host} open after {self._failures} failures')
+        self.state = 'open'
+        self._opened = now()
+
+  def stats(self):
+    return {**self.counters, 'state': self.state, 'failures': self._failures}
+
+class UpstreamPolicy(object):
+  '''Timeouts, circuit breakers and latency tracking per upstream host, shared by
+  the async engine and the synchronous requests helpers.
+
+  Breakers and latencies are only kept for the known upstreams, the hosts with
+  configured timeouts, so requests to arbitrary (user supplied) hosts only get the
+  default timeouts.'''
+
+  def __init__(self, timeouts=None, hedged=None, hedging=HEDGING, **kwargs):
+    self.timeouts = {**HOST_TIMEOUTS, **(timeouts or {})}
+    self.hedged = HEDGED_HOSTS if hedged is None else set(hedged)
+    self.hedging = hedging
+    self.hosts = set(self.timeouts) | self.hedged
+    self._breakers = {}
+    self._latencies = {}
+    self._lock = threading.Lock()
+    self.counters = {'timeouts': 0, 'failures': 0, 'hedges': 0, 'hedge_wins': 0}
+
+  def timeout(self, host):
+    '''(connect, read) deadlines for host in seconds.'''
+    timeout = self.timeouts.get(host, DEFAULT_TIMEOUT)
+    return timeout['connect'], timeout['read']
+
+  def breaker(self, host):
+    '''The circuit breaker of host, None if it is not a known upstream.'''
+    if host not in self.hosts:
+      return None
+    with self._lock:
+      if host not in self._breakers:
+        self._breakers[host] = CircuitBreaker(host)
+      return self._breakers[host]
+
+  def allow(self, host):
+    '''Checks a request to host may be sent (see CircuitBreaker.allow).'''
+    breaker = self.breaker(host)
+    return breaker.allow() if breaker else False
+
+  def release(self, host, probe):
+    '''Releases the probe of host's breaker if the request was the probe and ended
+    without an outcome.'''
+    if probe:
+      self.breaker(host).release()
+
+  def observe(self, host, elapsed, ok=True, timed_out=False):
+    '''Records the outcome of a request to host.  Failures count toward the breaker,
+    latencies of successful requests toward the hedge delay.'''
+    if timed_out:
+      self.counters['timeouts'] += 1
+    if not ok:
+      self.counters['failures'] += 1
+    breaker = self.breaker(host)
+    if breaker is None:
+      return
+    breaker.record(ok)
+    if not ok:
+      return
+    with self._lock:
+      if host not in self._latencies:
+        self._latencies[host] = deque(maxlen=LATENCY_WINDOW)
+      self._latencies[host].append(elapsed)
+
+  def p95(self, host):
+    with self._lock:
+      latencies = sorted(self._latencies.get(host, ()))
+    return latencies[int(len(latencies) * 0.95)] if latencies else None
+
+  def hedge_delay(self, host):
+    '''Seconds after which a GET to host is hedged, None if it is not.'''
+    if not self.hedging or host not in self.hedged or len(self._latencies.get(host, ())) < HEDGE_MIN_SAMPLES:
+      return None
+    return max(self.p95(host), HEDGE_MIN_DELAY)
+
+  def stats(self):
+    return {
+      **self.counters,
+      'hosts': dict([(host, {
+        **breaker.stats(),
+        'p95': round(self.p95(host), 3) if self.p95(host) is not None else None
+      }) for host, breaker in list(self._breakers.items())])
+    }
+
+policy = UpstreamPolicy()
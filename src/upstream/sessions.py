@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+import os
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Keep-alive connections kept per upstream host by the synchronous sessions.  Only these
+# hosts are pooled, requests to other hosts (e.g. user supplied URLs) get a session of their own.
+POOL_SIZES = {
+  'query.wikidata.org': 10,
+  'commons.wikimedia.org': 10,
+  'www.wikidata.org': 10,
+  'www.jstor.org': 10,
+  'api.github.com': 10,
+  'raw.githubusercontent.com': 10
+}
+DEFAULT_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 10))
+
+# Headers sent to every upstream unless a request overrides them, and per host.
+DEFAULT_HEADERS = {'User-Agent': 'Labs Client'}
+HOST_HEADERS = {
+  'api.github.com': {
+    'Accept': 'application/vnd.github.v3+json',
+    'User-Agent': 'JSTOR Labs visual essays client'
+  }
+}
+
+# Shared sessions serve many users, so cookies set by one response must never be sent with
+# another user's request.
+REJECT_COOKIES = DefaultCookiePolicy(allowed_domains=[])
+
+def default_headers(host):
+  return {**DEFAULT_HEADERS, **HOST_HEADERS.get(host, {})}
+
+def new_session(host, pool_size=DEFAULT_POOL_SIZE):
+  '''requests.Session with a connection pool of pool_size, the host's default headers and
+  no cookie persistence.'''
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+  session = requests.Session()
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  session.headers.update(default_headers(host))
+  session.cookies.set_policy(REJECT_COOKIES)
+  return session
+
+class SessionRegistry(object):
+  '''Pooled keep-alive requests.Session per known upstream host.
+
+  Sessions are created on first use, with a connection pool sized for the host
+  and the host's default headers, and shared by all threads (the underlying
+  urllib3 pools are thread-safe).  Other hosts are not pooled.'''
+
+  def __init__(self, pool_sizes=None, **kwargs):
+    self.pool_sizes = {**POOL_SIZES, **(pool_sizes or {})}
+    self._sessions = {}
+    self._lock = threading.Lock()
+
+  def session(self, host):
+    '''The pooled session of host, None if host is not pooled.'''
+    if host not in self.pool_sizes:
+      return None
+    session = self._sessions.get(host)
+    if session is None:
+      with self._lock:
+        session = self._sessions.get(host)
+        if session is None:
+          session = new_session(host, self.pool_sizes[host])
+          self._sessions[host] = session
+    return session
+
+  def request(self, host, method, url, **kwargs):
+    '''Sends a request on the pooled session of host, or on a session closed after the
+    response if host is not pooled.'''
+    session = self.session(host)
+    if session is not None:
+      return session.request(method, url, **kwargs)
+    with new_session(host, 1) as session:
+      return session.request(method, url, **kwargs)
+
+  def close(self):
+    with self._lock:
+      for session in self._sessions.values():
+        session.close()
+      self._sessions = {}
+
+  def stats(self):
+    return dict([(host, self.pool_sizes[host]) for host in list(self._sessions)])
+
+sessions = SessionRegistry()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+from time import time as now
+from urllib.parse import urlparse
+
+import requests
+
+from upstream.policy import policy
+from upstream.sessions import sessions
+
+def request(method, url, **kwargs):
+  '''Sends a request on the host's pooled keep-alive session, if it has one, with the host's
+  connect/read deadlines (unless a timeout is given) and circuit breaker.  Raises
+  CircuitOpenError without calling the host while its breaker is open.'''
+  host = urlparse(url).hostname
+  probe = policy.allow(host)
+  kwargs.setdefault('timeout', policy.timeout(host))
+  start = now()
+  try:
+    resp = sessions.request(host, method, url, **kwargs)
+  except requests.RequestException as exc:
+    policy.observe(host, now() - start, ok=False, timed_out=isinstance(exc, requests.Timeout))
+    raise
+  except BaseException:
+    policy.release(host, probe)
+    raise
+  policy.observe(host, now() - start, ok=resp.status_code < 500)
+  return resp
+
+def get(url, **kwargs):
+  return request('GET', url, **kwargs)
+
+def head(url, **kwargs):
+  kwargs.setdefault('allow_redirects', False)
+  return request('HEAD', url, **kwargs)
+
+def post(url, **kwargs):
+  return request('POST', url, **kwargs)
+
+def put(url, **kwargs):
+  return request('PUT', url, **kwargs)
@@ -0,0 +1,5 @@
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+# keep the module-level caches of the search clients in memory, not in sqlite files in the working dir
+os.environ.setdefault('CACHE_BACKEND', 'memory')
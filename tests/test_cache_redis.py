@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import fakeredis
+import redis
+
+from cache.redis import RedisCache
+
+def new_cache(client=None, **kwargs):
+  return RedisCache('test', client=client or fakeredis.FakeRedis(), **kwargs)
+
+class SlowRedis(object):
+  '''Redis client whose calls take delay seconds, as a slow or remote server would.'''
+
+  def __init__(self, delay):
+    self.delay = delay
+    self.client = fakeredis.FakeRedis()
+
+  def __getattr__(self, name):
+    attr = getattr(self.client, name)
+    def slow(*args, **kwargs):
+      time.sleep(self.delay)
+      return attr(*args, **kwargs)
+    return slow
+
+class DownRedis(object):
+
+  def __getattr__(self, name):
+    def fail(*args, **kwargs):
+      raise redis.ConnectionError('connection refused')
+    return fail
+
+def test_set_get_keeps_stored_time():
+  cache = new_cache()
+  cache.set('a', {'x': 1}, stored=100, ttl=10**10)
+  assert cache.get_entry('a') == ({'x': 1}, 100)
+  assert cache.get('b') is None
+  assert cache.counters['hits'] == 1 and cache.counters['misses'] == 1
+
+def test_ttl_is_set_on_server():
+  client = fakeredis.FakeRedis()
+  cache = new_cache(client, max_age_seconds=60)
+  cache.set('a', 1)
+  assert 59000 < client.pttl('test:a') <= 60000
+  cache.set('b', 1, stored=time.time() - 120)
+  assert cache.get_entry('b') is None
+
+def test_namespaces_do_not_collide():
+  client = fakeredis.FakeRedis()
+  RedisCache('one', client=client).set('a', 1)
+  assert RedisCache('two', client=client).get('a') is None
+
+def test_async_batch_access():
+  cache = new_cache()
+  async def run():
+    await cache.aset_many({'a': 1, 'b': 2})
+    await cache.aset('c', 3, stored=100, ttl=10**10)
+    return await cache.aget_entries(['a', 'b', 'c', 'd']), await cache.aget('c')
+  entries, value = asyncio.run(run())
+  assert dict([(key, value) for key, (value, stored) in entries.items()]) == {'a': 1, 'b': 2, 'c': 3}
+  assert entries['c'][1] == 100 and value == 3
+
+def test_async_access_does_not_block_the_loop():
+  cache = new_cache(SlowRedis(0.2))
+  ticks = []
+  async def ticker():
+    for _ in range(10):
+      ticks.append(time.time())
+      await asyncio.sleep(0.01)
+  async def run():
+    await asyncio.gather(cache.aget_entry('a'), ticker())
+  start = time.time()
+  asyncio.run(run())
+  assert len(ticks) == 10
+  assert ticks[0] - start < 0.1 # the ticker ran while the cache call was waiting
+
+def test_server_errors_are_misses():
+  cache = new_cache(DownRedis())
+  cache.set('a', 1)
+  assert cache.get('a') is None
+  assert asyncio.run(cache.aget_entries(['a', 'b'])) == {}
+  assert cache.counters['errors'] == 3
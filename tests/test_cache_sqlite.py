@@ -0,0 +1,80 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+from cache.sqlite import SqliteCache
+
+@pytest.fixture
+def path(tmp_path):
+  return str(tmp_path / 'test.cache')
+
+@pytest.fixture
+def cache(path):
+  return SqliteCache(path, namespace='test', max_age_seconds=60)
+
+def test_entries_persist_across_instances(cache, path):
+  cache.set('a', {'x': 1}, stored=100, ttl=10**10)
+  cache.set('b', 1, stored=100, ttl=1)
+  reopened = SqliteCache(path, namespace='test')
+  assert reopened.get_entry('a') == ({'x': 1}, 100)
+  assert reopened.get('b') is None
+  assert reopened.counters['hits'] == 1 and reopened.counters['misses'] == 1
+
+def test_async_writes_are_made_off_the_loop(cache, path):
+  writers = []
+  write = cache._write
+  cache._write = lambda records: writers.append(threading.current_thread().name) or write(records)
+  async def run():
+    await cache.aset_many({'a': 1, 'b': 2})
+    await cache.aset('c', 3)
+    await cache.adelete('a')
+    return await cache.aget_entries(['a', 'b', 'c'])
+  entries = asyncio.run(run())
+  assert dict([(key, value) for key, (value, stored) in entries.items()]) == {'b': 2, 'c': 3}
+  assert writers and all(name.startswith('sqlite-cache') for name in writers)
+  assert SqliteCache(path, namespace='test').get('c') == 3
+
+def test_locked_file_does_not_block_the_loop(cache, path):
+  other = sqlite3.connect(path, isolation_level=None)
+  other.execute('BEGIN IMMEDIATE')
+  async def run():
+    ticks = 0
+    writing = asyncio.ensure_future(cache.aset('a', 1))
+    asyncio.get_running_loop().call_later(0.2, other.execute, 'COMMIT')
+    while not writing.done():
+      await asyncio.sleep(0.01)
+      ticks += 1
+      # answered by the memory tier while the disk write waits
+      assert await cache.aget('a') == 1
+    return ticks
+  assert asyncio.run(run()) > 5
+  assert SqliteCache(path, namespace='test').get('a') == 1
+
+def test_memory_tier_is_bounded_by_bytes(path):
+  cache = SqliteCache(path, namespace='test', max_len=None, memory_bytes=2500)
+  for key in 'abc':
+    cache.set(key, 'x' * 1000)
+  stats = cache.stats()
+  assert stats['memory']['entries'] == 2 and stats['memory']['evictions'] == 1 and stats['memory']['bytes'] <= 2500
+  # evicted from memory, still on disk
+  assert cache.get('a') == 'x' * 1000 and cache.stats()['disk']['hits'] == 1
+
+def test_disk_tier_is_purged_oldest_first_by_bytes(path):
+  cache = SqliteCache(path, namespace='test', max_len=None, disk_bytes=5000)
+  for idx in range(10):
+    cache.set(f'k{idx}', 'x' * 1000, stored=1000 + idx, ttl=10**10)
+  stats = cache.stats()['disk']
+  assert stats['bytes'] <= 5000 and stats['evictions'] > 0
+  reopened = SqliteCache(path, namespace='test', max_len=None)
+  assert reopened.get('k9') is not None and reopened.get('k0') is None
+
+def test_purge_bounds_the_disk_tier_by_entries(path):
+  cache = SqliteCache(path, namespace='test', max_len=3)
+  for idx in range(5):
+    cache.set(f'k{idx}', idx, stored=1000 + idx, ttl=10**10)
+  cache.set('expired', 0, stored=1000, ttl=1)
+  cache.purge()
+  assert len(cache) == 3 and cache.stats()['disk']['entries'] == 3
+  assert [cache.get(f'k{idx}') for idx in range(5)] == [None, None, 2, 3, 4]
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from search.commons import CommonsClient
+from search.health import StrategyHealth
+
+DOCS = [{'id': 'wc:a.jpg'}]
+
+class Strategy(object):
+  '''Answers after delay seconds with result, or raises it if it is an exception.'''
+
+  def __init__(self, delay, result):
+    self.delay = delay
+    self.result = result
+    self.calls = 0
+    self.cancelled = 0
+
+  async def __call__(self, qid):
+    self.calls += 1
+    try:
+      await asyncio.sleep(self.delay)
+    except asyncio.CancelledError:
+      self.cancelled += 1
+      raise
+    if isinstance(self.result, Exception):
+      raise self.result
+    return self.result
+
+@pytest.fixture
+def client():
+  return CommonsClient()
+
+def strategies(client, sparql, wikimedia):
+  client.commons_depict_images_sparql, client.commons_depict_images_wikimedia = sparql, wikimedia
+  return sparql, wikimedia
+
+def test_health_needs_samples_then_follows_the_success_rate():
+  health = StrategyHealth('test', window=10)
+  for _ in range(4):
+    health.record(True, 0.1)
+  assert health.state == 'uncertain'
+  health.record(True, 0.3)
+  assert health.state == 'healthy'
+  for _ in range(5):
+    health.record(False, 1)
+  assert health.success_rate() == 0.5 and health.state == 'uncertain'
+  health.record(False, 1)
+  # the window drops the oldest success
+  assert health.success_rate() == 0.4 and health.state == 'unhealthy'
+  assert health.stats() == {'attempts': 0, 'failures': 6, 'cancelled': 0, 'probes': 0, 'state': 'unhealthy', 'success_rate': 0.4, 'p50_ms': 100}
+
+def test_health_run_records_none_and_exceptions_as_failures():
+  health = StrategyHealth('test')
+  async def run():
+    return [await health.run(Strategy(0, result), 'Q42') for result in (DOCS, None, RuntimeError('down'))]
+  assert asyncio.run(run()) == [DOCS, None, None]
+  assert health.counters['attempts'] == 3 and health.counters['failures'] == 2
+
+def test_health_probes_once_per_interval():
+  health = StrategyHealth('test', probe_interval=0.05)
+  async def run():
+    await health.run(Strategy(0, None), 'Q42')
+    due = [health.probe_due()]
+    await asyncio.sleep(0.1)
+    return due + [health.probe_due()]
+  assert asyncio.run(run()) == [False, True]
+  assert health.counters['probes'] == 1
+
+def test_race_cancels_the_loser(client):
+  sparql, wikimedia = strategies(client, Strategy(1, DOCS), Strategy(0.01, [{'id': 'wc:b.jpg'}]))
+  async def run():
+    docs = await client.commons_depict_images('Q42')
+    await asyncio.sleep(0)
+    return docs
+  assert asyncio.run(run()) == [{'id': 'wc:b.jpg'}]
+  assert sparql.cancelled == 1 and client._strategy_counters['raced'] == 1
+  # the cancelled loser is not an outcome
+  assert client._health['sparql'].counters['cancelled'] == 1 and client._health['sparql'].success_rate() is None
+  assert client._health['wikimedia'].success_rate() == 1
+
+def test_race_falls_back_after_a_failure(client):
+  sparql, wikimedia = strategies(client, Strategy(0.01, RuntimeError('down')), Strategy(0.05, DOCS))
+  assert asyncio.run(client.commons_depict_images('Q42')) == DOCS
+  assert wikimedia.cancelled == 0
+  assert client._health['sparql'].success_rate() == 0 and client._health['wikimedia'].success_rate() == 1
+
+def test_healthy_wcqs_is_tried_first_then_falls_back(client):
+  sparql, wikimedia = strategies(client, Strategy(0, None), Strategy(0, DOCS))
+  for _ in range(5):
+    client._health['sparql'].record(True, 0.1)
+  assert asyncio.run(client.commons_depict_images('Q42')) == DOCS
+  assert client._strategy_counters['sequential'] == 1 and client._strategy_counters['fallback'] == 1
+  assert sparql.calls == 1 and wikimedia.calls == 1
+
+def test_unhealthy_wcqs_is_skipped_between_probes(client):
+  sparql, wikimedia = strategies(client, Strategy(0, DOCS), Strategy(0, DOCS))
+  for _ in range(5):
+    client._health['sparql'].record(False, 1)
+  client._health['sparql'].probe_interval = 60
+  async def run():
+    # the first search probes WCQS, raced against the fallback
+    await client.commons_depict_images('Q42')
+    await client.commons_depict_images('Q42')
+  asyncio.run(run())
+  assert client._strategy_counters['raced'] == 1 and client._strategy_counters['skipped'] == 1
+  assert sparql.calls == 1 and wikimedia.calls == 2
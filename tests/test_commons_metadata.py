@@ -0,0 +1,67 @@
+import asyncio
+import importlib
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+import pytest
+
+from search.commons import CommonsClient
+from upstream.engine import UpstreamEngine
+
+class MediaWiki(httpx.AsyncBaseTransport):
+  '''Answers imageinfo queries, normalizing underscores as the API does.  Titles in
+  missing have no imageinfo.'''
+
+  def __init__(self, missing=()):
+    self.missing = set(missing)
+    self.requests = []
+
+  async def handle_async_request(self, request):
+    titles = parse_qs(urlparse(str(request.url)).query)['titles'][0].split('|')
+    self.requests.append(titles)
+    await asyncio.sleep(0.02)
+    normalized = [{'from': title, 'to': title.replace('_', ' ')} for title in titles if '_' in title]
+    pages = {}
+    for idx, title in enumerate([title.replace('_', ' ') for title in titles]):
+      page = {'title': title}
+      if title not in self.missing:
+        page['imageinfo'] = [{'size': 1, 'extmetadata': {'LicenseUrl': {'value': 'https://creativecommons.org/licenses/by/4.0'}}}]
+      pages[str(len(self.requests) * 1000 + idx)] = page
+    return httpx.Response(200, json={'query': {'normalized': normalized, 'pages': pages}})
+
+@pytest.fixture
+def mediawiki(monkeypatch):
+  transport = MediaWiki(missing={'File:Gone.jpg'})
+  monkeypatch.setattr(importlib.import_module('search.commons'), 'engine', UpstreamEngine(transport=transport))
+  return transport
+
+@pytest.fixture
+def commons(mediawiki):
+  return CommonsClient()
+
+def test_metadata_is_fetched_once_per_title(commons, mediawiki):
+  async def run():
+    first = await commons.image_metadata(['A_b.jpg', 'Gone.jpg'])
+    return first, await commons.image_metadata(['A b.jpg', 'Gone.jpg', 'C.jpg'])
+  first, second = asyncio.run(run())
+  assert first['A b.jpg']['rights'] == 'https://creativecommons.org/licenses/by/4.0' and first['A b.jpg']['title'] == 'A_b.jpg'
+  # files without imageinfo are cached as empty
+  assert first['Gone.jpg'] == {} and second['Gone.jpg'] == {}
+  assert sorted(second) == ['A b.jpg', 'C.jpg', 'Gone.jpg']
+  assert [sorted(titles) for titles in mediawiki.requests] == [['File:A b.jpg', 'File:Gone.jpg'], ['File:C.jpg']]
+  assert commons._metadata_counters == {'hits': 2, 'misses': 3, 'coalesced': 0}
+
+def test_concurrent_requests_share_fetches(commons, mediawiki):
+  async def run():
+    return await asyncio.gather(commons.image_metadata(['A.jpg', 'B.jpg']), commons.image_metadata(['B.jpg', 'C.jpg']))
+  first, second = asyncio.run(run())
+  assert sorted(first) == ['A.jpg', 'B.jpg'] and sorted(second) == ['B.jpg', 'C.jpg']
+  assert first['B.jpg'] == second['B.jpg']
+  assert sorted([title for titles in mediawiki.requests for title in titles]) == ['File:A.jpg', 'File:B.jpg', 'File:C.jpg']
+  assert commons._metadata_counters['coalesced'] == 1
+
+def test_titles_are_fetched_in_chunks(commons, mediawiki):
+  titles = [f'F{idx}.jpg' for idx in range(120)]
+  metadata = asyncio.run(commons.image_metadata(titles))
+  assert len(metadata) == 120 and all('pageid' in fields for fields in metadata.values())
+  assert sorted([len(titles) for titles in mediawiki.requests]) == [20, 50, 50]
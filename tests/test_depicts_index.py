@@ -0,0 +1,71 @@
+import gzip
+import json
+
+import pytest
+
+from search.commons import CommonsClient
+from search.depicts import DepictsIndex, build_index
+
+def statement(prop, value, rank='normal'):
+  datavalue = {'value': {'id': value} if value.startswith('Q') else value}
+  return {'mainsnak': {'property': prop, 'datavalue': datavalue}, 'rank': rank}
+
+ITEMS = [
+  # painting of Q5 with a preferred depicts: only the truthy (preferred) value is indexed
+  {'type': 'item', 'id': 'Q100', 'claims': {
+    'P18': [statement('P18', 'Painting.jpg')],
+    'P180': [statement('P180', 'Q5', 'preferred'), statement('P180', 'Q6')]}},
+  # another item sharing the image
+  {'type': 'item', 'id': 'Q101', 'claims': {
+    'P18': [statement('P18', 'Painting.jpg')],
+    'P180': [statement('P180', 'Q5'), statement('P180', 'Q7', 'deprecated')]}},
+  {'type': 'item', 'id': 'Q102', 'claims': {'P31': [statement('P31', 'Q3305213')]}}
+]
+MEDIAINFO = [
+  {'type': 'mediainfo', 'id': 'M1', 'title': 'File:Photo of Q5.jpg', 'statements': {
+    'P180': [statement('P180', 'Q5', 'preferred'), statement('P180', 'Q6')],
+    'P6243': [statement('P6243', 'Q100')]}},
+  {'type': 'mediainfo', 'id': 'M2', 'title': 'File:Painting.jpg', 'statements': {
+    'P180': [statement('P180', 'Q5')]}}
+]
+
+@pytest.fixture
+def index_path(tmp_path):
+  items = tmp_path / 'wikidata.json'
+  items.write_text('[\n' + ',\n'.join([json.dumps(entity) for entity in ITEMS]) + '\n]\n')
+  mediainfo = tmp_path / 'commons.json.gz'
+  with gzip.open(mediainfo, 'wt') as fp:
+    fp.write('\n'.join([json.dumps(entity) for entity in MEDIAINFO]))
+  path = str(tmp_path / 'depicts.idx')
+  build_index([str(items), str(mediainfo)], path)
+  return path
+
+def test_images_are_indexed_under_truthy_depicts(index_path):
+  index = DepictsIndex(index_path)
+  # Q6 is outranked by the preferred Q5 and Q7 deprecated, as wdt:P180 would match
+  assert 'Q5' in index and 'Q6' not in index and 'Q7' not in index and 'Q100' not in index and 'X' not in index
+  assert len(index) == 1
+  assert sorted([(image['title'], image['from_wikidata']) for image in index.images('Q5')]) == [
+    ('Painting.jpg', False), ('Painting.jpg', True), ('Painting.jpg', True), ('Photo of Q5.jpg', False)]
+  assert index.images('Q8') == []
+
+def test_records_round_trip(index_path):
+  photo = [image for image in DepictsIndex(index_path).images('Q5') if image['title'] == 'Photo of Q5.jpg'][0]
+  assert photo == {'title': 'Photo of Q5.jpg', 'from_wikidata': False, 'dro': 'Q100', 'depicts': [('Q5', True), ('Q6', False)]}
+
+def test_index_docs_match_the_sparql_docs(index_path):
+  client = CommonsClient()
+  client._depicts_index = DepictsIndex(index_path)
+  docs = dict([(doc['title'], doc) for doc in client.index_depict_images('Q5')])
+  assert sorted(docs) == ['Painting.jpg', 'Photo of Q5.jpg']
+  # the Commons record replaces the Wikidata ones for the same file
+  assert docs['Painting.jpg']['depicts'] == [{'id': 'Q5'}] and docs['Painting.jpg']['weight'] == 2
+  assert docs['Photo of Q5.jpg']['depicts'] == [{'id': 'Q5', 'prominent': True}, {'id': 'Q6', 'prominent': True}]
+  assert docs['Photo of Q5.jpg']['digital_representation_of'] == {'id': 'Q100'}
+  assert docs['Photo of Q5.jpg']['weight'] == 3
+
+def test_rejects_other_files(tmp_path):
+  path = tmp_path / 'other.idx'
+  path.write_bytes(b'NOTDEPIC' + b'\0' * 64)
+  with pytest.raises(ValueError):
+    DepictsIndex(str(path))
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from search.entities import EntityIndex, EntityLabels, build_index, normalize
+
+def entity(qid, labels, aliases=None):
+  return {'type': 'item', 'id': qid,
+    'labels': dict([(language, {'language': language, 'value': value}) for language, value in labels.items()]),
+    'aliases': dict([(language, [{'language': language, 'value': value} for value in values]) for language, values in (aliases or {}).items()])}
+
+ENTITIES = [
+  entity('Q90', {'en': 'Paris', 'fr': 'Paris'}, {'en': ['City of Light']}),
+  entity('Q167646', {'en': 'Paris'}),
+  entity('Q1', {'en': 'Universe', 'fr': 'Univers'}),
+  entity('Q2', {'en': 'Earth', 'fr': 'Terre'}, {'fr': ['Planète bleue']}),
+  entity('Q3', {'de': 'Leben'}),
+  entity('Q4', {'en': 'Parisian'})
+]
+
+@pytest.fixture
+def index_path(tmp_path):
+  dump = tmp_path / 'entities.json'
+  dump.write_text('[\n' + ',\n'.join([json.dumps(rec) for rec in ENTITIES]) + '\n]\n')
+  path = str(tmp_path / 'entities.idx')
+  build_index([str(dump)], path, ['en', 'fr'])
+  return path
+
+def test_normalize_folds_case_accents_and_spaces():
+  assert normalize('  Planète   BLEUE ') == 'planete bleue'
+
+def test_labels_by_language_with_fallback(index_path):
+  index = EntityIndex(index_path)
+  assert len(index) == 8
+  assert index.label('Q2', 'fr') == 'Terre' and index.label('Q2') == 'Earth'
+  assert index.label('Q4', 'fr') == 'Parisian'
+  assert index.label('Q3') is None and index.label('Q5') is None and index.label('x') is None
+
+def test_terms_are_read_in_term_order_from_the_prefix(index_path):
+  rows = list(EntityIndex(index_path).terms('paris'))
+  assert [(term, qnum, language, alias) for term, qnum, language, alias, text in rows] == [
+    ('paris', 90, 'en', False), ('paris', 90, 'fr', False), ('paris', 167646, 'en', False), ('parisian', 4, 'en', False)]
+  assert len(list(EntityIndex(index_path).terms('paris', scan=2))) == 2
+
+def test_lookup_ranks_exact_matches_labels_and_language(index_path):
+  entities = EntityLabels(index_path)
+  assert [rec['id'] for rec in entities.lookup('PARIS')] == ['Q90', 'Q167646', 'Q4']
+  assert entities.lookup('planete', 'fr') == [{'id': 'Q2', 'label': 'Terre', 'match': 'Planète bleue'}]
+  # aliases of other languages than the requested and fallback ones are not matched
+  assert entities.lookup('planete', 'en') == []
+  assert entities.lookup('city of l') == [{'id': 'Q90', 'label': 'Paris', 'match': 'City of Light'}]
+  assert entities.lookup('leben', 'de') == [] and entities.lookup('  ') == []
+
+def test_runtime_labels_are_searchable_and_bounded(index_path):
+  entities = EntityLabels(index_path, overlay_max=2)
+  entities.add({'Q90': 'Paris', 'Q10': 'Parisii', 'Q11': 'Parthenon', 'x': 'ignored', 'Q12': ''})
+  # Q90's label is already in the index, the oldest runtime label is dropped for Q11
+  assert entities.stats()['overlay'] == 2
+  assert entities.label('Q10') == 'Parisii' and entities.label('Q11') == 'Parthenon'
+  # shorter terms rank first
+  assert [rec['id'] for rec in entities.lookup('paris')] == ['Q90', 'Q167646', 'Q10', 'Q4']
+  entities.add({'Q12': 'Zeus'})
+  assert entities.label('Q10') is None and entities.lookup('parisii') == []
+
+def test_without_index_only_runtime_labels_are_used():
+  entities = EntityLabels(None)
+  entities.add({'Q90': 'Paris'}, 'fr')
+  assert entities.label('Q90', 'fr') == 'Paris' and entities.label('Q90') is None
+  assert entities.lookup('par', 'fr') == [{'id': 'Q90', 'label': 'Paris', 'match': 'Paris'}]
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from search.jstor import JSTORClient
+
+@pytest.fixture
+def client():
+  client = JSTORClient()
+  client.calls = []
+  async def lookup(name, result):
+    client.calls.append(name)
+    await asyncio.sleep(0.01)
+    return result
+  client.get_wd_entity = lambda qid: lookup('entity', {'labels': {'en': {'value': 'Douglas Adams'}}, 'aliases': {}})
+  client.get_depicts_dois_labs = lambda qid: lookup('labs', ['10.2307/community.1'])
+  client.get_depicts_dois_wikidata = lambda qid: lookup('wikidata', [])
+  async def jstor_image_search(query, limit=10, page_mark=None, filter_queries=None):
+    client.calls.append(('search', page_mark))
+    return {'total': 0, 'results': [], 'paging': {'next': 'mark-2' if page_mark is None else None}}
+  client.jstor_image_search = jstor_image_search
+  return client
+
+def test_concurrent_stage_builds_are_coalesced(client):
+  async def run():
+    return await asyncio.gather(client.jstor_search('Q42', label=False), client.jstor_search('Q42', 'mark-2', label=False))
+  first, second = asyncio.run(run())
+  assert sorted([call for call in client.calls if isinstance(call, str)]) == ['entity', 'labs', 'wikidata']
+  assert first['page_mark'] == 'mark-2' and second['page_mark'] is None
+  assert client.stats()['stages']['singleflight']['coalesced'] == 3
+
+def test_later_pages_reuse_the_cached_stages(client):
+  async def run():
+    await client.jstor_search('Q43', label=False)
+    await client.jstor_search('Q43', 'mark-2', label=False)
+  asyncio.run(run())
+  assert [call for call in client.calls if isinstance(call, str)].count('entity') == 1
+  assert client.stats()['stages']['hits'] == 1
@@ -0,0 +1,134 @@
+import asyncio
+import importlib
+import itertools
+import re
+from urllib.parse import parse_qs
+
+import httpx
+import pytest
+
+from search.entities import EntityLabels, build_index
+from search.labels import LabelService
+from upstream.engine import UpstreamEngine
+
+namespaces = itertools.count()
+
+class SparqlLabels(httpx.AsyncBaseTransport):
+  '''Answers label queries with the English label "label Q<n>" for every QID but the unknown
+  ones, and the labels of french in French.'''
+
+  def __init__(self, unknown=(), french=None):
+    self.unknown = set(unknown)
+    self.french = french or {}
+    self.queries = []
+
+  async def handle_async_request(self, request):
+    await request.aread()
+    query = parse_qs(request.content.decode('utf-8'))['query'][0]
+    qids = re.findall(r'entity/(Q\d+)>', query)
+    self.queries.append(sorted(qids))
+    await asyncio.sleep(0.01)
+    labels = [(qid, 'en', f'label {qid}') for qid in qids if qid not in self.unknown]
+    if 'LANG(?label) = "fr"' in query:
+      labels += [(qid, 'fr', self.french[qid]) for qid in qids if qid in self.french]
+    return httpx.Response(200, json={'results': {'bindings': [
+      {'item': {'value': f'http://www.wikidata.org/entity/{qid}'}, 'label': {'type': 'literal', 'xml:lang': lang, 'value': label}} for qid, lang, label in labels]}})
+
+@pytest.fixture
+def sparql(monkeypatch):
+  transport = SparqlLabels(unknown={'Q9000004'}, french={'Q9300001': 'étiquette Q9300001'})
+  monkeypatch.setattr(importlib.import_module('search.labels'), 'engine', UpstreamEngine(transport=transport))
+  return transport
+
+def new_service(**kwargs):
+  return LabelService(namespace=f'labels-test-{next(namespaces)}', **kwargs)
+
+@pytest.fixture
+def service():
+  return new_service()
+
+def test_misses_are_queried_in_chunks_then_cached(sparql):
+  service = new_service(chunk_size=2)
+  qids = [f'Q900000{idx}' for idx in range(5)]
+  async def run():
+    return await service.get_labels(qids), await service.get_labels(qids)
+  first, second = asyncio.run(run())
+  assert first == second == {**dict([(qid, f'label {qid}') for qid in qids]), 'Q9000004': ''}
+  assert sorted([len(chunk) for chunk in sparql.queries]) == [1, 2, 2]
+  assert sorted(sum(sparql.queries, [])) == qids
+  assert service.counters['misses'] == 5 and service.counters['hits'] == 5
+
+def test_concurrent_callers_share_queries(sparql, service):
+  async def run():
+    return await asyncio.gather(
+      service.get_labels(['Q9100001', 'Q9100002']),
+      service.get_labels(['Q9100002', 'Q9100003']))
+  first, second = asyncio.run(run())
+  assert first == {'Q9100001': 'label Q9100001', 'Q9100002': 'label Q9100002'}
+  assert second == {'Q9100002': 'label Q9100002', 'Q9100003': 'label Q9100003'}
+  assert sorted(sparql.queries) == [['Q9100001', 'Q9100002'], ['Q9100003']]
+  assert service.counters['coalesced'] == 1
+
+def test_add_labels_labels_depicts_and_dro(sparql, service):
+  docs = [{'depicts': [{'id': 'Q9200001'}, {'id': 'Q9200002', 'label': 'kept'}], 'digital_representation_of': {'id': 'Q9200003'}}]
+  asyncio.run(service.add_labels(docs))
+  assert docs == [{'depicts': [{'id': 'Q9200001', 'label': 'label Q9200001'}, {'id': 'Q9200002', 'label': 'label Q9200002'}],
+    'digital_representation_of': {'id': 'Q9200003', 'label': 'label Q9200003'}}]
+  assert len(sparql.queries) == 1
+
+def test_labels_in_other_languages_are_not_hits(sparql, service):
+  async def run():
+    english = await service.get_labels(['Q9300001', 'Q9300002'])
+    return english, await service.get_labels(['Q9300001', 'Q9300002'], 'fr'), await service.get_labels(['Q9300001', 'Q9300002'], 'fr')
+  english, french, cached = asyncio.run(run())
+  assert english == {'Q9300001': 'label Q9300001', 'Q9300002': 'label Q9300002'}
+  # the cached English labels do not answer the French request, Q9300002 has no French label
+  assert french == cached == {'Q9300001': 'étiquette Q9300001', 'Q9300002': 'label Q9300002'}
+  assert len(sparql.queries) == 2
+  assert service.counters['hits'] == 2
+
+def test_indexed_labels_in_the_fallback_language_are_not_hits(sparql, monkeypatch, tmp_path, service):
+  dump = tmp_path / 'entities.json'
+  dump.write_text('{"type": "item", "id": "Q9300001", "labels": {"en": {"language": "en", "value": "indexed"}}}\n')
+  build_index([str(dump)], str(tmp_path / 'entities.idx'), ['en', 'fr'])
+  monkeypatch.setattr(importlib.import_module('search.labels'), 'entities', EntityLabels(str(tmp_path / 'entities.idx')))
+  async def run():
+    return await service.get_labels(['Q9300001']), await service.get_labels(['Q9300001'], 'fr')
+  english, french = asyncio.run(run())
+  assert english == {'Q9300001': 'indexed'} and french == {'Q9300001': 'étiquette Q9300001'}
+  assert sparql.queries == [['Q9300001']]
+
+class InjectedLabels(SparqlLabels):
+  '''Also answers with a label for an item that was not asked for.'''
+
+  async def handle_async_request(self, request):
+    resp = await super().handle_async_request(request)
+    bindings = resp.json()['results']['bindings']
+    if 'Q9400099' not in [rec['item']['value'].split('/')[-1] for rec in bindings]:
+      bindings.append({'item': {'value': 'http://www.wikidata.org/entity/Q9400099'}, 'label': {'type': 'literal', 'xml:lang': 'en', 'value': 'pwned'}})
+    return httpx.Response(200, json={'results': {'bindings': bindings}})
+
+def test_malformed_qids_and_unrequested_bindings_are_ignored(monkeypatch, service):
+  transport = InjectedLabels()
+  monkeypatch.setattr(importlib.import_module('search.labels'), 'engine', UpstreamEngine(transport=transport))
+  async def run():
+    first = await service.get_labels(['Q9400001', 'Q42>) } BIND("pwned"@en AS ?label) } #'])
+    return first, await service.get_labels(['Q9400099'])
+  first, second = asyncio.run(run())
+  assert first == {'Q9400001': 'label Q9400001'}
+  assert transport.queries == [['Q9400001'], ['Q9400099']]
+  assert second == {'Q9400099': 'label Q9400099'}
+  with pytest.raises(ValueError):
+    asyncio.run(service.get_labels(['Q9400001'], 'en") || true || ("'))
+
+def test_expired_labels_are_queried_again(sparql, monkeypatch):
+  monkeypatch.setattr(importlib.import_module('search.labels'), 'entities', EntityLabels(None))
+  service = new_service(ttl=0.05)
+  async def run():
+    first = await service.get_labels(['Q9500001'])
+    await asyncio.sleep(0.1)
+    return first, await service.get_labels(['Q9500001'])
+  first, second = asyncio.run(run())
+  assert first == second == {'Q9500001': 'label Q9500001'}
+  # the runtime overlay still has the label, it does not outlive the cache entry
+  assert sparql.queries == [['Q9500001'], ['Q9500001']]
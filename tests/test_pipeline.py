@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from search.pipeline import Pipeline
+
+async def later(value, delay=0.01):
+  await asyncio.sleep(delay)
+  return value
+
+def test_stages_get_their_dependencies_results():
+  pipeline = Pipeline('test')
+  pipeline.add('a', lambda: later(1))
+  pipeline.add('b', lambda: later(2, 0.02))
+  pipeline.add('sum', lambda a, b: a + b, ['a', 'b'])
+  pipeline.add('double', lambda total: later(total * 2), ['sum'])
+  pipeline.value('given', 'x')
+  assert asyncio.run(pipeline.run()) == {'a': 1, 'b': 2, 'sum': 3, 'double': 6, 'given': 'x'}
+  assert pipeline.timings['sum'][0] >= pipeline.timings['b'][1]
+
+def test_independent_stages_run_concurrently():
+  pipeline = Pipeline('test')
+  for name in 'abcd':
+    pipeline.add(name, lambda: later(None, 0.1))
+  asyncio.run(pipeline.run())
+  assert max([end for _, end in pipeline.timings.values()]) < 0.3
+
+def test_failed_stage_yields_its_default():
+  def fail():
+    raise ValueError('upstream down')
+  pipeline = Pipeline('test')
+  pipeline.add('a', fail, default=[])
+  pipeline.add('count', len, ['a'])
+  assert asyncio.run(pipeline.run()) == {'a': [], 'count': 0}
+
+def test_failure_without_default_propagates_and_cancels_the_other_stages():
+  finished = []
+  async def slow():
+    await asyncio.sleep(0.2)
+    finished.append('slow')
+  async def fail():
+    await asyncio.sleep(0.01)
+    raise ValueError('upstream down')
+  pipeline = Pipeline('test')
+  pipeline.add('slow', slow)
+  pipeline.add('fail', fail)
+  pipeline.add('after', lambda value: finished.append('after'), ['fail'])
+  async def run():
+    with pytest.raises(ValueError):
+      await pipeline.run()
+    await asyncio.sleep(0.3)
+  asyncio.run(run())
+  assert finished == []
+
+def test_cancelling_run_cancels_running_stages():
+  finished = []
+  async def slow():
+    await asyncio.sleep(0.1)
+    finished.append('slow')
+  pipeline = Pipeline('test')
+  pipeline.add('slow', slow)
+  async def run():
+    task = asyncio.ensure_future(pipeline.run())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await task
+    await asyncio.sleep(0.2)
+  asyncio.run(run())
+  assert finished == []
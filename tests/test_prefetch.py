@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from search.prefetch import Prefetcher
+
+class Warm(object):
+  '''Warms a QID after delay seconds, failing for the QIDs in failing.'''
+
+  def __init__(self, delay=0.01, failing=()):
+    self.delay = delay
+    self.failing = set(failing)
+    self.warmed = []
+    self.running = 0
+    self.max_running = 0
+
+  async def __call__(self, qid, language='en'):
+    self.running += 1
+    self.max_running = max(self.max_running, self.running)
+    try:
+      await asyncio.sleep(self.delay)
+      if qid in self.failing:
+        raise RuntimeError('down')
+      self.warmed.append((qid, language))
+    finally:
+      self.running -= 1
+
+@pytest.fixture
+def warm():
+  return Warm()
+
+@pytest.fixture
+def prefetcher(warm):
+  return Prefetcher(warm, rate=1000, concurrency=2)
+
+def test_queued_and_recent_qids_are_deduplicated(prefetcher, warm):
+  async def run():
+    queued = [prefetcher.enqueue(['Q1', 'Q2', 'Q1'])]
+    await asyncio.sleep(0.1)
+    return queued + [prefetcher.enqueue(['Q1', 'Q3']), prefetcher.enqueue(['Q1'], 'fr')]
+  assert asyncio.run(run()) == [2, 1, 1]
+  assert sorted(warm.warmed) == [('Q1', 'en'), ('Q2', 'en')]
+  assert prefetcher.counters['deduplicated'] == 2
+
+def test_workers_are_bounded_and_full_queues_drop(warm):
+  prefetcher = Prefetcher(warm, max_depth=3, rate=1000, concurrency=2)
+  async def run():
+    queued = prefetcher.enqueue([f'Q{idx}' for idx in range(1, 6)])
+    await asyncio.sleep(0.2)
+    return queued
+  assert asyncio.run(run()) == 3
+  assert warm.max_running == 2 and len(warm.warmed) == 3
+  assert prefetcher.counters['dropped'] == 2
+
+def test_prefetches_are_rate_limited(warm):
+  prefetcher = Prefetcher(warm, rate=20, concurrency=4)
+  async def run():
+    prefetcher.enqueue([f'Q{idx}' for idx in range(1, 5)])
+    await asyncio.sleep(0.1)
+    return len(warm.warmed)
+  # at 20 per second only the first two of four have started within 0.1 s
+  assert asyncio.run(run()) <= 2
+
+def test_searches_after_a_prefetch_are_hits(prefetcher, warm):
+  warm.failing = {'Q3'}
+  async def run():
+    prefetcher.enqueue(['Q1', 'Q2', 'Q3'])
+    await asyncio.sleep(0)
+    prefetcher.claim('Q2')
+    await asyncio.sleep(0.1)
+    for qid in ('Q1', 'Q1', 'Q3'):
+      prefetcher.claim(qid)
+  asyncio.run(run())
+  stats = prefetcher.stats()
+  assert stats['completed'] == 2 and stats['failed'] == 1
+  # Q2 was searched while queued, Q1 counts once
+  assert stats['late'] == 1 and stats['hits'] == 1 and stats['hit_rate'] == 0.5
+
+def test_enqueue_outside_a_loop_does_nothing(prefetcher, warm):
+  assert prefetcher.enqueue(['Q1']) == 0
@@ -0,0 +1,75 @@
+import asyncio
+import importlib
+
+import pytest
+
+from search import BATCH_MAX_QIDS, SearchClient
+from search.commons import CommonsClient
+
+class Labels(object):
+  '''Labels every entity, recording the QIDs of each pass.'''
+
+  def __init__(self):
+    self.passes = []
+
+  async def add_labels(self, docs, language='en'):
+    self.passes.append(sorted(set([rec['id'] for doc in docs for rec in doc['depicts']])))
+    for doc in docs:
+      for rec in doc['depicts']:
+        rec['label'] = f'label {rec["id"]}'
+    return docs
+
+@pytest.fixture
+def labels(monkeypatch):
+  labels = Labels()
+  monkeypatch.setattr(importlib.import_module('search.commons'), 'labels', labels)
+  return labels
+
+@pytest.fixture
+def commons(labels):
+  commons = CommonsClient()
+  commons.collected, commons.running, commons.max_running, commons.metadata_passes = [], 0, 0, []
+  async def collect_depict_images(qid):
+    commons.collected.append(qid)
+    commons.running += 1
+    commons.max_running = max(commons.max_running, commons.running)
+    await asyncio.sleep(0.02)
+    commons.running -= 1
+    return [{'id': f'wc:{qid}-{idx}.jpg', 'title': f'{qid}-{idx}.jpg', 'weight': idx, 'depicts': [{'id': qid}]} for idx in range(3)]
+  async def image_metadata(titles):
+    commons.metadata_passes.append(sorted(titles))
+    return dict([(title, {'pageid': idx}) for idx, title in enumerate(titles)])
+  commons.collect_depict_images, commons.image_metadata = collect_depict_images, image_metadata
+  return commons
+
+def test_batch_shares_one_label_and_one_metadata_pass(commons, labels):
+  qids = [f'Q{idx}' for idx in range(1, 6)]
+  results = asyncio.run(commons.search_batch(qids, limit=2, concurrency=2))
+  assert sorted(commons.collected) == qids and commons.max_running == 2
+  assert labels.passes == [qids]
+  assert len(commons.metadata_passes) == 1 and len(commons.metadata_passes[0]) == 15
+  assert [doc['id'] for doc in results['Q1']['docs']] == ['wc:Q1-2.jpg', 'wc:Q1-1.jpg', 'wc:Q1-0.jpg']
+  assert results['Q1']['docs'][0]['depicts'] == [{'id': 'Q1', 'label': 'label Q1'}] and 'pageid' in results['Q1']['docs'][0]
+
+def test_concurrent_search_waits_on_the_batch(commons):
+  async def run():
+    batch = asyncio.ensure_future(commons.search_batch(['Q1', 'Q2']))
+    await asyncio.sleep(0)
+    return await commons.search('Q2'), await batch
+  single, batch = asyncio.run(run())
+  assert sorted(commons.collected) == ['Q1', 'Q2']
+  assert [doc['id'] for doc in single['docs']] == [doc['id'] for doc in batch['Q2']['docs']]
+
+def test_cached_qids_are_not_collected_again(commons):
+  async def run():
+    await commons.search_batch(['Q1'])
+    return await commons.search_batch(['Q1', 'Q2'])
+  asyncio.run(run())
+  assert commons.collected == ['Q1', 'Q2']
+
+def test_search_client_rejects_malformed_and_too_many_qids():
+  client = SearchClient()
+  with pytest.raises(ValueError):
+    asyncio.run(client.search_batch(['Q1', 'Q1>']))
+  with pytest.raises(ValueError):
+    asyncio.run(client.search_batch([f'Q{idx}' for idx in range(1, BATCH_MAX_QIDS + 2)]))
@@ -0,0 +1,64 @@
+import asyncio
+import importlib
+import json
+
+import pytest
+
+from search import SearchClient
+
+class SlowLabels(object):
+  '''Labels every entity after delay seconds.'''
+
+  def __init__(self, delay):
+    self.delay = delay
+    self.calls = 0
+
+  async def add_labels(self, docs, language='en'):
+    self.calls += 1
+    await asyncio.sleep(self.delay)
+    for doc in docs:
+      for rec in doc['depicts']:
+        rec['label'] = f'label {rec["id"]}'
+    return docs
+
+async def results(delay, docs):
+  await asyncio.sleep(delay)
+  return {'total': len(docs), 'docs': docs}
+
+@pytest.fixture
+def labels(monkeypatch):
+  labels = SlowLabels(0.01)
+  monkeypatch.setattr(importlib.import_module('search'), 'labels', labels)
+  return labels
+
+@pytest.fixture
+def client(labels):
+  client = SearchClient(source_budgets={})
+  client.source_delay = 0
+  client._searches = lambda qid, source, offset, limit, **kwargs: {
+    'commons': results(client.source_delay, [{'id': 'wc:a.jpg', 'title': 'A', 'weight': 2, 'pageid': 1, 'depicts': [{'id': 'Q5'}]}])
+  }
+  return client
+
+def test_labels_within_the_budget_are_added(client):
+  resp = asyncio.run(client.search('Q42', budget_ms=500))
+  assert resp['docs'][0]['depicts'] == [{'id': 'Q5', 'label': 'label Q5'}]
+  assert client.budget_counters['unlabelled'] == 0
+
+def test_labels_past_the_budget_are_left_out(client, labels):
+  labels.delay, client.source_delay = 0.3, 0.05
+  async def run():
+    resp = await client.search_json('Q42', ['id', 'depicts'], ['id', 'label'], budget_ms=100)
+    assert len(client._late) == 1
+    await asyncio.sleep(0.35)
+    return resp
+  resp = json.loads(asyncio.run(run()))
+  assert resp['docs'] == [{'id': 'wc:a.jpg', 'depicts': [{'id': 'Q5'}]}]
+  assert client.budget_counters['unlabelled'] == 1 and client.budget_counters['late_completed'] == 1
+  # the unlabelled page is not cached
+  assert client._pages.stats()['pages'] == 0
+
+def test_labels_are_awaited_without_a_budget(client, labels):
+  labels.delay = 0.2
+  resp = asyncio.run(client.search('Q42'))
+  assert resp['docs'][0]['depicts'] == [{'id': 'Q5', 'label': 'label Q5'}]
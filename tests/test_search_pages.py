@@ -0,0 +1,57 @@
+import asyncio
+import importlib
+import json
+
+import pytest
+
+from search import SearchClient
+
+class Labels(object):
+  '''Labels every entity, unless failing.'''
+
+  def __init__(self):
+    self.failing = False
+
+  async def add_labels(self, docs, language='en'):
+    if not self.failing:
+      for doc in docs:
+        for rec in doc['depicts']:
+          rec['label'] = f'label {rec["id"]}'
+    return docs
+
+async def results(docs):
+  return {'total': len(docs), 'docs': docs}
+
+@pytest.fixture
+def labels(monkeypatch):
+  labels = Labels()
+  monkeypatch.setattr(importlib.import_module('search'), 'labels', labels)
+  return labels
+
+@pytest.fixture
+def client(labels):
+  client = SearchClient(source_budgets={})
+  client.docs = [{'id': 'wc:a.jpg', 'title': 'A', 'weight': 2, 'pageid': 1, 'depicts': [{'id': 'Q5'}]}]
+  client._searches = lambda qid, source, offset, limit, **kwargs: {'commons': results([dict(doc, depicts=[dict(rec) for rec in doc['depicts']]) for doc in client.docs])}
+  return client
+
+def search(client, depicts_fields=('id', 'label')):
+  return json.loads(asyncio.run(client.search_json('Q42', ['id', 'depicts'], list(depicts_fields))))
+
+def test_pages_are_cached_per_depicts_fields(client):
+  assert search(client)['docs'] == [{'id': 'wc:a.jpg', 'depicts': [{'id': 'Q5', 'label': 'label Q5'}]}]
+  assert search(client, ['id'])['docs'] == [{'id': 'wc:a.jpg', 'depicts': [{'id': 'Q5'}]}]
+  assert client._pages.stats()['pages'] == 2
+
+def test_pages_without_metadata_are_not_cached(client):
+  del client.docs[0]['pageid']
+  search(client)
+  assert client._pages.stats()['pages'] == 0
+
+def test_pages_without_labels_are_not_cached(client, labels):
+  labels.failing = True
+  assert search(client)['docs'] == [{'id': 'wc:a.jpg', 'depicts': [{'id': 'Q5'}]}]
+  assert client._pages.stats()['pages'] == 0
+  labels.failing = False
+  assert search(client)['docs'] == [{'id': 'wc:a.jpg', 'depicts': [{'id': 'Q5', 'label': 'label Q5'}]}]
+  assert client._pages.stats()['pages'] == 1
@@ -0,0 +1,50 @@
+import asyncio
+from time import time as now
+
+import pytest
+
+from search.commons import CACHE_HARD_TTL, CACHE_SOFT_TTL, CommonsClient
+
+def docs(version):
+  return [{'id': f'wc:{version}.jpg', 'title': f'{version}.jpg', 'pageid': 1, 'weight': 1, 'depicts': []}]
+
+@pytest.fixture
+def client():
+  client = CommonsClient()
+  client.collected = []
+  async def collect_depict_images(qid):
+    client.collected.append(qid)
+    await asyncio.sleep(0.01)
+    return docs('new')
+  client.collect_depict_images = collect_depict_images
+  return client
+
+def test_fresh_entry_is_served_without_refresh(client):
+  client._cache.set('Q42', docs('old'), stored=now() - CACHE_SOFT_TTL + 60)
+  async def run():
+    results = await client.search('Q42')
+    await asyncio.sleep(0.05)
+    return results
+  results = asyncio.run(run())
+  assert results['docs'] == docs('old') and results['stale'] is False
+  assert client.collected == []
+
+def test_entry_past_soft_ttl_is_served_stale_and_refreshed(client):
+  client._cache.set('Q42', docs('old'), stored=now() - CACHE_SOFT_TTL - 60)
+  async def run():
+    stale = await asyncio.gather(client.search('Q42'), client.search('Q42'))
+    await asyncio.sleep(0.05)
+    return stale, await client.search('Q42')
+  stale, refreshed = asyncio.run(run())
+  assert [results['docs'] for results in stale] == [docs('old')] * 2
+  assert all(results['stale'] for results in stale)
+  # one background refresh for both stale reads
+  assert client.collected == ['Q42']
+  assert refreshed['docs'] == docs('new') and refreshed['stale'] is False
+  assert client.stats()['cache']['stale'] == 2
+
+def test_entry_past_hard_ttl_is_refetched(client):
+  client._cache.set('Q42', docs('old'), stored=now() - CACHE_HARD_TTL - 60)
+  results = asyncio.run(client.search('Q42'))
+  assert results['docs'] == docs('new') and results['stale'] is False
+  assert client.collected == ['Q42']
@@ -0,0 +1,67 @@
+import asyncio
+import importlib
+
+import pytest
+
+from search import SearchClient
+
+DOC_FIELDS = ['seq', 'id', 'title', 'weight']
+
+async def results(docs):
+  return {'total': len(docs), 'docs': docs}
+
+class FakeLabels(object):
+
+  async def add_labels(self, docs, language='en'):
+    for doc in docs:
+      for rec in doc.get('depicts', []):
+        rec['label'] = f'label {rec["id"]}'
+    return docs
+
+@pytest.fixture
+def client(monkeypatch):
+  monkeypatch.setattr(importlib.import_module('search'), 'labels', FakeLabels())
+  client = SearchClient()
+  client.searched = []
+  def searches(qid, source, offset, limit, **kwargs):
+    client.searched.append(kwargs)
+    return {
+      'commons': results([{'id': f'wc:{idx}.jpg', 'weight': 10-idx, 'depicts': [{'id': f'Q{idx+1}'}]} for idx in range(3)]),
+      'jstor': results([{'id': f'jstor:{idx}', 'weight': 10-idx-0.5} for idx in range(3)])
+    }
+  client._searches = searches
+  return client
+
+def test_stream_docs_are_projected():
+  client = SearchClient()
+  client._searches = lambda qid, source, offset, limit, **kwargs: {
+    'commons': results([{'id': 'wc:a.jpg', 'title': 'A', 'weight': 2, 'pageid': 1, 'depicts': []}]),
+    'jstor': results([{'id': 'jstor:1', 'title': 'B', 'weight': 1, 'doi': '10.2307/1'}])
+  }
+  async def run():
+    return [message async for message in client.stream('Q42', DOC_FIELDS, ['id'], limit=2)]
+  messages = asyncio.run(run())
+  assert [message['event'] for message in messages] == ['source', 'source', 'done']
+  for message in messages:
+    for doc in message['docs']:
+      assert list(doc) == [fld for fld in DOC_FIELDS if fld in doc]
+  assert [doc['id'] for doc in messages[-1]['docs']] == ['wc:a.jpg', 'jstor:1']
+  assert messages[-1]['total'] == 2
+
+def test_stream_labels_the_merged_page(client):
+  async def run():
+    return [message async for message in client.stream('Q42', ['id', 'depicts'], ['id', 'label'], limit=2)]
+  messages = asyncio.run(run())
+  assert client.searched == [{'label': True}]
+  assert messages[-1]['docs'] == [
+    {'id': 'wc:0.jpg', 'depicts': [{'id': 'Q1', 'label': 'label Q1'}]},
+    {'id': 'jstor:0'}]
+
+def test_stream_source_docs_only_on_the_first_page(client):
+  async def run():
+    return [message async for message in client.stream('Q42', ['id'], ['id'], offset=2, limit=2)]
+  messages = asyncio.run(run())
+  assert client.searched == [{'label': False}]
+  assert [message['docs'] for message in messages[:-1]] == [[], []]
+  assert [message['total'] for message in messages[:-1]] == [3, 3]
+  assert [doc['id'] for doc in messages[-1]['docs']] == ['wc:1.jpg', 'jstor:1']
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from search.singleflight import SingleFlight
+
+def test_concurrent_calls_share_one_execution():
+  flights = SingleFlight()
+  calls = []
+  async def fetch(key):
+    calls.append(key)
+    await asyncio.sleep(0.01)
+    return {'key': key}
+  async def run():
+    return await asyncio.gather(*[flights.do('Q42', fetch, 'Q42') for _ in range(5)], flights.do('Q1', fetch, 'Q1'))
+  results = asyncio.run(run())
+  assert calls == ['Q42', 'Q1']
+  assert results[:5] == [{'key': 'Q42'}] * 5 and results[5] == {'key': 'Q1'}
+  assert flights.stats() == {'calls': 6, 'executed': 2, 'coalesced': 4, 'inflight': 0}
+
+def test_errors_reach_every_waiter_and_are_not_cached():
+  flights = SingleFlight()
+  calls = []
+  async def fetch():
+    calls.append(1)
+    await asyncio.sleep(0.01)
+    if len(calls) == 1:
+      raise ValueError('upstream down')
+    return 'ok'
+  async def run():
+    failed = await asyncio.gather(*[flights.do('Q42', fetch) for _ in range(3)], return_exceptions=True)
+    return failed, await flights.do('Q42', fetch)
+  failed, retried = asyncio.run(run())
+  assert all(isinstance(exc, ValueError) for exc in failed)
+  assert retried == 'ok' and len(calls) == 2
+
+def test_cancelled_caller_does_not_cancel_the_others():
+  flights = SingleFlight()
+  async def fetch():
+    await asyncio.sleep(0.02)
+    return 'done'
+  async def run():
+    first = asyncio.ensure_future(flights.do('Q42', fetch))
+    second = asyncio.ensure_future(flights.do('Q42', fetch))
+    await asyncio.sleep(0.005)
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await first
+    return await second
+  assert asyncio.run(run()) == 'done'
+
+def test_spawn_skips_keys_in_flight():
+  flights = SingleFlight()
+  calls = []
+  async def fetch():
+    calls.append(1)
+    await asyncio.sleep(0.01)
+  async def run():
+    flights.spawn('Q42', fetch)
+    await asyncio.sleep(0)
+    assert flights.running('Q42')
+    flights.spawn('Q42', fetch)
+    await asyncio.sleep(0.02)
+    assert not flights.running('Q42')
+  asyncio.run(run())
+  assert len(calls) == 1
@@ -0,0 +1,104 @@
+import asyncio
+import gzip
+import pickle
+import threading
+from time import time as now
+
+from cache.memory import MemoryCache
+from cache.snapshot import Snapshotter, collect, decode, dump, encode, load
+
+def new_caches():
+  return {'commons': MemoryCache('commons', max_len=None), 'labels': MemoryCache('labels', max_len=None)}
+
+def new_snapshotter(path, caches, **kwargs):
+  snapshotter = Snapshotter(str(path), **kwargs)
+  snapshotter.caches = lambda: caches
+  return snapshotter
+
+def test_dump_and_load_keep_values_and_ages():
+  caches = new_caches()
+  stored = now() - 100
+  caches['commons'].set('Q42', [{'id': 'wc:a.jpg'}], ttl=1000, stored=stored)
+  caches['labels'].set('en:Q42', 'Douglas Adams', ttl=1000, stored=stored)
+  caches['labels'].set('en:Q1', 'expired', ttl=10, stored=stored)
+  restored = new_caches()
+  assert load(dump(caches), restored) == {'commons': 1, 'labels': 1}
+  assert restored['commons'].get_entry('Q42') == ([{'id': 'wc:a.jpg'}], stored)
+  assert restored['labels'].get('en:Q42') == 'Douglas Adams' and restored['labels'].get('en:Q1') is None
+
+def test_dump_keeps_the_most_recently_used_entries():
+  caches = {'labels': MemoryCache('labels', max_len=None)}
+  for idx in range(5):
+    caches['labels'].set(f'en:Q{idx}', f'label {idx}')
+  caches['labels'].get('en:Q0')
+  assert [key for key, *_ in decode(dump(caches, max_entries=2))['labels']] == ['en:Q0', 'en:Q4']
+
+def test_load_skips_entries_stored_since_and_other_versions():
+  caches = new_caches()
+  caches['labels'].set('en:Q42', 'old', stored=now() - 100)
+  data = dump(caches)
+  restored = new_caches()
+  restored['labels'].set('en:Q42', 'new')
+  assert load(data, restored) == {'commons': 0, 'labels': 0} and restored['labels'].get('en:Q42') == 'new'
+  other = gzip.compress(pickle.dumps({'version': 0, 'namespaces': {}}))
+  assert load(other, restored) is None
+
+def test_snapshotter_round_trip(tmp_path):
+  path = tmp_path / 'snapshot.pkl.gz'
+  caches = new_caches()
+  caches['labels'].set('en:Q42', 'Douglas Adams')
+  async def run(snapshotter):
+    await snapshotter.start()
+    await snapshotter.stop()
+  writer = new_snapshotter(path, caches, interval=60)
+  asyncio.run(run(writer))
+  assert path.exists() and writer.stats()['writes'] == 1 and writer.stats()['errors'] == 0
+
+  restored = new_caches()
+  reader = new_snapshotter(path, restored, interval=0)
+  asyncio.run(run(reader))
+  assert restored['labels'].get('en:Q42') == 'Douglas Adams'
+  assert reader.stats()['loaded'] == 1 and reader.stats()['writes'] == 0
+
+def test_periodic_writes(tmp_path):
+  path = tmp_path / 'snapshot.pkl.gz'
+  caches = new_caches()
+  snapshotter = new_snapshotter(path, caches, interval=0.05)
+  async def run():
+    await snapshotter.start()
+    caches['commons'].set('Q42', [])
+    await asyncio.sleep(0.2)
+    return snapshotter.stats()['writes']
+  assert asyncio.run(run()) >= 2
+  assert decode(path.read_bytes())['commons'][0][:2] == ('Q42', [])
+
+def test_collected_entries_do_not_change_with_the_cache():
+  caches = new_caches()
+  docs = [{'id': 'wc:a.jpg', 'depicts': [{'id': 'Q42'}]}]
+  caches['commons'].set('Q42', docs)
+  namespaces = collect(caches)
+  docs[0]['depicts'][0]['label'] = 'Douglas Adams'
+  docs.append({'id': 'wc:b.jpg'})
+  assert decode(encode(namespaces))['commons'][0][1] == [{'id': 'wc:a.jpg', 'depicts': [{'id': 'Q42'}]}]
+
+def test_entries_are_read_on_the_loop_and_encoded_off_it(tmp_path, monkeypatch):
+  caches = new_caches()
+  caches['labels'].set('en:Q42', 'Douglas Adams')
+  threads = {}
+  entries = caches['labels'].entries
+  def read_entries(limit=None):
+    threads['entries'] = threading.current_thread()
+    return entries(limit)
+  monkeypatch.setattr(caches['labels'], 'entries', read_entries)
+  snapshotter = new_snapshotter(tmp_path / 'snapshot.pkl.gz', caches, interval=60)
+  write = snapshotter.write
+  def record_write(namespaces=None):
+    threads['write'] = threading.current_thread()
+    write(namespaces)
+  snapshotter.write = record_write
+  async def run():
+    await snapshotter.start()
+    await snapshotter.stop()
+  asyncio.run(run())
+  assert threads['entries'] is threading.main_thread() and threads['write'] is not threading.main_thread()
+  assert snapshotter.stats()['writes'] == 1
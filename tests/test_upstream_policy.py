@@ -0,0 +1,135 @@
+import asyncio
+import importlib
+
+import httpx
+import pytest
+
+from upstream.engine import UpstreamEngine
+from upstream.policy import CircuitBreaker, CircuitOpenError, UpstreamPolicy
+
+HOST = 'query.wikidata.org'
+
+class Transport(httpx.AsyncBaseTransport):
+  '''Answers requests with status after delays[n] seconds for the nth request.'''
+
+  def __init__(self, status=200, delays=()):
+    self.status = status
+    self.delays = list(delays)
+    self.requests = 0
+
+  async def handle_async_request(self, request):
+    delay = self.delays[self.requests] if self.requests < len(self.delays) else 0
+    self.requests += 1
+    await asyncio.sleep(delay)
+    return httpx.Response(self.status, json={'n': self.requests})
+
+@pytest.fixture
+def policy(monkeypatch):
+  policy = UpstreamPolicy()
+  monkeypatch.setattr(importlib.import_module('upstream.engine'), 'policy', policy)
+  return policy
+
+def test_breaker_opens_after_threshold_failures():
+  breaker = CircuitBreaker(HOST, threshold=3, reset_seconds=60)
+  for _ in range(2):
+    breaker.record(False)
+  assert breaker.allow() is False and breaker.state == 'closed'
+  breaker.record(False)
+  assert breaker.state == 'open'
+  with pytest.raises(CircuitOpenError):
+    breaker.allow()
+  assert breaker.stats() == {'trips': 1, 'rejected': 1, 'probes': 0, 'state': 'open', 'failures': 3}
+
+def test_success_resets_the_failure_count():
+  breaker = CircuitBreaker(HOST, threshold=2)
+  breaker.record(False)
+  breaker.record(True)
+  breaker.record(False)
+  assert breaker.state == 'closed'
+
+def test_half_open_lets_one_probe_through():
+  breaker = CircuitBreaker(HOST, threshold=1, reset_seconds=0.01)
+  breaker.record(False)
+  asyncio.run(asyncio.sleep(0.02))
+  assert breaker.allow() is True and breaker.state == 'half_open'
+  with pytest.raises(CircuitOpenError):
+    breaker.allow()
+  breaker.record(True)
+  assert breaker.state == 'closed' and breaker.allow() is False
+
+def test_failed_probe_reopens_the_breaker():
+  breaker = CircuitBreaker(HOST, threshold=1, reset_seconds=0.01)
+  breaker.record(False)
+  asyncio.run(asyncio.sleep(0.02))
+  assert breaker.allow() is True
+  breaker.record(False)
+  assert breaker.state == 'open'
+  with pytest.raises(CircuitOpenError):
+    breaker.allow()
+
+def test_released_or_lost_probe_is_replaced():
+  breaker = CircuitBreaker(HOST, threshold=1, reset_seconds=0.05)
+  breaker.record(False)
+  asyncio.run(asyncio.sleep(0.06))
+  assert breaker.allow() is True
+  breaker.release()
+  assert breaker.allow() is True
+  asyncio.run(asyncio.sleep(0.06))
+  assert breaker.allow() is True
+
+def test_unknown_hosts_get_no_breaker_or_latencies():
+  policy = UpstreamPolicy()
+  for _ in range(10):
+    policy.observe('example.org', 1, ok=False)
+  assert policy.allow('example.org') is False
+  assert policy.stats()['hosts'] == {} and policy.counters['failures'] == 10
+
+def test_engine_fails_fast_while_open(policy):
+  transport = Transport(status=503)
+  engine = UpstreamEngine(transport=transport)
+  async def run():
+    for _ in range(5):
+      assert (await engine.get(f'https://{HOST}/sparql')).status_code == 503
+    with pytest.raises(CircuitOpenError):
+      await engine.get(f'https://{HOST}/sparql')
+  asyncio.run(run())
+  assert transport.requests == 5 and policy.breaker(HOST).state == 'open'
+
+def test_engine_releases_a_cancelled_probe(policy):
+  breaker = policy.breaker(HOST)
+  breaker.reset_seconds = 0.05
+  for _ in range(5):
+    breaker.record(False)
+  engine = UpstreamEngine(transport=Transport(delays=[1, 0]))
+  async def run():
+    await asyncio.sleep(0.06)
+    probe = asyncio.ensure_future(engine.get(f'https://{HOST}/sparql'))
+    await asyncio.sleep(0.01)
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await probe
+    return await engine.get(f'https://{HOST}/sparql')
+  assert asyncio.run(run()).status_code == 200
+  assert breaker.state == 'closed'
+
+def test_slow_get_is_hedged_and_the_first_response_wins(policy):
+  for _ in range(20):
+    policy.observe(HOST, 0.01)
+  transport = Transport(delays=[0.5, 0])
+  engine = UpstreamEngine(transport=transport)
+  async def run():
+    return await engine.get(f'https://{HOST}/sparql')
+  resp = asyncio.run(run())
+  assert resp.json() == {'n': 2} and transport.requests == 2
+  assert policy.counters['hedges'] == 1 and policy.counters['hedge_wins'] == 1
+
+def test_fast_gets_and_posts_are_not_hedged(policy):
+  for _ in range(20):
+    policy.observe(HOST, 0.05)
+  transport = Transport(delays=[0, 0.2])
+  engine = UpstreamEngine(transport=transport)
+  async def run():
+    await engine.get(f'https://{HOST}/sparql')
+    await engine.post(f'https://{HOST}/sparql')
+  asyncio.run(run())
+  assert transport.requests == 2 and policy.counters['hedges'] == 0
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from upstream.engine import UpstreamEngine
+from upstream.sessions import SessionRegistry
+
+class Handler(BaseHTTPRequestHandler):
+  '''Echoes the request headers, setting a cookie.  Connections are counted by client port.'''
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    self.server.ports.add(self.client_address[1])
+    body = json.dumps(dict(self.headers)).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('Set-Cookie', 'session=user-1; Path=/')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+class Echo(httpx.AsyncBaseTransport):
+
+  async def handle_async_request(self, request):
+    return httpx.Response(200, json=dict(request.headers))
+
+@pytest.fixture
+def server():
+  server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  server.ports = set()
+  thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+@pytest.fixture
+def registry():
+  registry = SessionRegistry(pool_sizes={'127.0.0.1': 2})
+  yield registry
+  registry.close()
+
+def test_pooled_hosts_reuse_one_session_and_connection(registry, server):
+  url = f'http://127.0.0.1:{server.server_port}/'
+  for _ in range(3):
+    registry.request('127.0.0.1', 'GET', url)
+  assert registry.session('127.0.0.1') is registry.session('127.0.0.1')
+  assert registry.session('127.0.0.1').get_adapter(url)._pool_maxsize == 2
+  assert len(server.ports) == 1
+  assert registry.stats() == {'127.0.0.1': 2}
+
+def test_other_hosts_are_not_pooled(registry, server):
+  url = f'http://localhost:{server.server_port}/'
+  for _ in range(2):
+    registry.request('localhost', 'GET', url)
+  assert registry.session('localhost') is None and len(server.ports) == 2
+
+def test_sessions_send_default_headers_and_no_cookies(registry, server):
+  url = f'http://127.0.0.1:{server.server_port}/'
+  registry.request('127.0.0.1', 'GET', url)
+  headers = registry.request('127.0.0.1', 'GET', url, headers={'Accept': 'text/plain'}).json()
+  assert headers['User-Agent'] == 'Labs Client' and headers['Accept'] == 'text/plain'
+  # a cookie set for one user is not sent with the next request
+  assert 'Cookie' not in headers and len(registry.session('127.0.0.1').cookies) == 0
+
+def test_github_sessions_get_the_api_headers():
+  registry = SessionRegistry()
+  headers = registry.session('api.github.com').headers
+  assert headers['Accept'] == 'application/vnd.github.v3+json' and headers['User-Agent'] == 'JSTOR Labs visual essays client'
+  registry.close()
+
+def test_engine_applies_host_headers_unless_overridden():
+  engine = UpstreamEngine(transport=Echo())
+  async def run():
+    default = await engine.get('https://api.github.com/repos/a/b')
+    overridden = await engine.get('https://api.github.com/repos/a/b', headers={'Accept': 'application/vnd.github.raw'})
+    other = await engine.get('https://www.jstor.org/stable/1')
+    return default.json(), overridden.json(), other.json()
+  default, overridden, other = asyncio.run(run())
+  assert default['accept'] == 'application/vnd.github.v3+json' and overridden['accept'] == 'application/vnd.github.raw'
+  assert other['user-agent'] == 'Labs Client'